@@ -1,30 +1,135 @@
 """
 This file contains the code related with the RadGraph-XL model of NER to annotate the reports generated by the RIS +
 the post-processing to keep relevant information.
+The texts are annotated by batches (process_reports) : the sections of a report, or the reports of a relabeling, are
+given to the model in a single call, the identical texts (empty sections, standard sentences) are annotated once.
+With an annotation cache, the texts are split into sentences and only the sentences never seen by the model are
+annotated, the annotations of the sentences are stitched back into the annotation of the text (see stitch).
 """
 from radgraph import RadGraph
 from radgraph import get_radgraph_processed_annotations
+from src.NER.annotation_cache import AnnotationCache, sentence_key
 from typing import Any
+import importlib.metadata
+import torch
+import re
+
+# Version of the post-processing of the annotations into labels (__labels), to increase when the rules change so that
+# the stored reports are labeled again (see relabel)
+LABELS_VERSION = 1
+# End of a sentence : whitespaces after a final punctuation, or a line break
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\s*\n\s*")
+
+
+def model_version(model_type: str) -> str:
+    """
+    Returns the version of the annotations of the RadGraph model @model_type (cache keys, version of the labels)
+    """
+    return f"{model_type}/radgraph-{importlib.metadata.version('radgraph')}"
+
+
+def split_sentences(text: str) -> list[str]:
+    """
+    Returns the normalized sentences (whitespaces collapsed) of @text. The sentences are split on whitespaces, so the
+    tokens of the sentences are the tokens of the text (RadGraph tokenizes on whitespaces and punctuation).
+    """
+    sentences = list()
+    for sentence in SENTENCE_END.split(text):
+        sentence = " ".join(sentence.split())
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def stitch(annotations: list[dict[str, Any]]) -> dict[str, Any]:
+    """
+    Function that joins the RadGraph annotations of consecutive sentences into the annotation of the whole text : the
+    token positions (start_ix, end_ix) are shifted by the number of tokens of the previous sentences and the entities
+    are renumbered (with the targets of their relations) after the entities of the previous sentences.
+    returns the annotation of the text ({"text", "entities", ...})
+    """
+    tokens = list()
+    entities = dict()
+    for annotation in annotations:
+        offset = len(tokens)
+        shift = len(entities)
+        for entity_id, entity in annotation["entities"].items():
+            entities[str(int(entity_id) + shift)] = {
+                **entity,
+                "start_ix": entity["start_ix"] + offset,
+                "end_ix": entity["end_ix"] + offset,
+                "relations": [[relation, str(int(target) + shift)] for relation, target in entity["relations"]]
+            }
+        tokens.extend(annotation["text"].split())
+    return {"text": " ".join(tokens), "entities": entities, "data_source": None, "data_split": "inference"}
 
 
 class NERModel():
 
-    def __init__(self, model_type="modern-radgraph-xl"):
+    def __init__(self, model_type="modern-radgraph-xl", cache: AnnotationCache | None = None):
+        """
+        Constructor for NERModel instance.
+        @pre model_type: the RadGraph model
+        @pre cache: the cache of the annotations of the sentences, the whole texts are annotated by the model if None
+        """
         self.model_rad = RadGraph(model_type=model_type)
+        self.version = model_version(model_type)
+        # Saved with the labels of a report, changes with the model or the post-processing
+        self.labels_version = f"{self.version}/labels-{LABELS_VERSION}"
+        self.cache = cache
+
+    def __annotate(self, reports: list[str]) -> list[dict[str, Any]]:
+        """
+        Function that annotates several texts with a single call of the model, the results of the model (keyed by the
+        position of the text) are split back. The model runs without autograd (not disabled by RadGraph, the gradients
+        graph of each forward pass was built for nothing).
+        returns the RadGraph annotation ({"text", "entities", ...}) of each text, in the order of @reports
+        """
+        unique = list(dict.fromkeys(reports))
+        if not unique:
+            return list()
+        with torch.no_grad():
+            annotations = self.model_rad(unique)
+        by_text = dict()
+        for i, text in enumerate(unique):
+            if str(i) not in annotations:
+                # RadGraph skips (and prints) a text failing in its post-processing
+                raise ValueError(f"RadGraph failed to annotate the text {text!r}")
+            by_text[text] = annotations[str(i)]
+        return [by_text[text] for text in reports]
+
+    def annotate_reports(self, reports: list[str]) -> list[dict[str, Any]]:
+        """
+        Function that annotates several texts. With a cache, the texts are annotated sentence by sentence : the
+        sentences missing from the cache are annotated with a single call of the model and added to the cache. The
+        relations between entities of different sentences are not found (each sentence is annotated alone).
+        returns the RadGraph annotation ({"text", "entities", ...}) of each text, in the order of @reports
+        """
+        if self.cache is None:
+            return self.__annotate(reports)
+        sentences = [split_sentences(report) for report in reports]
+        keys = {sentence: sentence_key(sentence, self.version) for report in sentences for sentence in report}
+        annotations = self.cache.get_many(keys.values())
+        missing = [sentence for sentence, key in keys.items() if key not in annotations]
+        if missing:
+            annotated = {keys[sentence]: annotation for sentence, annotation in zip(missing, self.__annotate(missing))}
+            self.cache.put_many(annotated, self.version)
+            annotations.update(annotated)
+        return [stitch([annotations[keys[sentence]] for sentence in report]) for report in sentences]
 
     def annotate_report(self, report: str):
-        return self.model_rad([report])
+        return {"0": self.annotate_reports([report])[0]}
 
     def process_annotation(self, annotations: dict) -> dict[str, list | dict[str, Any]]:
         return get_radgraph_processed_annotations(annotations)
 
-    def process_data(self, report: str) -> tuple[list, dict[str, list | dict[str, Any]]]:
+    @staticmethod
+    def __labels(processed_annotations: dict[str, list | dict[str, Any]]) -> list[dict[str, str]]:
         """
         Function that postprocess the data annotated by the model. This function can be modified to postprocess more or
         less the output of the model. Currently, the function doesn't take the observation for which we do not know the
         localisation and the presence is uncertain.
         """
-        processed_annotations = self.process_annotation(self.annotate_report(report))
         res = list()
         for annotation in processed_annotations["processed_annotations"]:
             tmp = dict()
@@ -33,5 +138,18 @@ class NERModel():
                 tmp['located_at'] = annotation.get("located_at", "unknown")
                 tmp['tags'] = annotation.get("tags", ['unknown'])[0].lower()
                 res.append(tmp)
-        return res, processed_annotations
+        return res
 
+    def process_reports(self, reports: list[str]) -> list[tuple[list, dict[str, list | dict[str, Any]]]]:
+        """
+        Function that annotates and postprocesses several texts with a single call of the model.
+        returns for each text of @reports (in the same order) its labels and its processed annotations
+        """
+        result = list()
+        for annotation in self.annotate_reports(reports):
+            processed_annotations = self.process_annotation({"0": annotation})
+            result.append((self.__labels(processed_annotations), processed_annotations))
+        return result
+
+    def process_data(self, report: str) -> tuple[list, dict[str, list | dict[str, Any]]]:
+        return self.process_reports([report])[0]
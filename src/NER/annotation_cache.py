@@ -0,0 +1,96 @@
+"""
+This file contains the cache of the RadGraph annotations of the sentences of the reports. Most of the sentences of the
+reports are standard phrases ("No acute intracranial abnormality.") annotated again and again by the model :
+    - A sentence is identified by a hash of its normalized text (whitespaces collapsed) and of the version of the model,
+      a new model never reuses the annotations of the previous one
+    - The cache keeps the @capacity most recently used annotations in memory (LRU), backed by a MongoDB collection
+      shared by all the workers of the server and kept across restarts
+    - The annotations are never modified once computed (same text, same model), no invalidation is needed
+The annotations returned are shared by all the threads and must not be modified.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo import ReplaceOne
+from collections import OrderedDict
+from typing import Any
+import hashlib
+import threading
+
+COLLECTION = "ner_annotations"
+
+
+def sentence_key(sentence: str, version: str) -> str:
+    """
+    Returns the key of the annotation of @sentence (normalized) by the model @version
+    """
+    return hashlib.sha256(f"{version}\0{sentence}".encode("utf-8")).hexdigest()
+
+
+class AnnotationCache:
+
+    def __init__(self, capacity: int = 100000, m_client: MongoDBClient | None = None):
+        """
+        Constructor for AnnotationCache instance.
+        @pre capacity: the maximum number of annotations kept in memory
+        @pre m_client: MongoDB client object storing the annotations, the cache is only in memory if None
+        """
+        self.capacity = capacity
+        self.m_client = m_client
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__annotations = OrderedDict()    # {key: annotation}, least recently used first
+
+    def __put(self, key: str, annotation: dict[str, Any]):
+        self.__annotations[key] = annotation
+        self.__annotations.move_to_end(key)
+        while len(self.__annotations) > self.capacity:
+            self.__annotations.popitem(last=False)
+
+    def get_many(self, keys) -> dict[str, dict[str, Any]]:
+        """
+        Returns {key: annotation} for the annotations of @keys already computed, the keys missing from the memory are
+        read from MongoDB with a single query
+        """
+        keys = set(keys)
+        result = dict()
+        missing = list()
+        with self.__lock:
+            for key in keys:
+                annotation = self.__annotations.get(key)
+                if annotation is not None:
+                    self.__annotations.move_to_end(key)
+                    result[key] = annotation
+                else:
+                    missing.append(key)
+        if missing and self.m_client is not None:
+            documents = self.m_client.get_documents(COLLECTION, {"_id": {"$in": missing}})
+            with self.__lock:
+                for document in documents:
+                    self.__put(document["_id"], document["annotation"])
+                    result[document["_id"]] = document["annotation"]
+        with self.__lock:
+            self.hits += len(result)
+            self.misses += len(keys) - len(result)
+        return result
+
+    def put_many(self, annotations: dict[str, dict[str, Any]], version: str):
+        """
+        Function that stores the annotations ({key: annotation}) computed by the model @version, in memory and in
+        MongoDB (single bulk write)
+        """
+        with self.__lock:
+            for key, annotation in annotations.items():
+                self.__put(key, annotation)
+        if annotations and self.m_client is not None:
+            self.m_client.bulk_write(COLLECTION, [
+                ReplaceOne({"_id": key}, {"_id": key, "version": version, "annotation": annotation}, upsert=True)
+                for key, annotation in annotations.items()
+            ])
+
+    def clear(self):
+        with self.__lock:
+            self.__annotations.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {"size": len(self.__annotations), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
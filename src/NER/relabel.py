@@ -0,0 +1,130 @@
+"""
+This file contains the relabeling of the stored reports, to run when the RadGraph model or the post-processing of the
+annotations (NER.LABELS_VERSION) changes. The labels of a report are stale when its labels_version is not the one of
+the current model :
+    - The reports are streamed from MongoDB in _id order and labeled by batches in a pool of processes (one model per
+      process), the labels of each batch are written with a single bulk write
+    - The progress (last report of the batches written, in order) is saved in the relabel_checkpoints collection after
+      each batch, an interrupted relabeling resumes after it
+    - The reports already labeled by this version (labeling queue, previous run) are skipped, the reports waiting for
+      the labeling queue are left to it, a report failing is left unchanged
+    - The sentences annotated are shared through the annotation cache, a change of the post-processing only does not run
+      the model again
+Run it with :
+    python -m src.NER.relabel [--model-type modern-radgraph-xl] [--processes 2] [--batch-size 32] [--restart]
+"""
+from src.utils.MongoDBClient import MongoDBClient, create_client
+from src.NER.NER import NERModel, LABELS_VERSION, model_version
+from src.NER.annotation_cache import AnnotationCache
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from pymongo import ReplaceOne, UpdateOne
+from typing import Any
+import src.utils.labeling as labeling
+import multiprocessing
+import datetime
+import torch
+import time
+
+CHECKPOINTS = "relabel_checkpoints"
+# Fields of a report sent to the labeling processes
+PROJECTION = {"_id": 1, **{f"{section}-text": 1 for section in labeling.SECTIONS}}
+
+_model = None    # Model of a labeling process
+
+
+def init_process(model_type: str, cache_size: int, threads: int):
+    """
+    Loads the model of a labeling process, with its own connection to MongoDB for the annotation cache
+    """
+    global _model
+    torch.set_num_threads(threads)
+    cache = AnnotationCache(cache_size, create_client()) if cache_size > 0 else None
+    _model = NERModel(model_type, cache)
+
+
+def label_batch(reports: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return labeling.label_reports(_model, reports)
+
+
+def relabel(m_client: MongoDBClient, model_type: str = "modern-radgraph-xl", processes: int = 2, batch_size: int = 32,
+            cache_size: int = 100000, restart: bool = False, progress_interval: float = 60) -> dict[str, Any]:
+    """
+    Function that labels again the reports whose labels were not computed by the current version of @model_type.
+        @pre m_client: MongoDB client object
+        @pre model_type: the RadGraph model
+        @pre processes: the number of labeling processes (each one loads the model)
+        @pre batch_size: the number of reports labeled per call of the model and written per bulk write
+        @pre cache_size: the number of annotations of sentences kept in memory by each process, no cache if 0
+        @pre restart: True to ignore the checkpoint of a previous run (the reports already relabeled are still skipped)
+        @pre progress_interval: the number of seconds between two progress lines
+    returns the checkpoint ({"_id": labels version, "last_id", "labeled", "failed", ...})
+    """
+    version = f"{model_version(model_type)}/labels-{LABELS_VERSION}"
+    if restart:
+        m_client.delete_document(CHECKPOINTS, version)
+    checkpoint = m_client.get_document(CHECKPOINTS, {"_id": version}) or {"_id": version, "last_id": None, "labeled": 0, "failed": 0}
+    query = {"labels_status": {"$nin": [labeling.PENDING, labeling.LABELING]}, "labels_version": {"$ne": version}}
+    if checkpoint["last_id"] is not None:
+        query["_id"] = {"$gt": checkpoint["last_id"]}
+
+    started = time.monotonic()
+    reported = started
+    done = 0
+
+    def write(batch: list[dict[str, Any]], future: Future):
+        nonlocal reported, done
+        operations = list()
+        for report, fields in zip(batch, future.result()):
+            if fields["labels_status"] == labeling.DONE:
+                operations.append(UpdateOne({"_id": report["_id"]}, {"$set": fields, "$unset": {"labels_error": ""}}))
+            else:
+                checkpoint["failed"] += 1
+        if operations:
+            m_client.bulk_write(labeling.COLLECTION, operations)
+        checkpoint["labeled"] += len(operations)
+        checkpoint["last_id"] = batch[-1]["_id"]
+        checkpoint["updated"] = datetime.datetime.now()
+        m_client.bulk_write(CHECKPOINTS, [ReplaceOne({"_id": version}, checkpoint, upsert=True)])
+        done += len(batch)
+        if time.monotonic() - reported >= progress_interval:
+            reported = time.monotonic()
+            print(f"{done} reports relabeled ({checkpoint['failed']} failed in total), {done / (reported - started):.1f} reports/s, last report {checkpoint['last_id']}")
+
+    # The intra-op threads of torch are shared between the processes instead of each process using all the cores
+    threads = max(1, multiprocessing.cpu_count() // processes)
+    # spawn : torch and the MongoDB client of the parent are not fork-safe
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_process, initargs=(model_type, cache_size, threads)) as pool:
+        # The batches are written in the order of the cursor so that the checkpoint never skips a report, a few batches
+        # per process are in flight to keep the processes busy while a batch is written
+        in_flight = deque()
+        batch = list()
+        for report in m_client.iter_documents(labeling.COLLECTION, query, projection=PROJECTION, sort=[("_id", 1)], batch_size=batch_size * processes):
+            batch.append(report)
+            if len(batch) >= batch_size:
+                in_flight.append((batch, pool.submit(label_batch, batch)))
+                batch = list()
+                if len(in_flight) >= 2 * processes:
+                    write(*in_flight.popleft())
+        if batch:
+            in_flight.append((batch, pool.submit(label_batch, batch)))
+        while in_flight:
+            write(*in_flight.popleft())
+
+    elapsed = time.monotonic() - started
+    print(f"{done} reports relabeled in {elapsed:.0f}s ({done / elapsed if elapsed else 0:.1f} reports/s), {checkpoint['labeled']} labeled and {checkpoint['failed']} failed with {version}")
+    return checkpoint
+
+
+if __name__ == "__main__":
+    import argparse
+    import src.config as config
+
+    parser = argparse.ArgumentParser(description="Label again the reports labeled by another version of the model or of the post-processing")
+    parser.add_argument("--model-type", default="modern-radgraph-xl", help="RadGraph model")
+    parser.add_argument("--processes", type=int, default=2, help="number of labeling processes (each one loads the model)")
+    parser.add_argument("--batch-size", type=int, default=32, help="number of reports per call of the model and per bulk write")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous run")
+    args = parser.parse_args()
+
+    relabel(create_client(), args.model_type, args.processes, args.batch_size, config.NER_CACHE_SIZE, args.restart)
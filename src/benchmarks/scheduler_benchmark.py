@@ -0,0 +1,190 @@
+"""
+This file contains a benchmark of the slot search of the Scheduler (Scheduler.get_possible_schedules). It seeds synthetic
+stations, patients and orders (using the procedures of configs/procedures.json) in a dedicated database, then measures
+for each combination of parameters :
+    - the latency percentiles (p50, p90, p99, max) of a slot search
+    - the number of allocated blocks and the peak of memory of one slot search (tracemalloc)
+Both engines of the scheduler can be measured : "sweep" (booked orders read from DB at each request) and "occupancy"
+(booked orders kept in the OccupancyCache). The results can be written as JSON to compare releases :
+    python -m src.benchmarks.scheduler_benchmark --orders 1000 10000 --stations 5 15 --d-range 7 14 --json results.json
+The seeded database (openris_bench by default) is dropped at the end of each combination. With --backend memory the
+orders are kept by the in-memory backend (no MongoDB server needed, the latencies exclude the network and the server).
+"""
+from src.utils.MongoDBClient import MongoDBClient, create_client
+from src.utils.indexes import apply_indexes
+from src.utils.occupancy import OccupancyCache
+from src.utils.scheduler import Scheduler
+from src.utils.utils import examination_datetimes
+import src.config as config
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+
+PROCEDURES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "configs", "procedures.json")
+SHIFT_START = datetime.datetime.strptime(config.SHIFT_START, "%H:%M").time()
+SHIFT_END = datetime.datetime.strptime(config.SHIFT_END, "%H:%M").time()
+
+
+def load_procedures(path: str = PROCEDURES_FILE) -> dict[str, list[dict]]:
+    """
+    Returns the procedures of the catalog grouped by modality {modality: [{"id", "name", "duration"}]}
+    """
+    with open(path) as f:
+        return json.load(f)["procedures"]
+
+
+def seed(m_client: MongoDBClient, rng: random.Random, modality: str, procedures: list[dict], n_orders: int, n_stations: int, d_range: int, n_patients: int) -> list[str]:
+    """
+    Function that seeds @n_orders SCHEDULED orders of @modality booked on the grid of the shift, spread over @n_stations
+    stations and the @d_range next days.
+    returns the list of the stations
+    """
+    stations = [f"{modality}{i + 1}" for i in range(n_stations)]
+    shift_start = SHIFT_START.hour * 60 + SHIFT_START.minute
+    shift_end = SHIFT_END.hour * 60 + SHIFT_END.minute
+    today = datetime.date.today()
+    batch = list()
+    for i in range(n_orders):
+        procedure = rng.choice(procedures)
+        duration = int(procedure["duration"])
+        date = today + datetime.timedelta(days=rng.randint(0, d_range))
+        start = shift_start + duration * rng.randint(0, (shift_end - shift_start) // duration - 1)
+        examination_date = {
+            "date": date.strftime("%Y-%m-%d"),
+            "start_time": f"{start // 60:02d}:{start % 60:02d}",
+            "end_time": f"{(start + duration) // 60:02d}:{(start + duration) % 60:02d}",
+        }
+        batch.append({
+            "_id": f"bench-{i}",
+            "patient_id": f"patient-{rng.randrange(n_patients)}",
+            "modality": modality,
+            "station_aet": rng.choice(stations),
+            "procedure": procedure["name"],
+            "examination_date": examination_date,
+            **examination_datetimes(examination_date),
+            "status": "SCHEDULED",
+            "is_active": True,
+        })
+        if len(batch) >= 10000:
+            m_client.add_documents("orders", batch)
+            batch = list()
+    if batch:
+        m_client.add_documents("orders", batch)
+    apply_indexes(m_client)
+    return stations
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1]
+
+
+def measure(scheduler: Scheduler, m_client: MongoDBClient, rng: random.Random, duration: int, stations: list[str], n_patients: int, n_requests: int) -> dict[str, float]:
+    """
+    Function that runs @n_requests slot searches for random patients and one more under tracemalloc.
+    returns the latency percentiles (ms), the number of slots returned and the allocations of one search
+    """
+    latencies = list()
+    n_slots = 0
+    for _ in range(n_requests):
+        patient_id = f"patient-{rng.randrange(n_patients)}"
+        start = time.perf_counter()
+        n_slots = len(scheduler.get_possible_schedules(duration, patient_id, stations, m_client))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    scheduler.get_possible_schedules(duration, f"patient-{rng.randrange(n_patients)}", stations, m_client)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated_blocks = sum(stat.count_diff for stat in after.compare_to(before, "lineno") if stat.count_diff > 0)
+    return {
+        "p50_ms": percentile(latencies, 50),
+        "p90_ms": percentile(latencies, 90),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+        "slots": n_slots,
+        "allocated_blocks": allocated_blocks,
+        "peak_kib": peak / 1024,
+    }
+
+
+def run(m_client_factory, orders: list[int], stations: list[int], d_ranges: list[int], durations: list[int], engines: list[str], n_requests: int, n_patients: int, modality: str, seed_value: int) -> list[dict]:
+    """
+    Entry point of the benchmark : for each (orders, stations, d_range) the database is seeded once, then every
+    (engine, duration) is measured.
+        @pre m_client_factory: a function returning an empty MongoDBClient-like object
+    returns the list of results (one dictionary per combination)
+    """
+    procedures = load_procedures()[modality]
+    durations = durations or sorted({int(procedure["duration"]) for procedure in procedures})
+    results = list()
+    for n_orders in orders:
+        for n_stations in stations:
+            for d_range in d_ranges:
+                rng = random.Random(seed_value)
+                m_client = m_client_factory()
+                seed_start = time.perf_counter()
+                station_names = seed(m_client, rng, modality, procedures, n_orders, n_stations, d_range, n_patients)
+                seed_time = time.perf_counter() - seed_start
+                for engine in engines:
+                    occupancy = OccupancyCache(d_range) if engine == "occupancy" else None
+                    scheduler = Scheduler(d_range, SHIFT_START, SHIFT_END, occupancy)
+                    for duration in durations:
+                        result = {
+                            "engine": engine,
+                            "orders": n_orders,
+                            "stations": n_stations,
+                            "d_range": d_range,
+                            "duration": duration,
+                            **measure(scheduler, m_client, rng, duration, station_names, n_patients, n_requests),
+                        }
+                        results.append(result)
+                        print(
+                            f"{engine:>9} orders={n_orders:>6} stations={n_stations:>3} d_range={d_range:>3} duration={duration:>3} | "
+                            f"p50={result['p50_ms']:8.2f}ms p90={result['p90_ms']:8.2f}ms p99={result['p99_ms']:8.2f}ms "
+                            f"slots={result['slots']:>5} blocks={result['allocated_blocks']:>7} peak={result['peak_kib']:9.1f}KiB "
+                            f"(seeded in {seed_time:.1f}s)"
+                        )
+                m_client.delete_database("orders")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the slot search of the scheduler")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 10000, 100000], help="number of booked orders")
+    parser.add_argument("--stations", type=int, nargs="+", default=[1, 5, 15], help="number of stations of the modality")
+    parser.add_argument("--d-range", type=int, nargs="+", default=[config.D_RANGE], help="number of days searched by the scheduler")
+    parser.add_argument("--durations", type=int, nargs="*", default=None, help="procedure durations (default: durations of the catalog)")
+    parser.add_argument("--engines", nargs="+", default=["sweep", "occupancy"], choices=["sweep", "occupancy"])
+    parser.add_argument("--requests", type=int, default=50, help="number of slot searches per combination")
+    parser.add_argument("--patients", type=int, default=2000, help="number of distinct patients")
+    parser.add_argument("--modality", default="CT")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", default="mongodb", choices=["mongodb", "memory"], help="storage backend of the seeded orders")
+    parser.add_argument("--url", default=config.MONGO_URL, help="MongoDB used to seed the orders")
+    parser.add_argument("--db", default="openris_bench", help="database dropped and seeded by the benchmark")
+    parser.add_argument("--json", default=None, help="file to write the results")
+    args = parser.parse_args()
+
+    def factory():
+        m_client = create_client(args.url, args.db, args.backend)
+        m_client.delete_database("orders")
+        return m_client
+
+    bench_results = run(factory, args.orders, args.stations, args.d_range, args.durations, args.engines, args.requests, args.patients, args.modality, args.seed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "date": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "results": bench_results
+            }, f, indent=4)
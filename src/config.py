@@ -2,6 +2,7 @@
 
 ORTHANC_SERVER = ""    # Enter the address to join orthanc
 ORTHANC_AET = "ORTHANC"    # To retrieve HL7 message incoming from Orthanc (differently handled)
+ORTHANC_WAIT_TIMEOUT = 10    # Seconds a request waits for the list of the stations connected to Orthanc (read at the start)
 RIS_SERVER = ""    # Enter the address of OpenRIS
 SECRET_KEY = "secret"
 
@@ -16,11 +17,51 @@ SEGMENT_HL7_DIR = "configs/hl7_segment_config.json"    # indicate the json file
 
 INSTITUTION_NAME = "DEBUG HOSPITAL"    # To identify the institution that send HL7 message
 HIS_NAME = "DEBUG HIS"    # To identify the HIS to send and receive message (ADT)
+## MongoDB configuration ##
+# Storage backend : "mongodb", or "memory" to run without a MongoDB server (in-process data, lost at exit, see memory_backend)
+MONGO_BACKEND = "mongodb"
+MONGO_URL = "mongodb://127.17.0.2:27017"
+MONGO_DB = "app"
+MONGO_MAX_POOL_SIZE = 100    # Maximum number of connections opened by each process (shared by the threads)
+MONGO_MIN_POOL_SIZE = 0
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000    # Time before failing a request when no server is available
+MONGO_SOCKET_TIMEOUT_MS = None    # Time before failing a request without answer (None : no timeout)
+MONGO_WRITE_CONCERN = 1    # Number of nodes acknowledging a write ("majority" for a replica set)
+MONGO_JOURNAL = False    # True to wait for the write to be in the journal
+MONGO_BATCH_SIZE = 1000    # Number of documents per batch when streaming a cursor (iter_documents)
+
 # Shift start is a string representing the start hour of the radiology department
 SHIFT_START = "8:00"
 SHIFT_END = "23:00"
 # Number of day(s) to consider for the scheduler
 D_RANGE = 7
+# Size in minutes of a cell of the stations occupancy cache and number of seconds before reloading it from DB
+OCCUPANCY_RESOLUTION = 1
+OCCUPANCY_TTL = 300
+# Maximum number of day(s) searched when the slots are requested by page (?limit=), can be longer than D_RANGE
+SLOTS_MAX_HORIZON = 90
+# Number of seconds before reloading the procedure catalog from DB, and if the catalog of all the workers is invalidated
+# at each change of the procedures (change stream, only available when MongoDB runs as a replica set)
+PROCEDURES_TTL = 300
+PROCEDURES_WATCH = True
+# Number of patients kept in memory (LRU) and number of seconds before reading a cached patient again from DB
+PATIENT_CACHE_SIZE = 10000
+PATIENT_CACHE_TTL = 60
+# Number of RadGraph annotations of sentences kept in memory (LRU), all of them are stored in DB (see annotation_cache)
+NER_CACHE_SIZE = 100000
+# Number of days an inactive order (and its report) stays in the live collections before being archived (see archive)
+ARCHIVE_AFTER_DAYS = 90
+# Number of rows of a page of the lists (patients, workflow, reports) and maximum accepted with ?limit=
+PAGE_SIZE = 50
+PAGE_MAX_SIZE = 500
+# Background labeling of the reports (see labeling) : number of threads running the NER model, number of reports
+# annotated per call of the model, seconds between two checks of the pending reports and seconds after which a report
+# claimed by a stopped worker is labeled again
+LABELING_WORKERS = 1
+LABELING_BATCH_SIZE = 8
+LABELING_POLL_INTERVAL = 5
+LABELING_CLAIM_TIMEOUT = 600
 
 ## Logger configuration ##
 MAX_BYTES_PER_FILE = 10000    # Number of bytes before file rolling
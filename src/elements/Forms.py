@@ -11,21 +11,9 @@ from wtforms import StringField, SelectField, TextAreaField, IntegerField, valid
 from wtforms.validators import ValidationError, DataRequired, Optional
 from wtforms.fields import TelField, EmailField
 import re
-import pyorthanc
-import config
 from utils import MongoDBClient
 
-client = MongoDBClient.MongoDBClient()
-orthanc_client = pyorthanc.Orthanc(config.ORTHANC_SERVER)
-
-
-# Use Orthanc server to get the modality connected to it
-# All the AET connected to Orthanc should present as "modality(MRI, CT, etc)"_"name" for example MRI_station1
-
-MODALITIES = set( modality.split('_')[0] for modality in set(orthanc_client.get_modalities()))
-MODALITIES.discard("horos")
-MODALITIES.discard("findscu")
-MODALITIES.discard(config.ORTHANC_AET)
+client = MongoDBClient.create_client()
 
 
 class BaseForm(FlaskForm):
@@ -54,7 +42,7 @@ class Order(BaseForm):
     # Imaging Request Information
     imaging_modality = SelectField(
         "Modality",
-        choices=[(modality, modality) for modality in MODALITIES],
+        choices=[],    # Modalities connected to Orthanc, set by the routes (see modality_choices in server)
         render_kw={"style": "display:block"},
     )
     procedure = SelectField(
@@ -104,8 +92,8 @@ class Order(BaseForm):
 class PatientSearchForm(BaseForm):
     """
     The form used to search a patient in the patients page
-        @patient_name: input-field for patient name (should contain an entire name)
-        @patient_surname: input-field for patient surname (should contain an entire surname)
+        @patient_name: input-field for patient name (the beginning of one or several words of the name, accents ignored)
+        @patient_surname: input-field for patient surname (the beginning of one or several words of the surname, accents ignored)
     """
     patient_name = StringField("Patient Name", validators=[Optional()])
     patient_surname = StringField("Patient Surname", validators=[Optional()])
@@ -114,14 +102,14 @@ class PatientSearchForm(BaseForm):
         """
         Validates the structure of the name field. Can be modified with the current institution
         """
-        if not bool(re.fullmatch(r'^[a-zA-Z\s\-\']+$', field.data)):
+        if not bool(re.fullmatch(r'^([^\W\d_]|[\s\-\'])+$', field.data)):
             raise ValidationError('Patient Name incorrect format')
 
     def validate_patient_surname(self, field):
         """
         Validates the structure of the surname field. Can be modified with the current institution
         """
-        if not bool(re.fullmatch(r'^[a-zA-Z\s\-\']+$', field.data)):
+        if not bool(re.fullmatch(r'^([^\W\d_]|[\s\-\'])+$', field.data)):
             raise ValidationError('Patient Surname incorrect format')
 
 
@@ -211,7 +199,7 @@ class NewProcedureForm(BaseForm):
                                       )
     procedure_modality = SelectField(
         "Modality",
-        choices=[(modality, modality) for modality in MODALITIES],
+        choices=[],    # Modalities connected to Orthanc, set by the routes (see modality_choices in server)
         render_kw={"style": "display:block"}
     )
 
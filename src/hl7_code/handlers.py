@@ -11,25 +11,29 @@ from uuid import uuid4
 import hl7
 from src.hl7_code.message_validators import extract_information
 from src.utils.MongoDBClient import MongoDBClient
+from src.utils.occupancy import OccupancyCache
+from src.utils.reservations import SlotReservations
+from src.utils.patient_search import search_keys
+from src.utils.catalog import ProcedureCatalog
+from src.utils.patient_cache import PatientCache
 
 
 
-def handle_adta01(message: hl7.Message, client: MongoDBClient) -> bool | None:
+def handle_adta01(message: hl7.Message, client: MongoDBClient, patients: PatientCache | None = None) -> bool | None:
     """
     Handle an ADT^A01 message, basically carrying the same information as ADT^A04
     """
-    return handle_adta04(message, client)
+    return handle_adta04(message, client, patients)
 
-def handle_adta04(message: hl7.Message, client: MongoDBClient) -> bool | None:
+def handle_adta04(message: hl7.Message, client: MongoDBClient, patients: PatientCache | None = None) -> bool | None:
     """
     Handle an ADT^A04 (register a new patient in the system) message to extract all the patient information (Name, Surname, ID, etc.). Can be extended to
-    extract more information.
+    extract more information. The patient is written through the patient cache if given.
     """
     if message.extract_field("MSH", field_num=5) != "OPENRIS":
         return None
+    patients = patients if patients is not None else PatientCache(capacity=0)
     patient_id = message.extract_field("PID", field_num=3)
-    if client.get_document('patients', {'_id': patient_id}) is not None:
-        return True
 
     new_patient = {
         '_id': patient_id,
@@ -77,28 +81,33 @@ def handle_adta04(message: hl7.Message, client: MongoDBClient) -> bool | None:
                                                                                                                 component_num=3) else ""
         }
     }
-    client.add_document('patients', new_patient)
+    new_patient.update(search_keys(new_patient['name'], new_patient['surname']))
+    patients.insert(client, new_patient)    # An already registered patient is kept as it is
     return True
 
 
-def handle_adta08(message: hl7.Message, client: MongoDBClient) -> bool | None:
+def handle_adta08(message: hl7.Message, client: MongoDBClient, patients: PatientCache | None = None) -> bool | None:
     """
-    Handle an ADT^A08 (change patient information) message
+    Handle an ADT^A08 (change patient information) message. The patient is read and written through the patient cache if given.
     """
     try:
         if message.extract_field("MSH", field_num=5) != "OPENRIS":
             return None
+        patients = patients if patients is not None else PatientCache(capacity=0)
         patient_id = message.extract_field("PID", field_num=3)
-        patient_to_update = client.get_document('patients', {'_id': patient_id})
+        patient_to_update = patients.get(client, patient_id)
         dob = extract_information(message, "PID", field_num=7)
-        client.update_document(
-            'patients',
+        name = extract_information(message, "PID", field_num=5, component_num=1) if extract_information(
+            message, "PID", field_num=5, component_num=1) else patient_to_update['name']
+        surname = extract_information(message, "PID", field_num=5, component_num=2) if extract_information(
+            message, "PID", field_num=5, component_num=2) else patient_to_update['surname']
+        patients.update(
+            client,
             patient_id,
             {
-                'name': extract_information(message, "PID", field_num=5, component_num=1) if extract_information(
-                    message, "PID", field_num=5, component_num=1) else patient_to_update['name'],
-                'surname': extract_information(message, "PID", field_num=5, component_num=2) if extract_information(
-                    message, "PID", field_num=5, component_num=2) else patient_to_update['surname'],
+                **search_keys(name, surname),
+                'name': name,
+                'surname': surname,
                 'dob': f"{dob[0:4]}-{dob[4:6]}-{dob[6:8]}" if dob else patient_to_update['dob'],
                 'sex': extract_information(message, "PID", field_num=8) if extract_information(message, "PID",
                                                                                                field_num=8) else patient_to_update['sex'],
@@ -126,19 +135,22 @@ def handle_adta08(message: hl7.Message, client: MongoDBClient) -> bool | None:
 def handle_omio23(message: hl7.Message, client: MongoDBClient):
     pass
 
-def handle_orm_o01(message: hl7.Message, client: MongoDBClient) -> bool | None:
+def handle_orm_o01(message: hl7.Message, client: MongoDBClient, occupancy: OccupancyCache | None = None, reservations: SlotReservations | None = None, procedures: ProcedureCatalog | None = None, patients: PatientCache | None = None) -> bool | None:
     """
     Handle an ORM^O01 (order management) message. Information checked :
         - procedure ID in OBX segment to verify the existence of the requesting procedure
         - patient ID in PID to verify the existence of the requesting patient
         - Control the Order Number and Placer ID because it indicates an order already placed or change the placer ID
     With its communication the HIS can only : add a new order, communicate a placer number if the order come from RIS,
-    cancel an order.
+    cancel an order. If an occupancy cache is given, it is kept up to date with the changed orders, the reservations of a
+    cancelled order are released. The procedure and the patient are read from the procedure catalog and the patient cache if given.
     """
     match extract_information(message, "ORC", field_num=1):
         case "NW":
-            patient = client.get_document('patients', {'_id': extract_information(message, "PID", field_num=3)})
-            procedure = client.get_document('procedures', {'_id': extract_information(message, "OBR", field_num=4, component_num=1)})
+            patient_id = extract_information(message, "PID", field_num=3)
+            patient = patients.get(client, patient_id) if patients is not None else client.get_document('patients', {'_id': patient_id})
+            procedure_id = extract_information(message, "OBR", field_num=4, component_num=1)
+            procedure = procedures.by_id(client, procedure_id) if procedures is not None else client.get_document('procedures', {'_id': procedure_id})
             if patient is None or procedure is None:
                 return False
 
@@ -157,6 +169,8 @@ def handle_orm_o01(message: hl7.Message, client: MongoDBClient) -> bool | None:
                     'start_time': '00:00',
                     'end_time': '00:00',
                 },
+                'examination_start': datetime.datetime.combine(datetime.date.today(), datetime.time()),
+                'examination_end': datetime.datetime.combine(datetime.date.today(), datetime.time()),
                 'modality': procedure['modality'],
                 'procedure': procedure['name'],
                 'note': extract_information(message, "OBR", field_num=13),
@@ -164,6 +178,8 @@ def handle_orm_o01(message: hl7.Message, client: MongoDBClient) -> bool | None:
                 'is_active': True,
             }
             client.add_document('orders', new_order)
+            if occupancy is not None:
+                occupancy.update_order(new_order)
             return True
 
         case "CA":
@@ -171,6 +187,10 @@ def handle_orm_o01(message: hl7.Message, client: MongoDBClient) -> bool | None:
             if res is None:
                 return False
             else:
+                if occupancy is not None:
+                    occupancy.remove_order(extract_information(message, "ORC", field_num=3))
+                if reservations is not None:
+                    reservations.release(client, extract_information(message, "ORC", field_num=3))
                 return True
         case "SN":
             order = client.get_document('orders', {'_id': extract_information(message, "ORC", field_num=3)})
@@ -1,22 +1,41 @@
-function fetchSlots(patient_id) {
+const SLOTS_PAGE_SIZE = 50;
+const MORE_SLOTS = "more-slots";    // Value of the last option used to load the next page of slots
+
+function fetchSlots(patient_id, after = "") {
     let proc_id = document.getElementById("procedure").value;
     const button = document.getElementById("register-order-button");
-    fetch(`/schedule/${patient_id}/${proc_id}`)
+    fetch(`/schedule/${patient_id}/${proc_id}?limit=${SLOTS_PAGE_SIZE}&after=${encodeURIComponent(after)}`)
         .then(resp => resp.json())
         .then(data => {
             const slots = document.getElementById("slots");
-            slots.innerHTML = '';
+            if (!after) slots.innerHTML = '';
             data.forEach(slotElem => {
                const newSlot = document.createElement("option");
                newSlot.value = slotElem.id;
                newSlot.textContent = slotElem.elem;
                slots.appendChild(newSlot)
             });
+            if (data.length === SLOTS_PAGE_SIZE) {
+                const moreSlots = document.createElement("option");
+                moreSlots.value = MORE_SLOTS;
+                moreSlots.textContent = "More slots...";
+                slots.appendChild(moreSlots);
+            }
         })
         .catch(e => console.error("Error when finding slots"));
     button.disabled = false;
 }
 
+document.getElementById("slots").addEventListener('change', () => {
+    const slots = document.getElementById("slots");
+    if (slots.value === MORE_SLOTS) {
+        slots.remove(slots.selectedIndex);
+        const last = slots.options[slots.options.length - 1];
+        fetchSlots(document.getElementById("register-order-button").dataset.patientId, last.value);
+        slots.value = last.value;
+    }
+});
+
 document.getElementById("procedure").addEventListener('change', () => {
     const slots = document.getElementById("slots");
     const button = document.getElementById("register-order-button");
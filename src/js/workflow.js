@@ -1,16 +1,34 @@
-function getAvailableSlots(order_id) {
-    fetch(`/get_available_slots/${order_id}`)
+const SLOTS_PAGE_SIZE = 50;
+const MORE_SLOTS = "more-slots";    // Value of the last option used to load the next page of slots
+
+function getAvailableSlots(order_id, after = "") {
+    fetch(`/get_available_slots/${order_id}?limit=${SLOTS_PAGE_SIZE}&after=${encodeURIComponent(after)}`)
         .then(resp => resp.json())
         .then(data => {
             const slots = document.getElementById("slots-"+order_id);
-            slots.innerHTML = '';
+            if (!after) {
+                slots.innerHTML = '';
+                slots.onchange = () => {
+                    if (slots.value === MORE_SLOTS) {
+                        slots.remove(slots.selectedIndex);
+                        const last = slots.options[slots.options.length - 1];
+                        getAvailableSlots(order_id, last.value);
+                        slots.value = last.value;
+                    }
+                };
+            }
             data.forEach(slotElem => {
                 const newSlot = document.createElement("option");
                 newSlot.value = slotElem.id;
                 newSlot.textContent = slotElem.elem;
                 slots.appendChild(newSlot);
             });
+            if (data.length === SLOTS_PAGE_SIZE) {
+                const moreSlots = document.createElement("option");
+                moreSlots.value = MORE_SLOTS;
+                moreSlots.textContent = "More slots...";
+                slots.appendChild(moreSlots);
+            }
         })
         .catch(e => console.error("Error when finding slots"));
 }
-
@@ -1,8 +1,11 @@
+import itertools
+import threading
 import flask
 from pydicom.uid import generate_uid
 
 import src.hl7_code.handlers as handlers
-from pymongo.errors import WriteError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError, WriteError
 
 from flask import request, flash, jsonify, make_response, Response
 from flask_material import Material
@@ -13,18 +16,29 @@ from src.utils.utils import generate_uuid
 from utils import utils
 from elements.Forms import *
 from hl7_code.message_validators import *
-from src.NER.NER import *
 import pyorthanc
 import requests
 import src.log as log
 
 import config
 from utils.scheduler import *
+from src.utils.reservations import SlotReservations
+from src.utils.catalog import ProcedureCatalog
+from src.utils.patient_cache import PatientCache
+from src.NER.annotation_cache import AnnotationCache
+from src.utils.joins import attach_patients, get_patient_with_orders
+from src.utils.pagination import Listing
+from src.utils.indexes import apply_indexes
+from src.utils.MongoDBClient import create_client
+from src.utils.dependencies import Dependency, DependencyUnavailable
+import src.utils.patient_search as patient_search
+import src.utils.order_states as order_states
+import src.utils.archive as archive
+import src.utils.labeling as labeling
 
 # TODO : Write the GIT page + function static + documentation + test the code
 # TODO : Publish the code in public + choose a license Open Source
 
-ner_model = NERModel()
 hl7_logger = log.HL7LogHandler()
 app_logger = log.AppLogHandler()
 
@@ -35,16 +49,119 @@ app.config['SECRET_KEY'] = config.SECRET_KEY
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 
 
-client = MongoDBClient()
-scheduler = Scheduler(config.D_RANGE, datetime.datetime.strptime(config.SHIFT_START, "%H:%M").time(), datetime.datetime.strptime(config.SHIFT_END, "%H:%M").time())
+client = create_client()
+occupancy = OccupancyCache(config.D_RANGE, config.OCCUPANCY_RESOLUTION, config.OCCUPANCY_TTL, app_logger.add_error_log)
+scheduler = Scheduler(config.D_RANGE, datetime.datetime.strptime(config.SHIFT_START, "%H:%M").time(), datetime.datetime.strptime(config.SHIFT_END, "%H:%M").time(), occupancy)
+reservations = SlotReservations()
+procedures = ProcedureCatalog(config.PROCEDURES_TTL)
+patient_cache = PatientCache(config.PATIENT_CACHE_SIZE, config.PATIENT_CACHE_TTL)
+annotation_cache = AnnotationCache(config.NER_CACHE_SIZE, client)    # Annotations of the sentences of the reports
+
+# Paginated lists, sorted by MongoDB on the sorts allowed in the URL (?sort=)
+patients_list = Listing(
+    "patients",
+    {"name": "name", "surname": "surname", "sex": "sex", "dob": "dob"},
+    "surname",
+    projection={"_id": 1, "name": 1, "surname": 1, "sex": 1, "dob": 1, "phone_number": 1}
+)
+workflow_list = Listing(
+    "orders",
+    {"procedure": "procedure", "modality": "modality", "station": "station_aet", "status": "status", "date": "examination_start"},
+    "date",
+    projection={"_id": 1, "patient_id": 1, "procedure": 1, "modality": 1, "station_aet": 1, "status": 1, "examination_date": 1,
+                "executive-start-time": 1, "executive-end-time": 1, "orthanc_series_id": 1}
+)
+reports_list = Listing("reports", {"date": "date"}, "date", projection={"_id": 1, "order_id": 1, "patient_id": 1, "date": 1, "labels_status": 1})
 
 pattern_val = PatternValidator(config.MESSAGE_HL7_DIR, config.SEGMENT_HL7_DIR)
 
 
 orthanc_client = pyorthanc.Orthanc(config.ORTHANC_SERVER)    # Connect to Orthanc service from RIS to enable communication
-if not orthanc_client:
-    app_logger.add_error_log("Orthanc server not available")
-modalities = orthanc_client.get_modalities()
+
+
+def load_ner_model():
+    # radgraph (and torch) are imported with the model, not when the server starts
+    from src.NER.NER import NERModel
+    return NERModel(cache=annotation_cache)
+
+
+# Slow dependencies, loaded in the background (see start_services), only the code using them waits for them
+ner_model = Dependency("ner_model", load_ner_model)
+stations = Dependency("orthanc", orthanc_client.get_modalities)    # AETs connected to Orthanc, as "modality"_"name"
+indexes = Dependency("indexes", lambda: apply_indexes(client))    # Can be long on large collections
+# The reports are labeled by background threads, the report creation does not wait for the NER model
+labeling_queue = labeling.LabelingQueue(ner_model, config.LABELING_WORKERS, config.LABELING_BATCH_SIZE, config.LABELING_POLL_INTERVAL, config.LABELING_CLAIM_TIMEOUT)
+services_lock = threading.Lock()    # Starts the background work once per worker (see start_services)
+
+
+def start_services():
+    """
+    Starts the background work of the worker once : the indexes, the slow dependencies (NER model, Orthanc), the catalog
+    watch and the labeling threads all start in background threads, no request waits for them (see /ready)
+    """
+    if app.extensions.get("openris_started"):
+        return
+    with services_lock:
+        if app.extensions.get("openris_started"):
+            return
+        app.extensions["openris_started"] = True
+        for dependency in (indexes, ner_model, stations):
+            dependency.start()
+        if config.PROCEDURES_WATCH:
+            procedures.watch(client, app_logger.add_error_log)
+        labeling_queue.start(client, send_report, app_logger.add_error_log)
+
+
+def create_app() -> flask.Flask:
+    """
+    Application factory, to give to the WSGI server (gunicorn "server:create_app()") or to flask --app. The services are
+    started right away (see start_services), the pages not using the slow dependencies are served while they load (see
+    /ready). When the module-level app is served directly (gunicorn "server:app"), the first request starts them.
+    returns the application
+    """
+    start_services()
+    return app
+
+
+@app.before_request
+def ensure_started():
+    start_services()
+
+
+def modality_choices() -> list[tuple[str, str]]:
+    """
+    Returns the choices of the modality fields of the forms : the modalities of the AETs connected to Orthanc (for
+    example MRI for MRI_station1), an empty list if Orthanc is not available
+    """
+    try:
+        aets = stations.get(config.ORTHANC_WAIT_TIMEOUT)
+    except DependencyUnavailable as e:
+        app_logger.add_error_log(f"Orthanc server not available: {e}")
+        return list()
+    modalities = set(aet.split('_')[0] for aet in aets) - {"horos", "findscu", config.ORTHANC_AET}
+    return [(modality, modality) for modality in sorted(modalities)]
+
+
+@app.errorhandler(DependencyUnavailable)
+def dependency_unavailable(e):
+    app_logger.add_error_log(str(e))
+    response = make_response(jsonify({"error": str(e)}), 503)
+    response.headers["Retry-After"] = "5"
+    return response
+
+
+@app.route("/ready")
+def ready():
+    """
+    Readiness endpoint : 200 once all the dependencies are loaded, 503 before (the other pages are already served). The
+    indexes are applied again after a failure (MongoDB down at the start), the other dependencies are loaded again by
+    the requests using them.
+    """
+    if indexes.status()["state"] == "failed":
+        indexes.start()
+    dependencies = {dependency.name: dependency.status() for dependency in (indexes, ner_model, stations)}
+    is_ready = all(status["state"] == "ready" for status in dependencies.values())
+    return make_response(jsonify({"ready": is_ready, "dependencies": dependencies}), 200 if is_ready else 503)
 
 
 def send_hl7(message: hl7.Message) -> bool:
@@ -69,6 +186,87 @@ def send_hl7(message: hl7.Message) -> bool:
             return False
     return True
 
+
+def send_report(report: dict):
+    """
+    Sends the ORU^R01 of a report to the HIS, called by the labeling threads once the report is labeled (see labeling)
+    """
+    order = archive.get_order(client, report["order_id"])
+    if order is None:
+        app_logger.add_error_log(f"Order {report['order_id']} of the report {report['_id']} not found, ORU^R01 not sent")
+        return
+    patient = patient_cache.get(client, report["patient_id"])
+    procedure = procedures.by_name(client, order["procedure"])
+    if procedure is None:
+        app_logger.add_error_log(f"Procedure {order['procedure']} of the report {report['_id']} not found, ORU^R01 not sent")
+        return
+    if not send_hl7(construct_oru_r01(report, procedure, order, patient, generate_uuid(), datetime.datetime.today().date().strftime("%Y%m%d"))):
+        app_logger.add_error_log(f"HIS failed to get the report {report['_id']} of order {report['order_id']}")
+
+
+def page_args() -> dict:
+    """
+    Reads the arguments of a paginated list from the URL (?sort=&order=asc|desc&after=&limit=)
+    returns the keyword arguments of Listing.page
+    """
+    limit = request.args.get("limit", config.PAGE_SIZE, type=int)
+    return {
+        "sort": request.args.get("sort"),
+        "direction": -1 if request.args.get("order") == "desc" else 1,
+        "after": request.args.get("after"),
+        "limit": min(max(limit, 1), config.PAGE_MAX_SIZE)
+    }
+
+
+def read_page(listing: Listing, query: dict) -> tuple[list, str | None]:
+    """
+    Reads the page of @listing requested in the URL, aborts with 400 if the cursor is invalid
+    """
+    try:
+        return listing.page(client, query, **page_args())
+    except ValueError:
+        flask.abort(400)
+
+
+def link_args(**filters) -> dict:
+    """
+    Returns the arguments of the URL to keep in the links of a paginated list (filters and sort, without the cursor)
+    """
+    args = {key: value for key, value in filters.items() if value}
+    for key in ("sort", "order", "limit"):
+        if request.args.get(key):
+            args[key] = request.args.get(key)
+    return args
+
+
+def patients_query(name: str, surname: str) -> dict:
+    # Prefix/phonetic search on the normalized search keys of the patients
+    return patient_search.search_query(name, surname)
+
+
+def workflow_query(filter: str) -> dict:
+    if filter == "today":
+        day_start = datetime.datetime.combine(datetime.datetime.today().date(), datetime.time())
+        return {'is_active': True, 'examination_start': {'$gte': day_start, '$lt': day_start + datetime.timedelta(days=1)}}
+    elif filter == "all":
+        return {'is_active': True}
+    else:
+        return {'is_active': True, 'status': 'FINISHED'}
+
+
+def reports_query(section: str, observation: str, presence: str) -> dict:
+    if not observation:
+        return dict()
+    return {
+        "labels." + str(section): {
+            "$elemMatch": {
+                "observation": observation.lower(),
+                "tags": presence
+            }
+        }
+    }
+
+
 @app.route("/")
 def index():
     app_logger.add_info_log("Application launched")
@@ -79,45 +277,41 @@ def index():
 def patients():
     search_form = PatientSearchForm()
     if request.method == "POST" and search_form.validate():
-        if search_form.patient_surname.data and search_form.patient_name.data:
-            patients = client.get_documents('patients', {'name': search_form.patient_name.data.upper(), 'surname': search_form.patient_surname.data.upper()})
-        elif search_form.patient_name.data:
-            patients = client.get_documents('patients', {'name': search_form.patient_name.data.upper()})
-        elif search_form.patient_surname.data:
-            patients = client.get_documents('patients', {'surname': search_form.patient_surname.data.upper()})
-        else:
-            patients = client.get_documents('patients', {})
-        return flask.render_template("patients.html", patients=patients, page_name='patients', search_form=search_form)
+        name, surname = search_form.patient_name.data, search_form.patient_surname.data
     elif request.method == "POST":
-        patients = client.get_documents("patients", {})
-        search_form.patient_name.data = ""
-        search_form.patient_surname.data = ""
-        return flask.render_template("patients.html", patients=patients, page_name='patients', search_form=search_form)
+        name, surname = "", ""
     else:
-        patients = client.get_documents("patients", {})
-        search_form.patient_name.data = ""
-        search_form.patient_surname.data = ""
-        return flask.render_template("patients.html", patients=patients, page_name='patients', search_form=search_form)
+        # Next pages of a search are requested with the search in the URL
+        name, surname = request.args.get("name", ""), request.args.get("surname", "")
+    search_form.patient_name.data = name
+    search_form.patient_surname.data = surname
+    patients, next_cursor = read_page(patients_list, patients_query(name, surname))
+    return flask.render_template("patients.html", patients=patients, next_cursor=next_cursor, args=link_args(name=name, surname=surname), page_name='patients', search_form=search_form)
+
+
+@app.route("/get_patients")
+def get_patients_page():
+    patients, next_cursor = read_page(patients_list, patients_query(request.args.get("name", ""), request.args.get("surname", "")))
+    return jsonify({"patients": patients, "next": next_cursor})
 
 
 @app.route("/patient_information/<id>")
 def patient_information(id):
-    patient = client.get_document('patients', {'_id': id})
-    scheduled_orders = client.get_documents('orders', {'patient_id': id, 'is_active': True})
-    past_orders = client.get_documents('orders', {'patient_id': id, 'is_active': False})
+    patient, scheduled_orders, past_orders = get_patient_with_orders(client, id, patient_cache)
     return flask.render_template('patient_informations.html', patient=patient, scheduled_orders=scheduled_orders, past_orders=past_orders)
 
 
 @app.route("/edit_profile/<id>", methods=["GET", "POST"])
 def edit_profile(id):
-    patient = client.get_document('patients', {'_id': id})
+    patient = patient_cache.get(client, id)
     PatientDemForm = PatientDemographics()
     if request.method == "POST" and PatientDemForm.validate():
         date = datetime.datetime.now().strftime("%Y%m%d")
-        client.update_document(
-            'patients',
+        patient = patient_cache.update(
+            client,
             id,
             {
+                **patient_search.search_keys(PatientDemForm.patient_name.data, PatientDemForm.patient_surname.data),
                 'name': PatientDemForm.patient_name.data.upper(),
                 'surname': PatientDemForm.patient_surname.data.upper(),
                 'dob': PatientDemForm.patient_dob.data,
@@ -138,7 +332,6 @@ def edit_profile(id):
                 }
             }
         )
-        patient = client.get_document("patients", {"_id": id})
         # Creating HL7 ADT^A08 message
         send_hl7(construct_adt_a08(patient, date, generate_uuid()))
         return flask.redirect("/patients")
@@ -172,7 +365,7 @@ def receive_hl7_message():
             valid = ADTA01Validator().validate_and_ack(message, pattern_val, config.INSTITUTION_NAME, "OPENRIS")
             hl7_logger.add_log("IN", str(valid))
             if extract_information(valid, "MSA", field_num=1) == "AA":
-                success = handlers.handle_adta01(message, client)
+                success = handlers.handle_adta01(message, client, patient_cache)
                 if success:
                     hl7_logger.add_log("OUT", str(valid))
                     return make_response(jsonify({"ack": valid}), 200)
@@ -185,7 +378,7 @@ def receive_hl7_message():
             valid = ADTA04Validator().validate_and_ack(message, pattern_val, config.INSTITUTION_NAME, "OPENRIS")
             hl7_logger.add_log("IN", str(message))
             if extract_information(valid, "MSA", field_num=1) == "AA":
-                success = handlers.handle_adta04(message, client)
+                success = handlers.handle_adta04(message, client, patient_cache)
                 if success:
                     hl7_logger.add_log("OUT", str(valid))
                     return make_response(jsonify({"ack": str(valid)}), 200)
@@ -198,7 +391,7 @@ def receive_hl7_message():
             valid = ADTA08Validator().validate_and_ack(message, pattern_val, config.INSTITUTION_NAME, "OPENRIS")
             hl7_logger.add_log("IN", str(message))
             if extract_information(valid, "MSA", field_num=1) == "AA":
-                success = handlers.handle_adta08(message, client)
+                success = handlers.handle_adta08(message, client, patient_cache)
                 if success:
                     hl7_logger.add_log("OUT", str(valid))
                     return make_response(jsonify({"ack": str(valid)}), 200)
@@ -211,7 +404,7 @@ def receive_hl7_message():
             valid = ORMO01Validator().validate_and_ack(message, pattern_val, config.INSTITUTION_NAME, "OPENRIS")
             hl7_logger.add_log("IN", str(message))
             if extract_information(valid, "MSA", field_num=1) == "AA":
-                success = handlers.handle_orm_o01(message, client)
+                success = handlers.handle_orm_o01(message, client, occupancy, reservations, procedures, patient_cache)
                 if success:
                     hl7_logger.add_log("OUT", str(valid))
                     return make_response(jsonify({"ack": str(valid)}), 200)
@@ -227,14 +420,37 @@ def receive_hl7_message():
             return make_response(jsonify({"ack": str(valid)}), 400)
 
 
-@app.route('/schedule/<patient_id>/<proc_id>', methods=['GET'])
-def schedule(patient_id, proc_id):
-    procedure = client.get_document('procedures', {'_id': proc_id})
-    possible_scheduling = scheduler.get_possible_schedules(int(procedure["duration"]), patient_id, [station for station in modalities if station.startswith(procedure["modality"])], client)
+def search_slots(duration: int, patient_id: str, modality: str) -> list[dict[str, str]]:
+    """
+    Search the free slots to book a procedure of @duration minutes on a station of @modality for the patient and
+    serialize them for the frontend (aborts with 400 on invalid parameters). Without query parameters, all the slots of
+    the range of days are returned, otherwise :
+        - limit: the maximum number of slots to return (the search goes up to SLOTS_MAX_HORIZON days)
+        - after: the id of the last slot already received, only the slots starting after it are returned
+    """
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 0:
+        flask.abort(400)
+    after = request.args.get("after", "")
+    if after:
+        try:
+            after = datetime.datetime.strptime(" ".join(after.split("|")[:2]), "%Y-%m-%d %H:%M")
+        except ValueError:
+            flask.abort(400)
+    else:
+        after = None
+    possible_scheduling = scheduler.iter_possible_schedules(
+        duration,
+        patient_id,
+        [station for station in stations.get(config.ORTHANC_WAIT_TIMEOUT) if station.startswith(modality)],
+        client,
+        after=after,
+        horizon=config.SLOTS_MAX_HORIZON if limit else None
+    )
     slots = list()
-    for possible_slot in possible_scheduling:
-        slot_id = possible_slot[1].date.strftime("%Y-%m-%d")+"|"+possible_slot[1].start_t.strftime("%H:%M")+"|"+possible_slot[1].end_t.strftime("%H:%M")+"|"+possible_slot[0]
-        slot_display = possible_slot[1].date.strftime("%Y-%m-%d")+" "+possible_slot[1].start_t.strftime("%H:%M")+" - "+possible_slot[1].end_t.strftime("%H:%M")
+    for station, slot in itertools.islice(possible_scheduling, limit):
+        slot_id = slot.date.strftime("%Y-%m-%d")+"|"+slot.start_t.strftime("%H:%M")+"|"+slot.end_t.strftime("%H:%M")+"|"+station
+        slot_display = slot.date.strftime("%Y-%m-%d")+" "+slot.start_t.strftime("%H:%M")+" - "+slot.end_t.strftime("%H:%M")
         slots.append(
             {
                 "id": slot_id,
@@ -244,19 +460,31 @@ def schedule(patient_id, proc_id):
     return slots
 
 
+@app.route('/schedule/<patient_id>/<proc_id>', methods=['GET'])
+def schedule(patient_id, proc_id):
+    procedure = procedures.by_id(client, proc_id)
+    return search_slots(int(procedure["duration"]), patient_id, procedure["modality"])
+
+
 @app.route("/schedule_order/<id>", methods=['POST'])
 def schedule_new_order(id):
     order = client.get_document('orders', {'_id': id})
-    patient = client.get_document('patients', {'_id': order['patient_id']})
-    procedure = client.get_document('procedures', {'name': order['procedure']})
+    patient = patient_cache.get(client, order['patient_id'])
+    procedure = procedures.by_name(client, order['procedure'])
     date = request.form["slots"].split('|')
     order["examination_date"] = {
         "date": date[0],
         "start_time": date[1],
         "end_time": date[2],
     }
+    order.update(utils.examination_datetimes(order["examination_date"]))
     order["status"] = "SCHEDULED"
     order["station_aet"] = date[3]
+    reserved = reservations.reserve(client, id, date[3], order['patient_id'], date[0], date[1], date[2])
+    if reserved is None:
+        app_logger.add_error_log(f"Slot {request.form['slots']} already booked, order {id} not scheduled")
+        flash(f"The slot has just been booked, order {id} cannot be scheduled!", "error")
+        return flask.redirect("/")
     if send_hl7(construct_orm_o01(order, procedure, patient, generate_uuid(), datetime.datetime.now().strftime("%Y%m%d"), "SC", "SC")):
         client.update_document(
             'orders',
@@ -268,45 +496,145 @@ def schedule_new_order(id):
                     "date": date[0],
                     "start_time": date[1],
                     "end_time": date[2],
-                }
+                },
+                "examination_start": order["examination_start"],
+                "examination_end": order["examination_end"],
             }
         )
+        reservations.confirm(client, id, date[3], order['patient_id'], date[0], date[1], date[2])
+        occupancy.update_order(order)
         app_logger.add_info_log(f"HIS successfully gets the scheduling of order {id}")
         flash(f"Order {id} has been successfully scheduled!", "toast")
     else:
+        reservations.cancel(client, id, reserved)
         app_logger.add_error_log(f"HIS failed to get the scheduling of order {id}")
         flash(f"Order {id} failed to be scheduled!", "toast")
     return flask.redirect("/")
 
 
+@app.route("/schedule_orders", methods=['POST'])
+def schedule_orders():
+    """
+    Bulk scheduling of orders (e.g. orders received from the HIS or a screening campaign). The body is a JSON
+    {"order_ids": [...]}, all the orders get a slot in one pass of the scheduler (in the given order), the accepted
+    ones are reserved (see SlotReservations) and persisted with one bulk write, then the ORM^O01 of the orders written
+    are sent to the HIS. An order the HIS does not get is put back in its previous state. The orders already in the
+    examination flow (worklist generated, in progress, finished) are not moved and returned as skipped.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("order_ids"), list) or not data["order_ids"] \
+            or not all(isinstance(order_id, str) for order_id in data["order_ids"]):
+        return flask.Response(status=400)
+    positions = {order_id: i for i, order_id in enumerate(data["order_ids"])}
+    orders = sorted(client.get_documents('orders', {'_id': {'$in': data["order_ids"]}, 'is_active': True}), key=lambda order: positions[order['_id']])
+    skipped = [order['_id'] for order in orders if order.get('status') not in order_states.SCHEDULABLE]
+    orders = [order for order in orders if order.get('status') in order_states.SCHEDULABLE]
+    order_procedures = procedures.by_names(client, {order['procedure'] for order in orders})
+    aets = stations.get(config.ORTHANC_WAIT_TIMEOUT)
+    patients = patient_cache.get_many(client, (order['patient_id'] for order in orders))
+    orders = [order for order in orders if order['procedure'] in order_procedures and order['patient_id'] in patients]
+
+    assignments = scheduler.schedule_batch(
+        [
+            (
+                order,
+                int(order_procedures[order['procedure']]['duration']),
+                [station for station in aets if station.startswith(order_procedures[order['procedure']]['modality'])]
+            )
+            for order in orders
+        ],
+        client
+    )
+    operations = list()
+    booked = list()
+    for order, assignment in zip(orders, assignments):
+        if assignment is None:
+            continue
+        station, slot = assignment
+        update = {
+            "status": "SCHEDULED",
+            "station_aet": station,
+            "examination_date": {
+                "date": slot.date.strftime("%Y-%m-%d"),
+                "start_time": slot.start_t.strftime("%H:%M"),
+                "end_time": slot.end_t.strftime("%H:%M"),
+            },
+            "examination_start": slot.start_t,
+            "examination_end": slot.end_t,
+        }
+        reserved = reservations.reserve(client, order['_id'], station, order['patient_id'], update["examination_date"]["date"], update["examination_date"]["start_time"], update["examination_date"]["end_time"])
+        if reserved is None:
+            occupancy.update_order(order)    # Booked by another worker in the meantime
+            continue
+        # Only written if the order was not moved in the examination flow meanwhile
+        operations.append(UpdateOne({'_id': order['_id'], 'status': {'$in': order_states.SCHEDULABLE}}, {'$set': update}))
+        booked.append((order, update, reserved))
+
+    # Persisted before telling the HIS, only the orders actually written are sent
+    not_written = set()
+    if operations:
+        try:
+            result = client.bulk_write('orders', operations)
+            if result.matched_count < len(operations):
+                # Orders that left the schedulable statuses meanwhile : the ones not holding their new slot
+                current = client.get_documents('orders', {'_id': {'$in': [order['_id'] for order, _, _ in booked]}}, projection={'station_aet': 1, 'examination_start': 1})
+                slots = {order['_id']: (order.get('station_aet'), order.get('examination_start')) for order in current}
+                for i, (order, update, _) in enumerate(booked):
+                    if slots.get(order['_id']) != (update['station_aet'], update['examination_start']):
+                        not_written.add(i)
+        except BulkWriteError as e:
+            not_written = {error["index"] for error in e.details["writeErrors"]}
+        except PyMongoError as e:
+            app_logger.add_error_log(f"Bulk scheduling not written: {e}")
+            not_written = set(range(len(booked)))
+    written = list()
+    for i, (order, update, reserved) in enumerate(booked):
+        if i in not_written:
+            reservations.cancel(client, order['_id'], reserved)
+            occupancy.update_order(order)    # Release the slot given by the scheduler
+        else:
+            written.append((order, update, reserved))
+
+    scheduled = list()
+    reverts = list()
+    for order, update, reserved in written:
+        if send_hl7(construct_orm_o01({**order, **update}, order_procedures[order['procedure']], patients[order['patient_id']], generate_uuid(), datetime.datetime.now().strftime("%Y%m%d"), "SC", "SC")):
+            reservations.confirm(client, order['_id'], update["station_aet"], order['patient_id'], update["examination_date"]["date"], update["examination_date"]["start_time"], update["examination_date"]["end_time"])
+            scheduled.append({"order_id": order['_id'], "slot": f"{update['examination_date']['date']}|{update['examination_date']['start_time']}|{update['examination_date']['end_time']}|{update['station_aet']}"})
+        else:
+            # The previous slot of the order (and its reservations, kept until confirm) is restored
+            revert = {'$set': {field: order[field] for field in update if field in order}, '$unset': {field: "" for field in update if field not in order}}
+            reverts.append(UpdateOne({'_id': order['_id']}, {operator: fields for operator, fields in revert.items() if fields}))
+            reservations.cancel(client, order['_id'], reserved)
+            occupancy.update_order(order)
+            app_logger.add_error_log(f"HIS failed to get the scheduling of order {order['_id']}")
+    if reverts:
+        client.bulk_write('orders', reverts)
+    scheduled_ids = {elem["order_id"] for elem in scheduled}
+    failed = [order_id for order_id in data["order_ids"] if order_id not in scheduled_ids and order_id not in skipped]
+    app_logger.add_info_log(f"{len(scheduled)} orders scheduled in bulk, {len(skipped)} skipped (already in the examination flow), {len(failed)} failed")
+    return jsonify({"scheduled": scheduled, "skipped": skipped, "failed": failed})
+
+
 @app.route("/get_available_slots/<order_id>", methods=['GET'])
 def get_available_slots(order_id):
     order = client.get_document('orders', {'_id': order_id})
-    procedure = client.get_document('procedures', {'name': order["procedure"]})
-    slots = scheduler.get_possible_schedules(procedure["duration"], order["patient_id"], [station for station in modalities if station.startswith(procedure["modality"])], client)
-    res = list()
-    for slot in slots:
-        slot_id = slot[1].date.strftime("%Y-%m-%d") + "|" + slot[1].start_t.strftime("%H:%M") + "|" + \
-                  slot[1].end_t.strftime("%H:%M") + "|" + slot[0]
-        slot_display = slot[1].date.strftime("%Y-%m-%d") + " " + slot[1].start_t.strftime(
-            "%H:%M") + " - " + slot[1].end_t.strftime("%H:%M")
-        res.append(
-            {
-                "id": slot_id,
-                "elem": slot_display
-            }
-        )
-    return res
+    procedure = procedures.by_name(client, order['procedure'])
+    return search_slots(int(procedure["duration"]), order["patient_id"], procedure["modality"])
 
 
 @app.route("/register_new_order/<patient_id>", methods=['GET', 'POST'])
 def register_new_order(patient_id):
     order_form = Order()
-    patient = client.get_document('patients', {'_id': patient_id})
-    order_form.procedure.choices = [(procedure['_id'], procedure['name']) for procedure in client.get_documents('procedures', {'modality': order_form.imaging_modality.choices[0][1]})]
+    order_form.imaging_modality.choices = modality_choices()
+    if not order_form.imaging_modality.choices:
+        flash("No modality available, Orthanc cannot be reached", "error")
+        return flask.redirect("/")
+    patient = patient_cache.get(client, patient_id)
+    order_form.procedure.choices = [(procedure['_id'], procedure['name']) for procedure in procedures.by_modality(client, order_form.imaging_modality.choices[0][1])]
     date = datetime.datetime.now().strftime("%Y%m%d")
     if request.method == 'POST' and order_form.validate():
-        procedure = client.get_document('procedures', {'_id': order_form.procedure.data})
+        procedure = procedures.by_id(client, order_form.procedure.data)
         modality = order_form.imaging_modality.data
         parsed_date = order_form.slots.data.split("|")
         examination_date = {
@@ -329,15 +657,23 @@ def register_new_order(patient_id):
             "procedure": procedure['name'],
             "note": order_form.add_note.data,
             "examination_date": examination_date,
+            **utils.examination_datetimes(examination_date),
             "status": "SCHEDULED",
             "is_active": True,
         }
+        reserved = reservations.reserve(client, new_order["_id"], parsed_date[3], patient["_id"], examination_date["date"], examination_date["start_time"], examination_date["end_time"])
+        if reserved is None:
+            flash("The slot has just been booked, choose another one!", "error")
+            app_logger.add_error_log(f"Slot {order_form.slots.data} already booked, order {new_order['_id']} not registered")
+            return flask.redirect("/register_new_order/"+str(patient_id))
         if send_hl7(construct_orm_o01(new_order, procedure, patient, generate_uuid(), datetime.datetime.now().strftime("%Y%m%d"), "NW", "")):
             client.add_document('orders', new_order)
+            occupancy.update_order(new_order)
             flash("New order registered!", "toast")
             app_logger.add_info_log(f"New order {new_order['_id']} registered!")
             return flask.redirect("/")
         else:
+            reservations.cancel(client, new_order["_id"], reserved)
             flash("Failed to register the newest order!", "error")
             app_logger.add_error_log(f"Failed to register order {new_order['_id']}")
             return flask.redirect("/register_new_order/"+str(patient_id))
@@ -345,8 +681,7 @@ def register_new_order(patient_id):
         return flask.render_template("create_order.html", form=order_form, id=patient_id, p_name=patient["name"], p_surname=patient["surname"], flash_msg=flask.get_flashed_messages(with_categories=True))
     else:
         order_form.procedure.choices = [(procedure['_id'], procedure['name']) for procedure in
-                                  client.get_documents('procedures', {
-                                      'modality': order_form.imaging_modality.data.split('_')[0]})]
+                                  procedures.by_modality(client, order_form.imaging_modality.data.split('_')[0])]
         flash("Error in Form", "error")
         return flask.redirect("/register_new_order/"+str(patient_id))
 
@@ -354,47 +689,48 @@ def register_new_order(patient_id):
 def workflow(filter):
     messages = flask.get_flashed_messages(with_categories=True)
     current_date = datetime.datetime.today().date()
-    if filter == "today":
-        page_name = "today"
-        orders = client.get_documents('orders', {'examination_date.date': str(current_date), 'is_active': True})
-    elif filter == "all":
-        page_name = "all"
-        orders = client.get_documents('orders', {'is_active': True})
-    else:
-        page_name = "reporting"
-        orders = client.get_documents('orders', {'is_active': True, 'status': 'FINISHED'})
-    for order in orders:
-        patient = client.get_document('patients', {'_id': order['patient_id']})
-        order['patient_name'] = patient['name']
-        order['patient_surname'] = patient['surname']
-    return flask.render_template("workflow.html", orders=orders, curr_date=str(current_date), page_name=f"workflow-{page_name}", flash_msg=messages)
+    page_name = filter if filter in ("today", "all") else "reporting"
+    orders, next_cursor = read_page(workflow_list, workflow_query(filter))
+    attach_patients(client, orders, patient_cache=patient_cache)
+    return flask.render_template("workflow.html", orders=orders, next_cursor=next_cursor, args=link_args(filter=filter), curr_date=str(current_date), page_name=f"workflow-{page_name}", flash_msg=messages)
+
+
+@app.route("/get_workflow/<filter>")
+def get_workflow_page(filter):
+    orders, next_cursor = read_page(workflow_list, workflow_query(filter))
+    attach_patients(client, orders, patient_cache=patient_cache)
+    return jsonify({"orders": orders, "next": next_cursor})
 
 
 @app.route("/search-reports", methods=["GET", "POST"])
 def report():
     searching_form = SearchSpecificReport()
     if request.method == "POST" and searching_form.validate():
-        if searching_form.observation.data:
-            reports = client.get_documents('reports', {
-                "labels." + str(searching_form.section_find.data): {
-                    "$elemMatch": {
-                        "observation": searching_form.observation.data.lower(),
-                        "tags": searching_form.select_presence.data
-                    }
-                }
-            })
+        section, observation, presence = searching_form.section_find.data, searching_form.observation.data, searching_form.select_presence.data
+    elif request.method == "POST":
+        section, observation, presence = "", "", ""
+    else:
+        # Next pages of a search are requested with the search in the URL
+        section, observation, presence = request.args.get("section", ""), request.args.get("observation", ""), request.args.get("presence", "")
+    searching_form.observation.data = observation
+    if observation:
+        searching_form.section_find.data = section
+        searching_form.select_presence.data = presence
+    reports, next_cursor = read_page(reports_list, reports_query(section, observation, presence))
+    args = link_args(section=section, observation=observation, presence=presence) if observation else link_args()
+    return flask.render_template("reports.html", reports=reports, next_cursor=next_cursor, args=args, search_form=searching_form)
 
-            return flask.render_template("reports.html", reports=reports, search_form=searching_form)
-    reports = client.get_documents('reports', {})
-    searching_form.observation.data = ""
-    return flask.render_template("reports.html", reports=reports, search_form=searching_form)
+
+@app.route("/get_reports")
+def get_reports_page():
+    reports, next_cursor = read_page(reports_list, reports_query(request.args.get("section", ""), request.args.get("observation", ""), request.args.get("presence", "")))
+    return jsonify({"reports": reports, "next": next_cursor})
 
 
 @app.route("/create-report/<id>", methods=["GET", "POST"])
 def create_report(id):
     order = client.get_document('orders', {'_id': id})
-    patient = client.get_document('patients', {'_id': order['patient_id']})
-    procedure = client.get_document('procedures', {'name': order['procedure']})
+    patient = patient_cache.get(client, order['patient_id'])
     info = {
         'patient': patient,
         'order' : order
@@ -402,36 +738,29 @@ def create_report(id):
     form = NewReport()
 
     if request.method == 'POST' and form.validate():
-        processed_impressions = ner_model.process_data(form.impressions.data)
-        processed_findings = ner_model.process_data(form.findings.data)
-        label = dict()
-        label['findings'] = list()
-        label['impressions'] = list()
-        for item in processed_impressions[0]:
-            label['impressions'].append(item)
-        for item in processed_findings[0]:
-            label['findings'].append(item)
-        client.add_document('reports', {
+        if order_states.close(client, order['_id']) is None:
+            # Submitted twice or by two radiologists, only the first report is kept
+            flash(f"Order {order['_id']} is already reported", "error")
+            return flask.redirect("/")
+        report = {
             '_id': utils.generate_uuid(),
             'order_id': order['_id'],
             'patient_id': patient['_id'],
-            'labels': label,
-            'impressions-text': processed_impressions[1]['radgraph_text'],
-            'findings-text': processed_findings[1]['radgraph_text'],
-            'impressions-annotations': processed_impressions[1]['radgraph_annotations'],
-            'findings-annotations': processed_findings[1]['radgraph_annotations'],
+            'impressions-text': form.impressions.data,
+            'findings-text': form.findings.data,
             'recommendations': form.recommendations.data,
             'date': datetime.datetime.today().date().strftime("%Y-%m-%d"),
             'time': datetime.datetime.now().strftime("%H:%M"),
             'radiologist': {
                 'name': form.name.data.upper(),
                 'surname': form.surname.data.upper(),
-            }
-        })
-        client.update_document('orders', order['_id'], {'is_active': False})
-        report = client.get_document('reports', {'order_id': order['_id']})
-        _ = send_hl7(construct_oru_r01(report, procedure, order, patient, generate_uuid(), datetime.datetime.today().date().strftime("%Y%m%d")))
-        flash(f"Report Created for {order['_id']}", 'toast')
+            },
+            # The labels and annotations are added by the labeling threads, which then send the ORU^R01 (send_report)
+            'labels_status': labeling.PENDING
+        }
+        client.add_document('reports', report)
+        labeling_queue.notify()
+        flash(f"Report Created for {order['_id']}, labeling in progress", 'toast')
         return flask.redirect("/")
     elif request.method == 'GET':
         return flask.render_template("report.html", info=info, form=form, flash_msg=flask.get_flashed_messages(with_categories=True))
@@ -442,26 +771,27 @@ def create_report(id):
 
 @app.route("/view-report/<patient_id>/<order_id>")
 def view_report(patient_id, order_id):
-    report = client.get_document('reports', {"patient_id": patient_id, "order_id": order_id})
-    patient = client.get_document('patients', {"_id": patient_id})
-    order = client.get_document('orders', {"_id": order_id})
+    report = archive.get_report(client, {"patient_id": patient_id, "order_id": order_id})
+    patient = patient_cache.get(client, patient_id)
+    order = archive.get_order(client, order_id)
     return flask.render_template("report_viewer.html", info={"patient": patient, "order": order, "report": report}, flash_msg=flask.get_flashed_messages(with_categories=True))
 
 
 @app.route("/get_procedures/<modality>")
 def get_procedures(modality):
     modality_name = modality.split('_')[0]
-    procedures = client.get_documents("procedures", {"modality": modality_name})
-    return jsonify([{"_id": option['_id'], 'name': option['name']} for option in procedures])
+    return jsonify([{"_id": option['_id'], 'name': option['name']} for option in procedures.by_modality(client, modality_name)])
 
 
 @app.route("/remove_order/<order_id>")
 def remove_order(order_id):
     old_order = client.get_document('orders', {'_id': order_id})
-    procedure = client.get_document('procedures', {'name': old_order['procedure']})
-    patient = client.get_document('patients', {'_id': old_order['patient_id']})
+    procedure = procedures.by_name(client, old_order['procedure'])
+    patient = patient_cache.get(client, old_order['patient_id'])
     deleted_order = client.delete_document("orders", order_id)    # Return a DeleteResult (status + elem deleted)
     if deleted_order.acknowledged and deleted_order.raw_result['n']:
+        occupancy.remove_order(order_id)
+        reservations.release(client, order_id)
         stat = send_hl7(construct_orm_o01(old_order, procedure, patient, generate_uuid(), datetime.datetime.today().date().strftime("%Y%m%d"), "OC", "CA"))
         if stat:
             app_logger.add_info_log(f"Message successfully sent to HIS")
@@ -479,34 +809,47 @@ def create_worklist(order_id):
     # Accession Number is simply entire date + time + 2 first ms numbers
     accession_number = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + datetime.datetime.now().strftime("%f")[:2]
     order = client.get_document("orders", {'_id': order_id})
-    patient = client.get_document("patients", {'_id': order["patient_id"]})
-    procedure = client.get_document("procedures", {'name': order['procedure']})
+    patient = patient_cache.get(client, order["patient_id"])
+    procedure = procedures.by_name(client, order['procedure'])
     study_uid = generate_uid()
+    worklist = {"study_instance_uid": study_uid, "accession_number": accession_number}
+    # The order is claimed before sending the worklist : a double submit creates a single worklist in Orthanc
+    outcome, claimed = order_states.transition(client, {'_id': order_id}, "GENERATED", worklist)
+    if outcome != order_states.APPLIED:
+        app_logger.add_error_log(f"Worklist {accession_number} not created, order {order_id} {outcome}")
+        flash(f"Worklist of order {order_id} was already created", "error")
+        return flask.redirect("/workflow/today")
     omi_msg = construct_omi_023(patient, procedure, order, str(generate_uuid()), accession_number, datetime.datetime.now().strftime("%Y%m%d"), study_uid)
     if send_hl7(omi_msg):
-        client.update_document(
-            'orders',
-            order_id,
-            {
-                "status": "GENERATED",
-                "study_instance_uid": study_uid,
-                "accession_number": accession_number,
-            }
-        )
         app_logger.add_info_log(f"Worklist with accession number {accession_number} created")
         flash(f"Worklist {accession_number} created", "toast")
     else:
+        order_states.undo(client, claimed, "SCHEDULED", worklist)
         app_logger.add_error_log(f"Error when creating sending order {order_id} to create worklist")
         flash(f"Error when creating worklist {accession_number}", "error")
     return flask.redirect("/workflow/today")
 
 
+def transition_response(outcome: str) -> flask.Response:
+    """
+    Returns the response of an Orthanc callback : 200 when the transition is applied or was already applied (retry),
+    404 for an unknown accession number and 409 when the order cannot reach the status
+    """
+    if outcome in (order_states.APPLIED, order_states.ALREADY_DONE):
+        return flask.Response(status=200)
+    elif outcome == order_states.NOT_FOUND:
+        return flask.Response(status=404)
+    app_logger.add_error_log("Study callback refused, order in an incompatible status")
+    return flask.Response(status=409)
+
+
 @app.route("/new_study", methods=["POST"])
 def new_study():
     data = request.get_json()
-    order_to_update = client.get_document("orders", {"accession_number": data["accession-number"]})
-    client.update_document("orders", order_to_update['_id'], {"status": "IN PROGRESS", "executive-start-time": data["creation-time"]})
-    return flask.Response(status=200)
+    if not data:
+        return flask.Response(status=400)
+    outcome, _ = order_states.transition(client, {"accession_number": data["accession-number"]}, "IN PROGRESS", {"executive-start-time": data["creation-time"]})
+    return transition_response(outcome)
 
 
 @app.route("/stable_study", methods=["POST"])
@@ -515,31 +858,41 @@ def stable_study():
     if not data:
         return flask.Response(status=400)
     else:
-        order_to_update = client.get_document("orders", {"accession_number": data["accession-number"]})
-        procedure = client.get_document("procedures", {"name": order_to_update["procedure"]})
-        patient = client.get_document("patients", {"_id": order_to_update["patient_id"]})
-        client.update_document("orders", order_to_update['_id'], {
-            "status": "FINISHED",
+        outcome, order_to_update = order_states.transition(client, {"accession_number": data["accession-number"]}, "FINISHED", {
             "orthanc_study_id": data["ID"],
             "orthanc_series_id": data["Series"],
             "executive-end-time": data["creation-time"],
         })
-        _ = send_hl7(construct_orm_o01(order_to_update, procedure, patient, generate_uuid(), datetime.datetime.today().date().strftime("%Y%m%d"), "SC", "CM"))
-        return flask.Response(status=200)
+        if outcome == order_states.APPLIED:
+            # Side effects only once, even if Orthanc sends the callback again
+            occupancy.remove_order(order_to_update['_id'])    # A finished order does not occupy its station anymore
+            reservations.release(client, order_to_update['_id'])
+            procedure = procedures.by_name(client, order_to_update['procedure'])
+            patient = patient_cache.get(client, order_to_update["patient_id"])
+            _ = send_hl7(construct_orm_o01(order_to_update, procedure, patient, generate_uuid(), datetime.datetime.today().date().strftime("%Y%m%d"), "SC", "CM"))
+        return transition_response(outcome)
+
+@app.route('/get_cache_stats')
+def get_cache_stats():
+    return jsonify({"patients": patient_cache.stats(), "ner_annotations": annotation_cache.stats()})
+
+
+@app.route('/get_labeling_stats')
+def get_labeling_stats():
+    return jsonify(labeling_queue.stats(client))
+
 
 @app.route('/get_order_info/<order_id>')
 def get_order_info(order_id):
     order = client.get_document('orders', {'_id': order_id})
-    patient = client.get_document('patients', {'_id': order['patient_id']})
-    order['patient_name'] = patient['name']
-    order['patient_surname'] = patient['surname']
-    order['patient_dob'] = patient['dob']
+    attach_patients(client, [order], ("name", "surname", "dob"), patient_cache)
     return jsonify(order)
 
 
 @app.route('/new_procedure', methods=['GET', 'POST'])
 def new_procedure():
     procedure_form = NewProcedureForm()
+    procedure_form.procedure_modality.choices = modality_choices()
     if request.method == 'POST' and procedure_form.validate():
         new_proc = {
             '_id': procedure_form.procedure_id.data,
@@ -550,6 +903,7 @@ def new_procedure():
         # Check if the procedure is already in the system
         try:
             client.add_document("procedures", new_proc)
+            procedures.invalidate()
             flash("New procedure added", "toast")
             return flask.redirect("/")
         except WriteError:
@@ -571,4 +925,4 @@ def view_series(serie_id):
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -1,13 +1,27 @@
 """
-This file contains a toolbox to use MongoDB system.
+This file contains a toolbox to use MongoDB system. The connection (pool, timeouts, write concern) is configured in
+config.py. Large volumes should be read with iter_documents (documents streamed by batches) and written with
+add_documents/bulk_write (one round trip per batch) rather than one document at a time.
+The clients of the application are created with create_client, which returns the backend selected by
+config.MONGO_BACKEND (MongoDB or the in-memory backend of memory_backend).
 """
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+import src.config as config
 
 
 class MongoDBClient:
 
-    def __init__(self, url="mongodb://127.17.0.2:27017"):
-        self.client = MongoClient(host=[url])["app"]
+    def __init__(self, url=config.MONGO_URL, db_name=config.MONGO_DB):
+        self.client = MongoClient(
+            host=[url],
+            maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+            minPoolSize=config.MONGO_MIN_POOL_SIZE,
+            connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+            serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            socketTimeoutMS=config.MONGO_SOCKET_TIMEOUT_MS,
+            w=config.MONGO_WRITE_CONCERN,
+            journal=config.MONGO_JOURNAL
+        )[db_name]
 
     def list_databases(self):
         return self.client.list_database_names()
@@ -21,18 +35,72 @@ class MongoDBClient:
     def add_document(self, name, elem):
         return self.client[name].insert_one(elem)
 
+    def add_documents(self, name, elems, ordered=True):
+        return self.client[name].insert_many(elems, ordered=ordered)
+
     def delete_document(self, name, id):
         return self.client[name].delete_one({"_id": id})
 
+    def delete_documents(self, name, req):
+        return self.client[name].delete_many(req)
+
     def get_document(self, name, req):
         return self.client[name].find_one(req)
 
-    def get_documents(self, name, req):
-        return self.client[name].find(req).to_list()
+    def get_documents(self, name, req, projection=None, sort=None, limit=0):
+        # sort is a list of (field, direction), limit=0 means no limit
+        return self.client[name].find(req, projection, sort=sort, limit=limit).to_list()
+
+    def count_documents(self, name, req):
+        # Counted by MongoDB, the documents are not sent
+        return self.client[name].count_documents(req)
+
+    def iter_documents(self, name, req, projection=None, sort=None, limit=0, batch_size=config.MONGO_BATCH_SIZE):
+        # Cursor streaming the documents by batches of batch_size, only one batch is held in memory
+        return self.client[name].find(req, projection, sort=sort, limit=limit, batch_size=batch_size)
+
+    def bulk_write(self, name, operations, ordered=False):
+        # operations is a list of pymongo operations (InsertOne, UpdateOne, DeleteOne, ...) sent in one round trip
+        return self.client[name].bulk_write(operations, ordered=ordered)
 
     def update_document(self, name, id, updated):
         updated = {"$set": updated}
         return self.client[name].update_one({"_id": id}, updated)
 
+    def find_and_update(self, name, req, updated, projection=None):
+        # Atomic update of the first document matching req, returns the updated document (None if nothing matches)
+        return self.client[name].find_one_and_update(req, {"$set": updated}, projection=projection, return_document=ReturnDocument.AFTER)
+
+    def update_documents(self, name, req, updated):
+        updated = {"$set": updated}
+        return self.client[name].update_many(req, updated)
+
     def list_documents(self, name):
         return self.client[name].find()
+
+    def explain(self, name, req, sort=None):
+        # Execution plan (winning plan and statistics) of a find
+        command = {"find": name, "filter": req}
+        if sort:
+            command["sort"] = dict(sort)
+        return self.client.command("explain", command, verbosity="executionStats")
+
+    def watch(self, name, pipeline=None):
+        # Change stream of a collection (needs a replica set), iterate it to receive the changes
+        return self.client[name].watch(pipeline)
+
+    def create_index(self, name, keys, **kwargs):
+        # Idempotent : MongoDB does nothing if the same index already exists
+        return self.client[name].create_index(keys, **kwargs)
+
+
+def create_client(url=config.MONGO_URL, db_name=config.MONGO_DB, backend=config.MONGO_BACKEND) -> MongoDBClient:
+    """
+    Returns a client of the storage @backend ("mongodb" or "memory")
+    """
+    if backend == "memory":
+        from src.utils.memory_backend import MemoryDBClient
+        return MemoryDBClient(url, db_name)
+    if backend != "mongodb":
+        raise ValueError(f"Unknown storage backend {backend}")
+    return MongoDBClient(url, db_name)
@@ -0,0 +1,110 @@
+"""
+This file contains the archival of the completed orders and of their reports. The live collections (orders, reports) only
+keep the worklist and the recent history, so that their indexes and the documents used every day stay in RAM :
+    - The inactive orders examined more than @after_days days ago are moved to orders_history
+    - Their reports are moved to reports_history, the heavy fields (texts and RadGraph annotations) are compressed
+    - The history is written before the live documents are removed, an interrupted archival can simply be run again
+The reads of a patient's past orders and of a report fall back to the history (see joins and get_report).
+Run it periodically with :
+    python -m src.utils.archive [--days 90]
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo import ReplaceOne
+from bson import Binary
+import bson
+import datetime
+import zlib
+
+ORDERS_HISTORY = "orders_history"
+REPORTS_HISTORY = "reports_history"
+# Fields of a report compressed in the history
+COMPRESSED_FIELDS = ["impressions-text", "findings-text", "impressions-annotations", "findings-annotations"]
+
+
+def compress_report(report: dict) -> dict:
+    """
+    Returns the report to store in the history, the heavy fields being replaced by a compressed BSON document
+    """
+    heavy = {field: report[field] for field in COMPRESSED_FIELDS if field in report}
+    archived = {key: value for key, value in report.items() if key not in heavy}
+    archived["compressed"] = Binary(zlib.compress(bson.encode(heavy)))
+    return archived
+
+
+def decompress_report(report: dict | None) -> dict | None:
+    """
+    Returns a report of the history as it was stored in the live collection
+    """
+    if report is None or "compressed" not in report:
+        return report
+    restored = {key: value for key, value in report.items() if key != "compressed"}
+    restored.update(bson.decode(zlib.decompress(report["compressed"])))
+    return restored
+
+
+def get_report(m_client: MongoDBClient, query: dict) -> dict | None:
+    """
+    Returns the report matching @query, from the live reports or from the history
+    """
+    report = m_client.get_document("reports", query)
+    if report is None:
+        report = decompress_report(m_client.get_document(REPORTS_HISTORY, query))
+    return report
+
+
+def get_order(m_client: MongoDBClient, order_id: str) -> dict | None:
+    """
+    Returns the order with @order_id, from the live orders or from the history
+    """
+    order = m_client.get_document("orders", {"_id": order_id})
+    if order is None:
+        order = m_client.get_document(ORDERS_HISTORY, {"_id": order_id})
+    return order
+
+
+def archive(m_client: MongoDBClient, after_days: int = 90, batch_size: int = 500) -> tuple[int, int]:
+    """
+    Function that moves the completed orders (and their reports) examined more than @after_days days ago to the history.
+        @pre m_client: MongoDB client object
+        @pre after_days: the number of days an inactive order stays in the live collection
+        @pre batch_size: the number of orders moved per bulk write
+    returns the number of orders and reports archived
+    """
+    cutoff = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=after_days), datetime.time())
+    n_orders, n_reports = 0, 0
+    batch = list()
+
+    def move(orders):
+        order_ids = [order["_id"] for order in orders]
+        reports = m_client.get_documents("reports", {"order_id": {"$in": order_ids}})
+        # Replace (upsert) instead of insert : the documents of an interrupted archival may already be in the history
+        m_client.bulk_write(ORDERS_HISTORY, [ReplaceOne({"_id": order["_id"]}, order, upsert=True) for order in orders])
+        if reports:
+            m_client.bulk_write(REPORTS_HISTORY, [ReplaceOne({"_id": report["_id"]}, compress_report(report), upsert=True) for report in reports])
+            m_client.delete_documents("reports", {"_id": {"$in": [report["_id"] for report in reports]}})
+        m_client.delete_documents("orders", {"_id": {"$in": order_ids}})
+        return len(orders), len(reports)
+
+    # Deleting the orders already returned by the cursor does not affect the rest of the iteration
+    for order in m_client.iter_documents("orders", {"is_active": False, "examination_start": {"$lt": cutoff}}, batch_size=batch_size):
+        batch.append(order)
+        if len(batch) >= batch_size:
+            moved = move(batch)
+            n_orders, n_reports = n_orders + moved[0], n_reports + moved[1]
+            batch = list()
+    if batch:
+        moved = move(batch)
+        n_orders, n_reports = n_orders + moved[0], n_reports + moved[1]
+    return n_orders, n_reports
+
+
+if __name__ == "__main__":
+    import argparse
+    import src.config as config
+
+    parser = argparse.ArgumentParser(description="Move the completed orders and their reports to the history collections")
+    parser.add_argument("--days", type=int, default=config.ARCHIVE_AFTER_DAYS, help="number of days an inactive order stays in the live collection")
+    args = parser.parse_args()
+
+    archived_orders, archived_reports = archive(MongoDBClient(), args.days)
+    print(f"{archived_orders} orders and {archived_reports} reports archived")
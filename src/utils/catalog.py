@@ -0,0 +1,135 @@
+"""
+This file contains an in-process cache of the procedure catalog. The procedures are read by almost every route but only
+change a few times a year (new_procedure), so the whole catalog is kept in memory, indexed by id, name and modality :
+    - The catalog is loaded from MongoDB with a single query at the first request and reloaded after a TTL, so that a
+      procedure added through another worker is seen by all the workers
+    - The worker adding a procedure invalidates its catalog right away
+    - If MongoDB runs as a replica set, a change stream on the procedures invalidates the catalog of every worker as soon
+      as the collection changes (see watch), the stream is reopened after an error (network, step down of the primary)
+The procedures returned are shared by all the requests and must not be modified.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo.errors import OperationFailure, PyMongoError
+from typing import Any, Callable
+import threading
+import time
+
+COLLECTION = "procedures"
+# Error code of a change stream opened on a standalone server
+NOT_REPLICA_SET = 40573
+# Maximum number of seconds between two attempts to reopen the change stream
+WATCH_MAX_BACKOFF = 60
+
+
+class ProcedureCatalog:
+
+    def __init__(self, ttl: int = 300):
+        """
+        Constructor for ProcedureCatalog instance.
+        @pre ttl: the number of seconds after which the catalog is reloaded from MongoDB
+        """
+        self.ttl = ttl
+        self.__lock = threading.RLock()
+        self.__loaded_at = None
+        self.__by_id = dict()    # {_id: procedure}
+        self.__by_name = dict()    # {name: procedure}
+        self.__by_modality = dict()    # {modality: [procedures]}
+        self.watching = False    # True while the change stream is open, the TTL is used alone otherwise
+
+    def is_stale(self) -> bool:
+        return self.__loaded_at is None or time.monotonic() - self.__loaded_at > self.ttl
+
+    def load(self, m_client: MongoDBClient):
+        """
+        Function that (re)builds the catalog with all the procedures.
+            @pre m_client: MongoDB client object
+        """
+        procedures = m_client.get_documents(COLLECTION, {})
+        by_modality = dict()
+        for procedure in procedures:
+            by_modality.setdefault(procedure.get("modality"), list()).append(procedure)
+        with self.__lock:
+            self.__by_id = {procedure["_id"]: procedure for procedure in procedures}
+            self.__by_name = {procedure["name"]: procedure for procedure in procedures}
+            self.__by_modality = by_modality
+            self.__loaded_at = time.monotonic()
+
+    def ensure_fresh(self, m_client: MongoDBClient):
+        if self.is_stale():
+            self.load(m_client)
+
+    def invalidate(self):
+        """
+        Function to call each time the catalog changes, the next request reloads it
+        """
+        with self.__lock:
+            self.__loaded_at = None
+
+    def by_id(self, m_client: MongoDBClient, procedure_id: str) -> dict[str, Any] | None:
+        self.ensure_fresh(m_client)
+        with self.__lock:
+            return self.__by_id.get(procedure_id)
+
+    def by_name(self, m_client: MongoDBClient, name: str) -> dict[str, Any] | None:
+        self.ensure_fresh(m_client)
+        with self.__lock:
+            return self.__by_name.get(name)
+
+    def by_names(self, m_client: MongoDBClient, names) -> dict[str, dict[str, Any]]:
+        """
+        Returns {name: procedure} for the known procedures among @names
+        """
+        self.ensure_fresh(m_client)
+        with self.__lock:
+            return {name: self.__by_name[name] for name in names if name in self.__by_name}
+
+    def by_modality(self, m_client: MongoDBClient, modality: str) -> list[dict[str, Any]]:
+        self.ensure_fresh(m_client)
+        with self.__lock:
+            return list(self.__by_modality.get(modality, list()))
+
+    def modalities(self, m_client: MongoDBClient) -> list[str]:
+        self.ensure_fresh(m_client)
+        with self.__lock:
+            return sorted(modality for modality in self.__by_modality if modality)
+
+    def watch(self, m_client: MongoDBClient, log: Callable[[str], None] | None = None) -> threading.Thread:
+        """
+        Function that starts a daemon thread invalidating the catalog at each change of the procedures (change stream).
+        The stream is reopened with an exponential backoff after an error, the catalog being invalidated for the changes
+        missed meanwhile. Change streams need a replica set, on a standalone server the thread stops and the TTL is used
+        alone.
+            @pre m_client: MongoDB client object
+            @pre log: function logging the errors of the change stream
+        returns the started thread
+        """
+        log = log or (lambda message: None)
+
+        def run():
+            backoff = 1
+            while True:
+                try:
+                    with m_client.watch(COLLECTION) as stream:
+                        self.watching = True
+                        backoff = 1
+                        self.invalidate()    # Changes made while the stream was closed
+                        for _ in stream:
+                            self.invalidate()
+                    error = "change stream closed"
+                except OperationFailure as e:
+                    if e.code == NOT_REPLICA_SET:
+                        self.watching = False
+                        log(f"Procedures change stream unavailable (standalone MongoDB), catalog reloaded every {self.ttl}s")
+                        return
+                    error = str(e)
+                except PyMongoError as e:
+                    error = str(e)
+                self.watching = False
+                self.invalidate()
+                log(f"Procedures change stream failed ({error}), reopened in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(2 * backoff, WATCH_MAX_BACKOFF)
+
+        thread = threading.Thread(target=run, name="procedures-watch", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,95 @@
+"""
+This file contains the lazy initialization of the slow dependencies of the application (the RadGraph NER model, the
+stations connected to Orthanc, the creation of the indexes). Instead of being built when server.py is imported, which
+blocks the start of each worker for the whole loading time, a dependency is :
+    - loaded in a background thread, started with the services of the server (start_services) or by the first request
+      using it
+    - waited for only by the requests using it (get), with a timeout, the other routes are served right away
+    - loaded again at the next request if the loading failed (Orthanc down at the start, ...)
+The state of each dependency is reported by the readiness endpoint of the server (/ready).
+"""
+from typing import Any, Callable
+import threading
+import time
+
+
+class DependencyUnavailable(Exception):
+    """
+    Raised when a dependency is still loading after the timeout of a request, or failed to load
+    """
+
+
+class Dependency:
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        """
+        Constructor for Dependency instance.
+        @pre name: the name of the dependency (shown by the readiness endpoint)
+        @pre factory: the function building the dependency, called in a background thread
+        """
+        self.name = name
+        self.factory = factory
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__value = None
+        self.__ready = False
+        self.__error = None
+        self.__load_time = None
+
+    def __load(self):
+        started = time.monotonic()
+        try:
+            value = self.factory()
+        except Exception as e:
+            with self.__lock:
+                self.__error = e
+            return
+        with self.__lock:
+            self.__value = value
+            self.__ready = True
+            self.__load_time = time.monotonic() - started
+
+    def start(self) -> threading.Thread | None:
+        """
+        Function that starts loading the dependency in a background thread (nothing is done if it is already loaded
+        or loading).
+        returns the loading thread, None if the dependency is loaded
+        """
+        with self.__lock:
+            if self.__ready:
+                return None
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__error = None
+                self.__thread = threading.Thread(target=self.__load, name=f"{self.name}-init", daemon=True)
+                self.__thread.start()
+            return self.__thread
+
+    def is_ready(self) -> bool:
+        with self.__lock:
+            return self.__ready
+
+    def get(self, timeout: float | None = None) -> Any:
+        """
+        Returns the dependency, waiting at most @timeout seconds (None : no limit) if it is still loading. The loading
+        is started if needed (first use, previous loading failed).
+        raises DependencyUnavailable if the dependency is not loaded after @timeout seconds or failed to load
+        """
+        thread = self.start()
+        if thread is not None:
+            thread.join(timeout)
+        with self.__lock:
+            if self.__ready:
+                return self.__value
+            if self.__error is not None:
+                raise DependencyUnavailable(f"{self.name} failed to load: {self.__error}")
+        raise DependencyUnavailable(f"{self.name} is still loading")
+
+    def status(self) -> dict[str, Any]:
+        with self.__lock:
+            if self.__ready:
+                return {"state": "ready", "load_time": round(self.__load_time, 3)}
+            if self.__error is not None:
+                return {"state": "failed", "error": str(self.__error)}
+            if self.__thread is not None:
+                return {"state": "loading"}
+            return {"state": "not started"}
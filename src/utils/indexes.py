@@ -0,0 +1,197 @@
+"""
+This file contains the registry of all the indexes used by OpenRIS, applied at the start of the application so that a
+fresh deployment has the same indexes as a running one. Each index is declared with the queries it serves; creating an
+index that already exists does nothing, so the registry can be applied at each start.
+
+The queries issued by the application can be checked against the indexes with :
+    python -m src.utils.indexes [--profile]
+which runs explain() on each query of queries() (and on the queries recorded by the MongoDB profiler with --profile) and
+flags the collection scans and the in-memory sorts.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.occupancy import ACTIVE_STATUSES
+from typing import Any, NamedTuple
+import datetime
+
+
+class Index(NamedTuple):
+    collection: str
+    keys: tuple[tuple[str, int], ...]
+    options: dict[str, Any]
+
+
+INDEXES: list[Index] = list()
+
+
+def register(collection: str, keys: list[tuple[str, int]], **options):
+    """
+    Declare an index of @collection on @keys ([(field, direction)]), @options are given to create_index (unique,
+    expireAfterSeconds, ...). Declaring the same index twice has no effect.
+    """
+    index = Index(collection, tuple(keys), options)
+    if index not in INDEXES:
+        INDEXES.append(index)
+
+
+def apply_indexes(m_client: MongoDBClient) -> int:
+    """
+    Create all the registered indexes (the existing ones are left untouched).
+        @pre m_client: MongoDB client object
+    returns the number of indexes in the registry
+    """
+    for index in INDEXES:
+        m_client.create_index(index.collection, list(index.keys), **index.options)
+    return len(INDEXES)
+
+
+## orders ##
+# Booked orders of a range of days (occupancy cache, repacker, reservations backfill)
+register("orders", [("status", 1), ("examination_start", 1)])
+# Scheduler : one index per branch of the query (station or patient), ending with the range on the examination date
+register("orders", [("station_aet", 1), ("status", 1), ("examination_start", 1)])
+# Also used by the patient information page (orders of a patient)
+register("orders", [("patient_id", 1), ("status", 1), ("examination_start", 1)])
+# Orders updated by Orthanc (new study, stable study)
+register("orders", [("accession_number", 1)])
+# Workflow board, one index per sort of the list (see workflow_list in server)
+for field in ("examination_start", "procedure", "modality", "station_aet", "status"):
+    register("orders", [("is_active", 1), (field, 1), ("_id", 1)])
+
+## reports ##
+# Report of an order (create report, view report)
+register("reports", [("order_id", 1)])
+# Reports list
+register("reports", [("date", 1), ("_id", 1)])
+# Reports waiting for the labeling threads (see labeling)
+register("reports", [("labels_status", 1)])
+
+## history (see archive) ##
+# Past orders of a patient (patient information), report of an archived order (view report)
+register("orders_history", [("patient_id", 1)])
+register("reports_history", [("order_id", 1)])
+
+## procedures ##
+register("procedures", [("name", 1)])
+register("procedures", [("modality", 1)])
+
+## patients ##
+# Patients list, one index per sort of the list (see patients_list in server)
+for field in ("surname", "name", "sex", "dob"):
+    register("patients", [(field, 1), ("_id", 1)])
+# Prefix/phonetic search, followed by the default sort of the patients list (see patient_search)
+register("patients", [("search_prefixes", 1), ("surname", 1), ("_id", 1)])
+register("patients", [("search_phonetic", 1), ("surname", 1), ("_id", 1)])
+
+## reservations ##
+# Release of the reservations of an order, expiration one day after the examination day
+register("reservations", [("order_id", 1)])
+register("reservations", [("expires_at", 1)], expireAfterSeconds=0)
+
+
+def queries() -> list[tuple[str, str, dict[str, Any], list[tuple[str, int]] | None]]:
+    """
+    Returns the queries issued by the application, as (description, collection, filter, sort), with example values
+    """
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    week = {"$gte": today, "$lt": today + datetime.timedelta(days=8)}
+    return [
+        ("scheduler booked orders", "orders", {"$or": [{"station_aet": {"$in": ["CT_1", "CT_2"]}}, {"patient_id": "patient"}], "status": {"$in": ACTIVE_STATUSES}, "examination_start": week}, None),
+        ("occupancy cache load", "orders", {"status": {"$in": ACTIVE_STATUSES}, "examination_start": week}, None),
+        ("patient orders", "orders", {"patient_id": "patient"}, None),
+        ("order by accession number", "orders", {"accession_number": "accession"}, None),
+        ("workflow all", "orders", {"is_active": True}, [("examination_start", 1), ("_id", 1)]),
+        ("workflow today", "orders", {"is_active": True, "examination_start": {"$gte": today, "$lt": today + datetime.timedelta(days=1)}}, [("examination_start", 1), ("_id", 1)]),
+        ("workflow reporting", "orders", {"is_active": True, "status": "FINISHED"}, [("examination_start", 1), ("_id", 1)]),
+        ("patients list", "patients", {}, [("surname", 1), ("_id", 1)]),
+        ("patients search", "patients", {"$or": [{"search_prefixes": {"$all": ["S:DUP"]}}, {"search_phonetic": {"$all": ["S:D150"]}}]}, [("surname", 1), ("_id", 1)]),
+        ("reports list", "reports", {}, [("date", 1), ("_id", 1)]),
+        ("report of an order", "reports", {"patient_id": "patient", "order_id": "order"}, None),
+        ("pending labels", "reports", {"labels_status": "pending"}, None),
+        ("archived orders of a patient", "orders_history", {"patient_id": "patient"}, None),
+        ("archived report of an order", "reports_history", {"patient_id": "patient", "order_id": "order"}, None),
+        ("procedure by name", "procedures", {"name": "PROCEDURE"}, None),
+        ("procedures of a modality", "procedures", {"modality": "CT"}, None),
+        ("reservations of an order", "reservations", {"order_id": "order"}, None),
+    ]
+
+
+def profiled_queries(m_client: MongoDBClient, limit: int = 1000) -> list[tuple[str, str, dict[str, Any], list[tuple[str, int]] | None]]:
+    """
+    Returns the distinct find queries recorded by the MongoDB profiler (db.setProfilingLevel(...) must be enabled)
+    """
+    seen = set()
+    result = list()
+    for entry in m_client.get_documents("system.profile", {"op": "query", "command.find": {"$exists": True}}, sort=[("ts", -1)], limit=limit):
+        command = entry["command"]
+        sort = list(command.get("sort", dict()).items()) or None
+        shape = (command["find"], str(sorted(command.get("filter", dict()))), str(sort))
+        if command["find"].startswith("system.") or shape in seen:
+            continue
+        seen.add(shape)
+        result.append((f"profiled ({entry.get('millis', 0)} ms)", command["find"], command.get("filter", dict()), sort))
+    return result
+
+
+def plan_stages(plan: dict[str, Any]) -> list[str]:
+    """
+    Returns the stages of an explain() plan, from the root to the leaves
+    """
+    stages = [plan["stage"]] if "stage" in plan else list()
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", list()):
+        stages += plan_stages(child)
+    return stages
+
+
+def advise(m_client: MongoDBClient, checked_queries) -> list[dict[str, Any]]:
+    """
+    Function that runs explain() on each query and flags the ones not served by an index.
+        @pre m_client: MongoDB client object
+        @pre checked_queries: a list of (description, collection, filter, sort)
+    returns for each query its stages, the number of keys/documents examined and the issues found
+    """
+    report = list()
+    for description, collection, query, sort in checked_queries:
+        explained = m_client.explain(collection, query, sort=sort)
+        stages = plan_stages(explained["queryPlanner"]["winningPlan"])
+        stats = explained.get("executionStats", dict())
+        issues = list()
+        if "COLLSCAN" in stages:
+            issues.append("collection scan")
+        if "SORT" in stages:
+            issues.append("in-memory sort")
+        report.append({
+            "query": description,
+            "collection": collection,
+            "stages": stages,
+            "returned": stats.get("nReturned"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "issues": issues,
+        })
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import src.config as config
+
+    parser = argparse.ArgumentParser(description="Check that the queries of OpenRIS are served by the indexes")
+    parser.add_argument("--url", default=config.MONGO_URL)
+    parser.add_argument("--profile", action="store_true", help="also check the queries recorded by the MongoDB profiler")
+    parser.add_argument("--apply", action="store_true", help="create the registered indexes before checking")
+    args = parser.parse_args()
+
+    client = MongoDBClient(args.url)
+    if args.apply:
+        print(f"{apply_indexes(client)} indexes applied")
+    checked = queries() + (profiled_queries(client) if args.profile else list())
+    n_issues = 0
+    for line in advise(client, checked):
+        flag = "!!" if line["issues"] else "ok"
+        n_issues += bool(line["issues"])
+        print(f"[{flag}] {line['collection']:<12} {line['query']:<30} {' <- '.join(line['stages']):<40} "
+              f"keys={line['keys_examined']} docs={line['docs_examined']} returned={line['returned']} {', '.join(line['issues'])}")
+    print(f"{n_issues} queries not served by an index")
@@ -0,0 +1,61 @@
+"""
+This file contains the joins between the orders and the patients used by the routes. Instead of reading the patient of
+each order one by one (one round trip per order), the patients of a list of orders are read with a single $in query
+and attached to the orders.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.patient_cache import PatientCache
+from src.utils.archive import ORDERS_HISTORY
+from typing import Any
+
+# Fields of the patient attached to an order, as {patient field: order field}
+PATIENT_FIELDS = {"name": "patient_name", "surname": "patient_surname", "dob": "patient_dob"}
+
+
+def get_patients(m_client: MongoDBClient, patient_ids, fields=None, patient_cache: PatientCache | None = None) -> dict[str, dict[str, Any]]:
+    """
+    Function that reads several patients with a single query.
+        @pre m_client: MongoDB client object
+        @pre patient_ids: an iterable of patient IDs (duplicates are allowed)
+        @pre fields: the fields of the patients to read, all the fields if None
+        @pre patient_cache: if given, only the patients missing from the cache are read (whole documents)
+    returns {patient_id: patient}
+    """
+    if patient_cache is not None:
+        return patient_cache.get_many(m_client, patient_ids)
+    projection = {field: 1 for field in fields} if fields is not None else None
+    patients = m_client.get_documents("patients", {"_id": {"$in": list(set(patient_ids))}}, projection=projection)
+    return {patient["_id"]: patient for patient in patients}
+
+
+def attach_patients(m_client: MongoDBClient, orders: list[dict[str, Any]], fields=("name", "surname"), patient_cache: PatientCache | None = None) -> list[dict[str, Any]]:
+    """
+    Function that attaches to each order the @fields of its patient (as "patient_<field>", see PATIENT_FIELDS) with a
+    single query for all the orders.
+        @pre m_client: MongoDB client object
+        @pre orders: a list of orders
+        @pre fields: the fields of the patient to attach
+        @pre patient_cache: an optional patient cache (see get_patients)
+    returns the orders (modified in place)
+    """
+    patients = get_patients(m_client, (order["patient_id"] for order in orders), fields, patient_cache)
+    for order in orders:
+        patient = patients.get(order["patient_id"], dict())
+        for field in fields:
+            order[PATIENT_FIELDS.get(field, f"patient_{field}")] = patient.get(field, "")
+    return orders
+
+
+def get_patient_with_orders(m_client: MongoDBClient, patient_id: str, patient_cache: PatientCache | None = None) -> tuple[dict[str, Any] | None, list[dict[str, Any]], list[dict[str, Any]]]:
+    """
+    Function that reads a patient and all its orders (one query for the orders, split on is_active, and one for the
+    archived orders, always inactive).
+        @pre m_client: MongoDB client object
+        @pre patient_id: the ID of the patient
+        @pre patient_cache: an optional patient cache the patient is read from
+    returns the patient (None if unknown), the active orders and the past orders
+    """
+    patient = patient_cache.get(m_client, patient_id) if patient_cache is not None else m_client.get_document("patients", {"_id": patient_id})
+    orders = m_client.get_documents("orders", {"patient_id": patient_id})
+    past_orders = [order for order in orders if not order.get("is_active")] + m_client.get_documents(ORDERS_HISTORY, {"patient_id": patient_id})
+    return patient, [order for order in orders if order.get("is_active")], past_orders
@@ -0,0 +1,178 @@
+"""
+This file contains the background labeling of the reports. Instead of running the NER model in the request creating a
+report (which ties up a worker of the server for each report), the report is saved right away with
+labels_status = "pending" and labeled later by a small pool of threads :
+    - The pending reports are the queue : a thread claims them atomically in MongoDB ("labeling"), so several workers
+      of the server (or a restart) never label the same report twice, and no report is lost if the server stops
+    - The claimed reports are annotated by batches (both sections of all the reports in one call of the model)
+    - A report claimed by a stopped worker is claimed again after @claim_timeout seconds
+    - Once labeled ("done") or if the model fails on it ("failed"), the report is given to the on_done callback (the
+      server sends the ORU^R01 to the HIS)
+The reports created before the labeling queue have no labels_status, they were labeled when created. The version of
+the model and of the post-processing is saved with the labels (labels_version), see relabel to update stale labels.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.dependencies import Dependency, DependencyUnavailable
+from typing import Any, Callable
+import datetime
+import threading
+import time
+
+COLLECTION = "reports"
+PENDING = "pending"
+LABELING = "labeling"
+DONE = "done"
+FAILED = "failed"
+# Sections of a report annotated by the model
+SECTIONS = ("findings", "impressions")
+
+
+def labeled_fields(processed: dict[str, tuple[list, dict[str, Any]]]) -> dict[str, Any]:
+    """
+    Returns the fields of a labeled report from the result of NERModel.process_reports for each section
+    ({section: (labels, processed annotations)})
+    """
+    fields = {"labels": {section: list(processed[section][0]) for section in SECTIONS}}
+    for section in SECTIONS:
+        fields[f"{section}-text"] = processed[section][1]["radgraph_text"]
+        fields[f"{section}-annotations"] = processed[section][1]["radgraph_annotations"]
+    return fields
+
+
+def label_reports(model, reports: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Function that labels @reports with @model (NERModel), all their sections being annotated with a single call of the
+    model. If the batch fails, the reports are labeled one by one so that only the failing ones are marked as failed.
+    returns the fields to set on each report (labels_status "done" or "failed"), in the order of @reports
+    """
+    texts = [report.get(f"{section}-text", "") for report in reports for section in SECTIONS]
+    try:
+        processed = model.process_reports(texts)
+    except Exception as e:
+        if len(reports) == 1:
+            return [{"labels_status": FAILED, "labels_error": str(e)}]
+        return [fields for report in reports for fields in label_reports(model, [report])]
+    result = list()
+    for i in range(len(reports)):
+        sections = {section: processed[i * len(SECTIONS) + j] for j, section in enumerate(SECTIONS)}
+        result.append({**labeled_fields(sections), "labels_status": DONE, "labels_version": model.labels_version})
+    return result
+
+
+class LabelingQueue:
+
+    def __init__(self, model: Dependency, workers: int = 1, batch_size: int = 8, poll_interval: float = 5, claim_timeout: int = 600):
+        """
+        Constructor for LabelingQueue instance.
+        @pre model: the NER model (NERModel) to wait for
+        @pre workers: the number of labeling threads (each one runs the model)
+        @pre batch_size: the maximum number of reports annotated by one call of the model
+        @pre poll_interval: the number of seconds between two checks of the pending reports when nothing is submitted
+                            (reports of the other workers of the server, reports left by a restart)
+        @pre claim_timeout: the number of seconds after which a report being labeled is claimed again
+        """
+        self.model = model
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.labeled = 0
+        self.failed = 0
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__threads = list()
+        self.__log = lambda message: None
+
+    def __claim(self, m_client: MongoDBClient) -> dict[str, Any] | None:
+        now = datetime.datetime.now()
+        return m_client.find_and_update(
+            COLLECTION,
+            {"$or": [
+                {"labels_status": PENDING},
+                {"labels_status": LABELING, "labeling_started": {"$lt": now - datetime.timedelta(seconds=self.claim_timeout)}}
+            ]},
+            {"labels_status": LABELING, "labeling_started": now}
+        )
+
+    def __finish(self, m_client: MongoDBClient, report: dict[str, Any], fields: dict[str, Any], on_done: Callable[[dict[str, Any]], None]):
+        # Only the report still claimed by this thread is updated (not claimed again by another worker meanwhile)
+        updated = m_client.find_and_update(
+            COLLECTION,
+            {"_id": report["_id"], "labels_status": LABELING, "labeling_started": report["labeling_started"]},
+            fields
+        )
+        if updated is None:
+            return
+        with self.__lock:
+            if updated["labels_status"] == DONE:
+                self.labeled += 1
+            else:
+                self.failed += 1
+        try:
+            on_done(updated)
+        except Exception as e:
+            # The report is saved, the other reports of the batch are still finished
+            self.__log(f"Report {updated['_id']} labeled but not sent: {e!r}")
+
+    def label(self, m_client: MongoDBClient, reports: list[dict[str, Any]], on_done: Callable[[dict[str, Any]], None]):
+        """
+        Function that labels claimed @reports (see label_reports) and saves them.
+        """
+        for report, fields in zip(reports, label_reports(self.model.get(), reports)):
+            self.__finish(m_client, report, fields, on_done)
+
+    def __run(self, m_client: MongoDBClient, on_done: Callable[[dict[str, Any]], None]):
+        while True:
+            self.__wakeup.wait(self.poll_interval)
+            self.__wakeup.clear()
+            try:
+                # The model is loaded before claiming, the reports stay pending (for the other workers) meanwhile
+                self.model.get()
+            except DependencyUnavailable:
+                continue
+            try:
+                while True:
+                    reports = list()
+                    while len(reports) < self.batch_size:
+                        report = self.__claim(m_client)
+                        if report is None:
+                            break
+                        reports.append(report)
+                    if not reports:
+                        break
+                    self.label(m_client, reports, on_done)
+            except Exception as e:
+                # MongoDB error (failover, ...) or model error : the thread goes on at the next pass, the reports
+                # already claimed are claimed again after claim_timeout
+                self.__log(f"Labeling pass failed: {e!r}")
+                time.sleep(self.poll_interval)
+
+    def start(self, m_client: MongoDBClient, on_done: Callable[[dict[str, Any]], None], log: Callable[[str], None] | None = None):
+        """
+        Function that starts the labeling threads (daemons), the reports left pending are labeled right away.
+            @pre m_client: MongoDB client object
+            @pre on_done: function called with each report once labeled (or failed)
+            @pre log: function logging the errors of the labeling threads and of on_done
+        """
+        with self.__lock:
+            if self.__threads:
+                return
+            if log is not None:
+                self.__log = log
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.__run, args=(m_client, on_done), name=f"labeling-{i}", daemon=True)
+                thread.start()
+                self.__threads.append(thread)
+        self.__wakeup.set()
+
+    def notify(self):
+        """
+        Function to call after saving a pending report, a labeling thread claims it right away
+        """
+        self.__wakeup.set()
+
+    def stats(self, m_client: MongoDBClient) -> dict[str, int]:
+        with self.__lock:
+            stats = {"labeled": self.labeled, "failed": self.failed}
+        stats["pending"] = m_client.count_documents(COLLECTION, {"labels_status": {"$in": [PENDING, LABELING]}})
+        return stats
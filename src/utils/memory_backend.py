@@ -0,0 +1,777 @@
+"""
+This file contains an in-memory storage backend with the same interface as MongoDBClient, selected with
+config.MONGO_BACKEND = "memory" (see create_client). It lets the scheduler, the HL7 handlers and the routes run (tests,
+load tests, profiling) without a MongoDB server, on deterministic data :
+    - The databases live in the process and are shared by all the clients of the same db_name, nothing is persisted
+    - The query operators used by OpenRIS are supported ($eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $exists, $all,
+      $elemMatch, $size, $regex, $not, $or, $and, $nor) on dotted paths and arrays, with the comparison order of MongoDB
+      (null < numbers < strings < objects < arrays < binary < ObjectId < booleans < dates)
+    - The updates support $set, $unset, $inc, $push and $setOnInsert (upserts), and the replacement of a document
+    - create_index builds a hash index (equalities, $in) and a sorted index (ranges) on the first field of the index keys,
+      a query uses the index returning the fewest candidates. Unique and TTL (expireAfterSeconds) indexes are enforced.
+    - Change streams (watch) need a replica set and are not supported, the caller falls back to its TTL
+The documents are copied when written and when read, as with a real server the caller cannot modify the stored ones.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError, DuplicateKeyError, InvalidOperation, OperationFailure, WriteError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+from bson import ObjectId
+from typing import Any, Callable
+import bisect
+import datetime
+import itertools
+import re
+import threading
+import time
+
+# Seconds between two removals of the expired documents of the TTL indexes (as the TTL monitor of MongoDB)
+TTL_MONITOR_INTERVAL = 60
+
+_databases: dict[str, "_Database"] = dict()
+_databases_lock = threading.Lock()
+_MISSING = object()    # Value of a field absent from a projected document
+
+
+# Rank of each type in the comparison order of MongoDB
+BRACKETS = {type(None): 1, int: 2, float: 2, str: 3, dict: 4, list: 5, tuple: 5, bytes: 6, ObjectId: 7, bool: 8, datetime.datetime: 9}
+
+
+def _bracket(value: Any) -> int:
+    bracket = BRACKETS.get(type(value))
+    if bracket is not None:
+        return bracket
+    # Subclasses (bson Int64, Binary, ...), a bool is an int for isinstance
+    for value_type, bracket in sorted(BRACKETS.items(), key=lambda item: -item[1]):
+        if isinstance(value, value_type):
+            return bracket
+    return 12
+
+
+def _key(value: Any) -> tuple:
+    """
+    Returns a hashable key of @value, ordered as MongoDB orders the values and equal only for values equal for MongoDB
+    (1 == 1.0 but True != 1)
+    """
+    bracket = _bracket(value)
+    if bracket == 4:
+        return bracket, tuple((field, _key(item)) for field, item in value.items())
+    if bracket == 5:
+        return bracket, tuple(_key(item) for item in value)
+    if bracket == 12:
+        return bracket, repr(value)
+    return bracket, value
+
+
+def _copy(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {field: _copy(item) for field, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _values(document: dict[str, Any], path: str) -> list[Any]:
+    """
+    Returns the values found at the dotted @path of @document, the arrays met on the way are traversed (an empty list
+    means the field is missing)
+    """
+    if "." not in path:
+        return [document[path]] if path in document else []
+    current = [document]
+    for part in path.split("."):
+        found = list()
+        for value in current:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                found += [item[part] for item in value if isinstance(item, dict) and part in item]
+        current = found
+    return current
+
+
+def _expand(values: list[Any]):
+    # A condition on an array field is true if it is true for the array or for one of its elements
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _is_operators(condition: Any) -> bool:
+    return isinstance(condition, dict) and len(condition) > 0 and all(field.startswith("$") for field in condition)
+
+
+def _compile_equals(target: Any) -> Callable[[list[Any]], bool]:
+    if isinstance(target, re.Pattern):
+        return lambda values: any(isinstance(value, str) and target.search(value) for value in _expand(values))
+    if target is None:
+        return lambda values: not values or any(value is None for value in _expand(values))
+    target = _key(target)
+    return lambda values: any(_key(value) == target for value in _expand(values))
+
+
+def _compile_in(targets: list[Any]) -> Callable[[list[Any]], bool]:
+    keys = {_key(target) for target in targets if target is not None and not isinstance(target, re.Pattern)}
+    others = [_compile_equals(target) for target in targets if target is None or isinstance(target, re.Pattern)]
+    return lambda values: any(_key(value) in keys for value in _expand(values)) or any(other(values) for other in others)
+
+
+def _compile_compare(operator: str, bound: Any) -> Callable[[list[Any]], bool]:
+    # MongoDB only compares values of the same type ({"$gt": 5} never matches a string)
+    bound = _key(bound)
+    compare = {"$gt": tuple.__gt__, "$gte": tuple.__ge__, "$lt": tuple.__lt__, "$lte": tuple.__le__}[operator]
+
+    def predicate(values):
+        for value in _expand(values):
+            value = _key(value)
+            if value[0] == bound[0] and compare(value, bound):
+                return True
+        return False
+    return predicate
+
+
+def _compile_operator(operator: str, argument: Any, condition: dict[str, Any]) -> Callable[[list[Any]], bool]:
+    if operator == "$eq":
+        return _compile_equals(argument)
+    if operator == "$ne":
+        equals = _compile_equals(argument)
+        return lambda values: not equals(values)
+    if operator == "$in":
+        return _compile_in(argument)
+    if operator == "$nin":
+        contained = _compile_in(argument)
+        return lambda values: not contained(values)
+    if operator in ("$gt", "$gte", "$lt", "$lte"):
+        return _compile_compare(operator, argument)
+    if operator == "$exists":
+        return lambda values: bool(values) == bool(argument)
+    if operator == "$all":
+        targets = [_compile_equals(target) for target in argument]
+        return lambda values: len(targets) > 0 and all(target(values) for target in targets)
+    if operator == "$elemMatch":
+        # {"$elemMatch": {"$gte": 1}} applies to the element itself, {"$elemMatch": {"field": 1}} to a sub-document
+        if _is_operators(argument) and not any(operator in argument for operator in ("$or", "$and", "$nor")):
+            element = _compile_condition(argument)
+            matches = lambda item: element([item])
+        else:
+            sub_query = compile_query(argument)
+            matches = lambda item: isinstance(item, dict) and sub_query(item)
+        return lambda values: any(isinstance(value, list) and any(matches(item) for item in value) for value in values)
+    if operator == "$size":
+        return lambda values: any(isinstance(value, list) and len(value) == argument for value in values)
+    if operator == "$regex":
+        flags = sum(getattr(re, flag.upper()) for flag in condition.get("$options", "") if flag in "imsx")
+        return _compile_equals(re.compile(argument, flags) if isinstance(argument, str) else argument)
+    if operator == "$options":
+        return lambda values: True
+    if operator == "$not":
+        negated = _compile_condition(argument)
+        return lambda values: not negated(values)
+    raise OperationFailure(f"unknown operator: {operator}", code=2)
+
+
+def _compile_condition(condition: Any) -> Callable[[list[Any]], bool]:
+    if not _is_operators(condition):
+        return _compile_equals(condition)
+    predicates = [_compile_operator(operator, argument, condition) for operator, argument in condition.items()]
+    if len(predicates) == 1:
+        return predicates[0]
+    return lambda values: all(predicate(values) for predicate in predicates)
+
+
+def compile_query(query: dict[str, Any]) -> Callable[[dict[str, Any]], bool]:
+    """
+    Returns a function telling if a document matches the MongoDB filter @query (the filter is parsed once per query,
+    not once per document)
+    """
+    predicates = list()
+    for field, condition in query.items():
+        if field in ("$or", "$and", "$nor"):
+            sub_queries = [compile_query(sub_query) for sub_query in condition]
+            if field == "$or":
+                predicates.append(lambda document, sub_queries=sub_queries: any(sub_query(document) for sub_query in sub_queries))
+            elif field == "$and":
+                predicates += sub_queries
+            else:
+                predicates.append(lambda document, sub_queries=sub_queries: not any(sub_query(document) for sub_query in sub_queries))
+        elif field.startswith("$"):
+            raise OperationFailure(f"unknown top level operator: {field}", code=2)
+        else:
+            predicates.append(lambda document, field=field, matches=_compile_condition(condition): matches(_values(document, field)))
+    return lambda document: all(predicate(document) for predicate in predicates)
+
+
+def _sort_key(document: dict[str, Any], field: str, direction: int) -> tuple:
+    # An array is sorted on its smallest element in ascending order (its largest in descending order)
+    values = _values(document, field)
+    if not values:
+        return _key(None)
+    value = values[0]
+    if isinstance(value, list) and value:
+        keys = [_key(item) for item in value]
+        return min(keys) if direction == 1 else max(keys)
+    return _key(value)
+
+
+def _projection_tree(fields: list[str]) -> dict[str, Any]:
+    # {"a.b": 1, "a.c": 1} -> {"a": {"b": True, "c": True}}, a whole field (True) wins over its subfields
+    tree = dict()
+    for field in fields:
+        node, parts = tree, field.split(".")
+        for part in parts[:-1]:
+            if node.get(part) is True:
+                break
+            node = node.setdefault(part, dict())
+        else:
+            node[parts[-1]] = True
+    return tree
+
+
+def _include(value: Any, tree: dict[str, Any] | bool) -> Any:
+    # The projection goes through the arrays : the documents of an array are projected, its other values are dropped
+    if tree is True:
+        return _copy(value)
+    if isinstance(value, list):
+        return [item for item in (_include(item, tree) for item in value) if item is not _MISSING]
+    if isinstance(value, dict):
+        result = dict()
+        for part, subtree in tree.items():
+            if part in value:
+                included = _include(value[part], subtree)
+                if included is not _MISSING:
+                    result[part] = included
+        return result
+    return _MISSING
+
+
+def _exclude(value: Any, tree: dict[str, Any]) -> Any:
+    if isinstance(value, list):
+        return [_exclude(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: _exclude(item, tree[key]) if key in tree else item for key, item in value.items() if tree.get(key) is not True}
+    return value
+
+
+def _project(document: dict[str, Any], projection: dict[str, Any] | list[str] | None) -> dict[str, Any]:
+    if not projection:
+        return _copy(document)
+    if not isinstance(projection, dict):
+        projection = {field: 1 for field in projection}
+    fields = [field for field in projection if field != "_id"]
+    if any(projection[field] for field in fields):
+        result = {"_id": _copy(document["_id"])} if projection.get("_id", 1) and "_id" in document else dict()
+        result.update(_include(document, _projection_tree(fields)))
+        return result
+    return _exclude(_copy(document), _projection_tree([field for field in projection if not projection[field]]))
+
+
+def _set(document: dict[str, Any], path: str, value: Any):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, dict())
+    document[parts[-1]] = value
+
+
+def _unset(document: dict[str, Any], path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def _update(document: dict[str, Any], update: dict[str, Any], inserting: bool = False) -> dict[str, Any]:
+    """
+    Returns a copy of @document with @update applied (update operators or replacement document)
+    """
+    if not any(field.startswith("$") for field in update):
+        updated = {"_id": document["_id"]} if "_id" in document else dict()
+        updated.update(_copy(update))
+    else:
+        updated = _copy(document)
+        for operator, fields in update.items():
+            for path, value in fields.items():
+                if operator == "$set" or (operator == "$setOnInsert" and inserting):
+                    _set(updated, path, _copy(value))
+                elif operator == "$unset":
+                    _unset(updated, path)
+                elif operator == "$inc":
+                    current = _values(updated, path)
+                    _set(updated, path, (current[0] if current else 0) + value)
+                elif operator == "$push":
+                    current = _values(updated, path)
+                    _set(updated, path, (list(current[0]) if current else list()) + [_copy(value)])
+                elif operator != "$setOnInsert":
+                    raise WriteError(f"Unknown modifier: {operator}", code=9)
+    if "_id" in document and _key(updated.get("_id")) != _key(document["_id"]):
+        raise WriteError("Performing an update on the path '_id' would modify the immutable field '_id'", code=66)
+    return updated
+
+
+def _upserted(query: dict[str, Any], update: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns the document inserted by an upsert matching nothing : the equalities of @query with @update applied
+    """
+    document = dict()
+    for field, condition in query.items():
+        if field == "$and":
+            for sub_query in condition:
+                document.update(_upserted(sub_query, dict()))
+        elif not field.startswith("$"):
+            if not _is_operators(condition):
+                _set(document, field, _copy(condition))
+            elif "$eq" in condition:
+                _set(document, field, _copy(condition["$eq"]))
+    document = _update(document, update, inserting=True) if update else document
+    if "_id" not in document:
+        document = {"_id": ObjectId(), **document}
+    return document
+
+
+class _FieldIndex:
+    """
+    Hash and sorted index of the values of a field (each element of an array is indexed, as in a multikey index)
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.__entries = dict()    # {value key: {document key}}
+        self.__sorted = None    # ([value keys], [document keys]) sorted on the values, built at the first range query
+        self.multikey = 0    # Number of documents with several values for the field (arrays)
+
+    def __keys(self, document: dict[str, Any]) -> set[tuple]:
+        keys = set()
+        for value in _values(document, self.field) or [None]:
+            keys.add(_key(value))
+            if isinstance(value, list):
+                keys.update(_key(item) for item in value)
+        return keys
+
+    def __is_multikey(self, document: dict[str, Any]) -> bool:
+        values = _values(document, self.field)
+        return len(values) > 1 or any(isinstance(value, list) for value in values)
+
+    def add(self, doc_key: tuple, document: dict[str, Any]):
+        self.multikey += self.__is_multikey(document)
+        for key in self.__keys(document):
+            self.__entries.setdefault(key, set()).add(doc_key)
+            if self.__sorted is not None:
+                position = bisect.bisect_right(self.__sorted[0], key)
+                self.__sorted[0].insert(position, key)
+                self.__sorted[1].insert(position, doc_key)
+
+    def remove(self, doc_key: tuple, document: dict[str, Any]):
+        self.multikey -= self.__is_multikey(document)
+        for key in self.__keys(document):
+            entry = self.__entries.get(key)
+            if entry is not None:
+                entry.discard(doc_key)
+                if not entry:
+                    del self.__entries[key]
+            if self.__sorted is not None:
+                low, high = bisect.bisect_left(self.__sorted[0], key), bisect.bisect_right(self.__sorted[0], key)
+                position = low + self.__sorted[1][low:high].index(doc_key)
+                del self.__sorted[0][position], self.__sorted[1][position]
+
+    def lookup(self, condition: Any) -> set[tuple] | None:
+        """
+        Returns the keys of the documents which may match @condition on the field, None if the index cannot be used
+        """
+        if not _is_operators(condition):
+            condition = {"$eq": condition}
+        if "$eq" in condition and condition["$eq"] is not None and not isinstance(condition["$eq"], re.Pattern):
+            return set(self.__entries.get(_key(condition["$eq"]), ()))
+        if "$in" in condition and all(value is not None and not isinstance(value, re.Pattern) for value in condition["$in"]):
+            return set().union(*(self.__entries.get(_key(value), ()) for value in condition["$in"]))
+        if "$all" in condition and condition["$all"] and not _is_operators(condition["$all"][0]):
+            return set(self.__entries.get(_key(condition["$all"][0]), ()))
+        lower = next(((op, condition[op]) for op in ("$gt", "$gte") if op in condition), None)
+        upper = next(((op, condition[op]) for op in ("$lt", "$lte") if op in condition), None)
+        if lower is None and upper is None:
+            return None
+        if lower is not None and upper is not None and self.multikey:
+            # The elements of an array can meet the bounds separately ({"$gt": 2, "$lt": 5} matches [1, 5]) : as MongoDB
+            # on a multikey index, only one bound is used, the full condition is checked on the documents
+            upper = None
+        if self.__sorted is None:
+            items = sorted((key, doc_key) for key, doc_keys in self.__entries.items() for doc_key in doc_keys)
+            self.__sorted = ([item[0] for item in items], [item[1] for item in items])
+        keys, doc_keys = self.__sorted
+        # The range is restricted to the type of its bounds (MongoDB only compares values of the same type)
+        bracket = _key((lower or upper)[1])[0]
+        start = bisect.bisect_left(keys, (bracket,))
+        end = bisect.bisect_left(keys, (bracket + 1,))
+        if lower is not None:
+            bound = _key(lower[1])
+            start = max(start, bisect.bisect_left(keys, bound) if lower[0] == "$gte" else bisect.bisect_right(keys, bound))
+        if upper is not None:
+            bound = _key(upper[1])
+            end = min(end, bisect.bisect_right(keys, bound) if upper[0] == "$lte" else bisect.bisect_left(keys, bound))
+        return set(doc_keys[start:end])
+
+
+class _Collection:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = dict()    # {_id key: document}, in insertion order
+        self.order = dict()    # {_id key: insertion number}, to return the candidates of an index in the natural order
+        self.indexes = {"_id": _FieldIndex("_id")}    # {first field of the index keys: index}
+        self.specs = {"_id_": [("_id", 1)]}    # {index name: keys}
+        self.unique = dict()    # {index name: (fields, {values key: _id key})}
+        self.ttl = dict()    # {field: seconds}
+        self.expired_at = 0
+        self.__counter = itertools.count()
+
+    def __unique_key(self, fields: list[str], document: dict[str, Any]) -> tuple:
+        return tuple(_key(values[0] if values else None) for values in (_values(document, field) for field in fields))
+
+    def check(self, doc_key: tuple, document: dict[str, Any]):
+        # Raises DuplicateKeyError if @document violates a unique index
+        for index_name, (fields, entries) in self.unique.items():
+            owner = entries.get(self.__unique_key(fields, document))
+            if owner is not None and owner != doc_key:
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {index_name}", code=11000)
+
+    def insert(self, document: dict[str, Any]):
+        doc_key = _key(document["_id"])
+        if doc_key in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_ dup key: {{ _id: {document['_id']!r} }}", code=11000)
+        self.check(doc_key, document)
+        self.documents[doc_key] = document
+        self.order[doc_key] = next(self.__counter)
+        self.__index(doc_key, document)
+
+    def replace(self, doc_key: tuple, document: dict[str, Any]):
+        self.check(doc_key, document)
+        self.__unindex(doc_key, self.documents[doc_key])
+        self.documents[doc_key] = document
+        self.__index(doc_key, document)
+
+    def delete(self, doc_key: tuple):
+        self.__unindex(doc_key, self.documents.pop(doc_key))
+        del self.order[doc_key]
+
+    def __index(self, doc_key: tuple, document: dict[str, Any]):
+        for index in self.indexes.values():
+            index.add(doc_key, document)
+        for fields, entries in self.unique.values():
+            entries[self.__unique_key(fields, document)] = doc_key
+
+    def __unindex(self, doc_key: tuple, document: dict[str, Any]):
+        for index in self.indexes.values():
+            index.remove(doc_key, document)
+        for fields, entries in self.unique.values():
+            entries.pop(self.__unique_key(fields, document), None)
+
+    def create_index(self, keys: list[tuple[str, Any]], unique: bool = False, expireAfterSeconds: int | None = None, name: str | None = None, **kwargs) -> str:
+        index_name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        if index_name in self.specs:
+            return index_name
+        field = keys[0][0]
+        if field not in self.indexes:
+            index = _FieldIndex(field)
+            for doc_key, document in self.documents.items():
+                index.add(doc_key, document)
+            self.indexes[field] = index
+        if unique:
+            fields = [key[0] for key in keys]
+            entries = dict()
+            for doc_key, document in self.documents.items():
+                if entries.setdefault(self.__unique_key(fields, document), doc_key) != doc_key:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {index_name}", code=11000)
+            self.unique[index_name] = (fields, entries)
+        if expireAfterSeconds is not None:
+            self.ttl[field] = expireAfterSeconds
+        self.specs[index_name] = list(keys)
+        return index_name
+
+    def expire(self):
+        # Removes the documents of the TTL indexes expired (at most once per TTL_MONITOR_INTERVAL)
+        if not self.ttl or time.monotonic() - self.expired_at < TTL_MONITOR_INTERVAL:
+            return
+        self.expired_at = time.monotonic()
+        now = datetime.datetime.now()
+        for field, seconds in self.ttl.items():
+            cutoff = now - datetime.timedelta(seconds=seconds)
+            for doc_key in self.indexes[field].lookup({"$lt": cutoff}):
+                self.delete(doc_key)
+
+    def plan(self, query: dict[str, Any]) -> tuple[set[tuple] | None, dict[str, Any]]:
+        """
+        Returns the keys of the candidate documents of @query given by the most selective index (None for a collection
+        scan) and the plan used, in the format of explain()
+        """
+        best, best_plan = None, {"stage": "COLLSCAN"}
+        for field, condition in query.items():
+            candidates, plan = None, None
+            if field == "$and":
+                for sub_query in condition:
+                    sub_candidates, sub_plan = self.plan(sub_query)
+                    if sub_candidates is not None and (candidates is None or len(sub_candidates) < len(candidates)):
+                        candidates, plan = sub_candidates, sub_plan
+            elif field == "$or":
+                branches = [self.plan(sub_query) for sub_query in condition]
+                if branches and all(branch[0] is not None for branch in branches):
+                    candidates = set().union(*(branch[0] for branch in branches))
+                    plan = {"stage": "OR", "inputStages": [branch[1] for branch in branches]}
+            elif field in self.indexes:
+                candidates = self.indexes[field].lookup(condition)
+                plan = {"stage": "IXSCAN", "keyPattern": {field: 1}, "indexName": f"{field}_1", "keysExamined": len(candidates or ())}
+            if candidates is not None and (best is None or len(candidates) < len(best)):
+                best, best_plan = candidates, plan
+        return best, best_plan
+
+    def sort_plan(self, sort: list[tuple[str, int]], plan: dict[str, Any]) -> dict[str, Any]:
+        """
+        Returns the plan of a sorted query : as MongoDB, the documents are read in the order of an index whose keys
+        start with the sort (or its reverse) when the query is a collection scan or uses this index, they are sorted in
+        memory otherwise (SORT stage)
+        """
+        for index_name, keys in self.specs.items():
+            prefix = keys[:len(sort)]
+            if len(prefix) < len(sort) or [key[0] for key in prefix] != [key[0] for key in sort]:
+                continue
+            if [key[1] for key in prefix] not in ([key[1] for key in sort], [-key[1] for key in sort]):
+                continue
+            if plan["stage"] == "COLLSCAN":
+                scan = {"stage": "IXSCAN", "keyPattern": dict(keys), "indexName": index_name, "keysExamined": len(self.documents)}
+                return {"stage": "FETCH", "inputStage": scan}
+            if plan["stage"] == "FETCH" and plan["inputStage"].get("keyPattern", {}).get(sort[0][0]) is not None:
+                return plan
+        return {"stage": "SORT", "sortPattern": dict(sort), "inputStage": plan}
+
+    def find(self, query: dict[str, Any], sort=None, limit: int = 0) -> tuple[list[dict[str, Any]], dict[str, Any]]:
+        """
+        returns the stored documents matching @query (not copied) and the statistics of the query, in the format of
+        explain()
+        """
+        self.expire()
+        query = query or dict()
+        candidates, plan = self.plan(query)
+        if candidates is None:
+            scanned = list(self.documents.values())
+        else:
+            scanned = [self.documents[doc_key] for doc_key in sorted(candidates, key=self.order.__getitem__)]
+            plan = {"stage": "FETCH", "inputStage": plan}
+        matches = compile_query(query)
+        documents = [document for document in scanned if matches(document)]
+        if sort:
+            sort = list(sort.items() if isinstance(sort, dict) else sort)
+            for field, direction in reversed(sort):
+                documents.sort(key=lambda document: _sort_key(document, field, direction), reverse=direction == -1)
+            plan = self.sort_plan(sort, plan)
+        if limit:
+            documents = documents[:abs(limit)]
+        stats = {
+            "nReturned": len(documents),
+            "totalKeysExamined": len(candidates) if candidates is not None else 0,
+            "totalDocsExamined": len(scanned),
+        }
+        return documents, {"queryPlanner": {"namespace": self.name, "winningPlan": plan}, "executionStats": stats}
+
+
+class _Database:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.RLock()
+        self.collections = dict()    # {name: _Collection}
+
+    def __getitem__(self, name: str) -> _Collection:
+        if name not in self.collections:
+            self.collections[name] = _Collection(name)
+        return self.collections[name]
+
+
+def get_database(db_name: str) -> _Database:
+    """
+    Returns the in-memory database @db_name of the process (created empty at the first use)
+    """
+    with _databases_lock:
+        if db_name not in _databases:
+            _databases[db_name] = _Database(db_name)
+        return _databases[db_name]
+
+
+def drop_database(db_name: str):
+    with _databases_lock:
+        _databases.pop(db_name, None)
+
+
+class MemoryDBClient(MongoDBClient):
+
+    def __init__(self, url=None, db_name="app"):
+        # url is ignored, the clients created with the same db_name share the same data
+        self.db_name = db_name
+        self.db = get_database(db_name)
+
+    def __new_document(self, elem):
+        # As pymongo, the generated _id is also set on the document given by the caller
+        if "_id" not in elem:
+            elem["_id"] = ObjectId()
+        return {"_id": _copy(elem["_id"]), **{field: _copy(value) for field, value in elem.items() if field != "_id"}}
+
+    def __update(self, collection, query, update, upsert=False, many=False):
+        # returns (matched, modified, upserted _id)
+        documents, _ = collection.find(query, limit=0 if many else 1)
+        if not documents:
+            if not upsert:
+                return 0, 0, None
+            document = _upserted(query, update)
+            collection.insert(document)
+            return 0, 0, document["_id"]
+        modified = 0
+        for document in documents:
+            updated = _update(document, update)
+            if updated != document:
+                collection.replace(_key(document["_id"]), updated)
+                modified += 1
+        return len(documents), modified, None
+
+    def __delete(self, collection, query, many=False):
+        documents, _ = collection.find(query, limit=0 if many else 1)
+        for document in documents:
+            collection.delete(_key(document["_id"]))
+        return len(documents)
+
+    def list_databases(self):
+        with _databases_lock:
+            return list(_databases)
+
+    def create_collection(self, name):
+        with self.db.lock:
+            return self.db[name]
+
+    def delete_database(self, name):
+        with self.db.lock:
+            self.db.collections.pop(name, None)
+
+    def add_document(self, name, elem):
+        with self.db.lock:
+            document = self.__new_document(elem)
+            self.db[name].insert(document)
+        return InsertOneResult(document["_id"], True)
+
+    def add_documents(self, name, elems, ordered=True):
+        if not elems:
+            raise TypeError("documents must be a non-empty list")
+        inserted, errors = list(), list()
+        with self.db.lock:
+            collection = self.db[name]
+            for index, elem in enumerate(elems):
+                document = self.__new_document(elem)
+                try:
+                    collection.insert(document)
+                except DuplicateKeyError as e:
+                    errors.append({"index": index, "code": e.code, "errmsg": str(e), "op": elem})
+                    if ordered:
+                        break
+                else:
+                    inserted.append(document["_id"])
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": len(inserted), "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []})
+        return InsertManyResult(inserted, True)
+
+    def delete_document(self, name, id):
+        with self.db.lock:
+            deleted = self.__delete(self.db[name], {"_id": id})
+        return DeleteResult({"n": deleted, "ok": 1.0}, True)
+
+    def delete_documents(self, name, req):
+        with self.db.lock:
+            deleted = self.__delete(self.db[name], req, many=True)
+        return DeleteResult({"n": deleted, "ok": 1.0}, True)
+
+    def get_document(self, name, req):
+        with self.db.lock:
+            documents, _ = self.db[name].find(req, limit=1)
+            return _copy(documents[0]) if documents else None
+
+    def get_documents(self, name, req, projection=None, sort=None, limit=0):
+        with self.db.lock:
+            documents, _ = self.db[name].find(req, sort=sort, limit=limit)
+            return [_project(document, projection) for document in documents]
+
+    def count_documents(self, name, req):
+        with self.db.lock:
+            documents, _ = self.db[name].find(req)
+            return len(documents)
+
+    def iter_documents(self, name, req, projection=None, sort=None, limit=0, batch_size=None):
+        # The matching documents are selected at once, they are copied one by one while iterating
+        with self.db.lock:
+            documents, _ = self.db[name].find(req, sort=sort, limit=limit)
+        return (_project(document, projection) for document in documents)
+
+    def bulk_write(self, name, operations, ordered=False):
+        if not operations:
+            raise InvalidOperation("No operations to execute")
+        result = {"writeErrors": [], "writeConcernErrors": [], "nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        with self.db.lock:
+            collection = self.db[name]
+            for index, operation in enumerate(operations):
+                try:
+                    if isinstance(operation, InsertOne):
+                        collection.insert(self.__new_document(operation._doc))
+                        result["nInserted"] += 1
+                    elif isinstance(operation, (UpdateOne, UpdateMany, ReplaceOne)):
+                        matched, modified, upserted_id = self.__update(collection, operation._filter, operation._doc, operation._upsert, isinstance(operation, UpdateMany))
+                        result["nMatched"] += matched
+                        result["nModified"] += modified
+                        if upserted_id is not None:
+                            result["nUpserted"] += 1
+                            result["upserted"].append({"index": index, "_id": upserted_id})
+                    elif isinstance(operation, (DeleteOne, DeleteMany)):
+                        result["nRemoved"] += self.__delete(collection, operation._filter, isinstance(operation, DeleteMany))
+                    else:
+                        raise TypeError(f"{operation!r} is not a valid request")
+                except (DuplicateKeyError, WriteError) as e:
+                    result["writeErrors"].append({"index": index, "code": e.code, "errmsg": str(e), "op": operation})
+                    if ordered:
+                        break
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def update_document(self, name, id, updated):
+        with self.db.lock:
+            matched, modified, _ = self.__update(self.db[name], {"_id": id}, {"$set": updated})
+        return UpdateResult({"n": matched, "nModified": modified, "ok": 1.0}, True)
+
+    def find_and_update(self, name, req, updated, projection=None):
+        with self.db.lock:
+            collection = self.db[name]
+            documents, _ = collection.find(req, limit=1)
+            if not documents:
+                return None
+            document = _update(documents[0], {"$set": updated})
+            collection.replace(_key(document["_id"]), document)
+            return _project(document, projection)
+
+    def update_documents(self, name, req, updated):
+        with self.db.lock:
+            matched, modified, _ = self.__update(self.db[name], req, {"$set": updated}, many=True)
+        return UpdateResult({"n": matched, "nModified": modified, "ok": 1.0}, True)
+
+    def list_documents(self, name):
+        return self.iter_documents(name, {})
+
+    def explain(self, name, req, sort=None):
+        with self.db.lock:
+            _, explained = self.db[name].find(req, sort=sort)
+        return explained
+
+    def watch(self, name, pipeline=None):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    def create_index(self, name, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        with self.db.lock:
+            return self.db[name].create_index(list(keys), **kwargs)
@@ -0,0 +1,53 @@
+"""
+This file contains the one-shot migrations of the documents stored by OpenRIS. Each migration is idempotent and only
+touches the documents that were not migrated yet, run them with :
+    python -m src.utils.migrations
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.utils import examination_datetimes
+from src.utils.patient_search import search_keys
+from pymongo import UpdateOne
+
+
+def add_examination_datetimes(m_client: MongoDBClient, batch_size: int = 1000) -> int:
+    """
+    Add the native datetime fields examination_start and examination_end (used by the range queries and the scheduler)
+    to the orders only having the examination_date strings.
+        @pre m_client: MongoDB client object
+        @pre batch_size: number of orders updated per bulk write
+    returns the number of migrated orders
+    """
+    migrated = 0
+    operations = list()
+    for order in m_client.iter_documents("orders", {"examination_start": {"$exists": False}, "examination_date": {"$exists": True}}, projection={"examination_date": 1}, batch_size=batch_size):
+        operations.append(UpdateOne({"_id": order["_id"]}, {"$set": examination_datetimes(order["examination_date"])}))
+        if len(operations) >= batch_size:
+            migrated += m_client.bulk_write("orders", operations).modified_count
+            operations = list()
+    if operations:
+        migrated += m_client.bulk_write("orders", operations).modified_count
+    return migrated
+
+
+def add_patient_search_keys(m_client: MongoDBClient, batch_size: int = 1000) -> int:
+    """
+    Add the search keys (search_prefixes, search_phonetic) to the patients registered before the prefix/phonetic search.
+        @pre m_client: MongoDB client object
+        @pre batch_size: number of patients updated per bulk write
+    returns the number of migrated patients
+    """
+    migrated = 0
+    operations = list()
+    for patient in m_client.iter_documents("patients", {"search_prefixes": {"$exists": False}}, projection={"name": 1, "surname": 1}, batch_size=batch_size):
+        operations.append(UpdateOne({"_id": patient["_id"]}, {"$set": search_keys(patient.get("name"), patient.get("surname"))}))
+        if len(operations) >= batch_size:
+            migrated += m_client.bulk_write("patients", operations).modified_count
+            operations = list()
+    if operations:
+        migrated += m_client.bulk_write("patients", operations).modified_count
+    return migrated
+
+
+if __name__ == "__main__":
+    print(f"{add_examination_datetimes(MongoDBClient())} orders migrated (examination_start/examination_end)")
+    print(f"{add_patient_search_keys(MongoDBClient())} patients migrated (search keys)")
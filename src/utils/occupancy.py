@@ -0,0 +1,179 @@
+"""
+This file contains an in-process cache of the occupancy of the stations used by the scheduler. Instead of reading all the
+booked orders from MongoDB for each scheduling request, the cache keeps for each station a matrix (days x cells of
+@resolution minutes) counting the orders booked on each cell, for the range of days of the scheduler. It works as following :
+    - The cache is loaded from MongoDB with a single query (at the first request, when the day changes or after a TTL to
+      catch the bookings made by other workers)
+    - Each route/handler changing an order updates the cache (add, move or release an order)
+    - A slot request becomes a sliding-window check on the cumulative sum of the occupancy of each station
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from typing import Any, Callable
+import datetime
+import threading
+import time
+import numpy as np
+
+# Status of the orders occupying a station
+ACTIVE_STATUSES = ["SCHEDULED", "GENERATED", "IN PROGRESS"]
+MINUTES_PER_DAY = 24 * 60
+
+
+class OccupancyCache:
+
+    def __init__(self, d_range: int, resolution: int = 1, ttl: int = 300, log: Callable[[str], None] | None = None):
+        """
+        Constructor for OccupancyCache instance.
+        @pre d_range: an integer representing the number of days (after today) covered by the cache
+        @pre resolution: the size in minutes of a cell of the occupancy matrix (must divide a day)
+        @pre ttl: the number of seconds after which the cache is reloaded from MongoDB
+        """
+        if MINUTES_PER_DAY % resolution:
+            raise ValueError(f"Resolution {resolution} does not divide a day")
+        self.d_range = d_range
+        self.resolution = resolution
+        self.ttl = ttl
+        self.__lock = threading.RLock()
+        self.__origin = None    # Date of the first day of the matrices
+        self.__loaded_at = 0.0
+        self.__invalid = False    # True if the counts are inconsistent, the cache is reloaded at the next use
+        self.__log = log or (lambda message: None)
+        self.__stations = dict()    # {station: np.ndarray (days x cells) of booked counts}
+        self.__patients = dict()    # {patient_id: {order_id: (day, start cell, end cell)}}
+        self.__orders = dict()    # {order_id: (station, patient_id, day, start cell, end cell)}
+        self.__workload = dict()    # {station: number of orders booked}
+
+    def __new_matrix(self) -> np.ndarray:
+        # int32 : the overlapping bookings of a cell are not bounded (uint8 wrapped to 0, a full cell seen as free)
+        return np.zeros((self.d_range + 1, MINUTES_PER_DAY // self.resolution), dtype=np.int32)
+
+    def __to_cells(self, start_t: datetime.datetime, end_t: datetime.datetime) -> tuple[int, int]:
+        """
+        Convert a start and end datetime (same day) into the first cell and the cell after the last one they cover
+        """
+        start = start_t.hour * 60 + start_t.minute
+        end = end_t.hour * 60 + end_t.minute
+        return start // self.resolution, -(-end // self.resolution)
+
+    def is_stale(self) -> bool:
+        return self.__invalid or self.__origin != datetime.date.today() or time.monotonic() - self.__loaded_at > self.ttl
+
+    def load(self, m_client: MongoDBClient):
+        """
+        Function that (re)builds the cache with all the active orders booked in the range of days.
+            @pre m_client: MongoDB client object
+        """
+        current_date = datetime.date.today()
+        orders = m_client.get_documents(
+            "orders",
+            {
+                "status": {"$in": ACTIVE_STATUSES},
+                "examination_start": {
+                    "$gte": datetime.datetime.combine(current_date, datetime.time()),
+                    "$lt": datetime.datetime.combine(current_date + datetime.timedelta(days=self.d_range + 1), datetime.time())
+                }
+            },
+            projection={"_id": 1, "status": 1, "patient_id": 1, "station_aet": 1, "examination_start": 1, "examination_end": 1}
+        )
+        with self.__lock:
+            self.__origin = current_date
+            self.__invalid = False
+            self.__stations = dict()
+            self.__patients = dict()
+            self.__orders = dict()
+            self.__workload = dict()
+            for order in orders:
+                self.__add(order)
+            self.__loaded_at = time.monotonic()
+
+    def ensure_fresh(self, m_client: MongoDBClient):
+        if self.is_stale():
+            self.load(m_client)
+
+    def __add(self, order: dict[str, Any]):
+        if order.get("status") not in ACTIVE_STATUSES or not order.get("station_aet") or not order.get("examination_start"):
+            return
+        day = (order["examination_start"].date() - self.__origin).days
+        if not 0 <= day <= self.d_range:
+            return
+        c_start, c_end = self.__to_cells(order["examination_start"], order["examination_end"])
+        station = order["station_aet"]
+        if station not in self.__stations:
+            self.__stations[station] = self.__new_matrix()
+        self.__stations[station][day, c_start:c_end] += 1
+        self.__patients.setdefault(order["patient_id"], dict())[order["_id"]] = (day, c_start, c_end)
+        self.__orders[order["_id"]] = (station, order["patient_id"], day, c_start, c_end)
+        self.__workload[station] = self.__workload.get(station, 0) + 1
+
+    def __remove(self, order_id: str):
+        booking = self.__orders.get(order_id)
+        if booking is None:
+            return
+        station, patient_id, day, c_start, c_end = booking
+        if self.__stations[station][day, c_start:c_end].min(initial=1) < 1:
+            # Counts out of sync with the bookings : nothing is changed, the cache is rebuilt from DB at the next use
+            self.__log(f"Occupancy of {station} inconsistent when removing order {order_id}, cache reloaded")
+            self.__invalid = True
+            return
+        del self.__orders[order_id]
+        self.__stations[station][day, c_start:c_end] -= 1
+        self.__workload[station] -= 1
+        self.__patients[patient_id].pop(order_id, None)
+        if not self.__patients[patient_id]:
+            del self.__patients[patient_id]
+
+    def update_order(self, order: dict[str, Any]):
+        """
+        Function to call each time an order is created or changed. The previous booking of the order (if any) is
+        released and the order is booked again if it is still occupying a station.
+            @pre order: the order document as stored in DB (at least _id, status, patient_id, station_aet, examination_start, examination_end)
+        """
+        with self.__lock:
+            if self.__origin is None:
+                return    # Not loaded yet, the first request will load the order from DB
+            self.__remove(order["_id"])
+            if not self.__invalid:
+                self.__add(order)
+
+    def remove_order(self, order_id: str):
+        """
+        Function to call each time an order is deleted or does not occupy its station anymore
+            @pre order_id: the ID of the order
+        """
+        with self.__lock:
+            self.__remove(order_id)
+
+    def workload(self, station: str) -> int:
+        """
+        Returns the number of orders booked on @station in the range of days
+        """
+        with self.__lock:
+            return self.__workload.get(station, 0)
+
+    def free_mask(self, stations: list[str], patient_id: str, date: datetime.date, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+        Function that checks, for every slot [starts[i], ends[i]) (minutes since midnight) of @date, which stations are
+        free while the patient is free as well.
+            @pre stations: a list of stations (str)
+            @pre patient_id: the patient ID
+            @pre date: the date of the slots (within the range of the cache)
+            @pre starts: array of slot starts in minutes
+            @pre ends: array of slot ends in minutes
+        returns a boolean array (stations x slots), True if the station can take the slot
+        """
+        n_cells = MINUTES_PER_DAY // self.resolution
+        c_starts = starts // self.resolution
+        c_ends = -(-ends // self.resolution)
+        with self.__lock:
+            day = (date - self.__origin).days
+            occupied = np.zeros((len(stations), n_cells), dtype=bool)
+            for i, station in enumerate(stations):
+                if station in self.__stations:
+                    occupied[i] = self.__stations[station][day] > 0
+            for b_day, c_start, c_end in self.__patients.get(patient_id, dict()).values():
+                if b_day == day:
+                    occupied[:, c_start:c_end] = True
+        # Number of occupied cells before each cell, a window is free if the count does not change over it
+        cumulative = np.zeros((len(stations), n_cells + 1), dtype=np.int32)
+        np.cumsum(occupied, axis=1, out=cumulative[:, 1:])
+        return (cumulative[:, c_ends] - cumulative[:, c_starts]) == 0
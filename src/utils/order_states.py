@@ -0,0 +1,74 @@
+"""
+This file contains the transitions of the status of an order during the examination :
+    SCHEDULED -> GENERATED (worklist created) -> IN PROGRESS (first images received) -> FINISHED (study stable)
+Each transition is a single find_one_and_update whose filter contains the statuses allowed before the new one, so that:
+    - Two workers (or a retry of Orthanc) cannot apply the same transition twice, only one of them gets APPLIED
+    - A late callback cannot move an order backward (e.g. new study received after the study is stable)
+The callbacks only perform their side effects (HL7 messages, release of the station) when the transition is APPLIED.
+A transition claimed before a side effect that can fail (worklist sent to Orthanc) is undone if the side effect fails.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo import UpdateOne
+from typing import Any
+
+ORDER_FLOW = ["SCHEDULED", "GENERATED", "IN PROGRESS", "FINISHED"]
+# Statuses of an order that can be (re)scheduled, once its worklist is generated the order keeps its slot
+SCHEDULABLE = ["UNSCHEDULED", "SCHEDULED"]
+# Statuses from which an order can reach a status, a study can become stable even if its new study callback was lost
+TRANSITIONS = {
+    "GENERATED": ["SCHEDULED"],
+    "IN PROGRESS": ["GENERATED"],
+    "FINISHED": ["GENERATED", "IN PROGRESS"],
+}
+
+APPLIED = "applied"
+ALREADY_DONE = "already done"    # The order already reached (or passed) the status, e.g. a retried callback
+CONFLICT = "conflict"    # The order is in a status from which the transition is not allowed
+NOT_FOUND = "not found"
+
+
+def transition(m_client: MongoDBClient, query: dict[str, Any], status: str, fields: dict[str, Any] | None = None) -> tuple[str, dict[str, Any] | None]:
+    """
+    Function that moves the order matching @query to @status in one atomic round trip.
+        @pre m_client: MongoDB client object
+        @pre query: the filter identifying the order ({"_id": ...} or {"accession_number": ...})
+        @pre status: the new status (a key of TRANSITIONS)
+        @pre fields: the other fields set with the status
+    returns the outcome (APPLIED, ALREADY_DONE, CONFLICT, NOT_FOUND) and the order (updated one if APPLIED, current one otherwise)
+    """
+    order = m_client.find_and_update("orders", {**query, "status": {"$in": TRANSITIONS[status]}}, {"status": status, **(fields or dict())})
+    if order is not None:
+        return APPLIED, order
+    # Only read when the transition is refused, to tell the caller why
+    current = m_client.get_document("orders", query)
+    if current is None:
+        return NOT_FOUND, None
+    if current.get("status") in ORDER_FLOW and ORDER_FLOW.index(current["status"]) >= ORDER_FLOW.index(status):
+        return ALREADY_DONE, current
+    return CONFLICT, current
+
+
+def undo(m_client: MongoDBClient, order: dict[str, Any], previous: str, fields: dict[str, Any] | None = None) -> bool:
+    """
+    Function that moves back an order claimed by transition when the side effect of the transition failed. Only the
+    claim of the caller is undone (the order still has the status and the @fields set by its transition).
+        @pre m_client: MongoDB client object
+        @pre order: the order returned by transition (APPLIED)
+        @pre previous: the status of the order before the transition
+        @pre fields: the other fields set by the transition, removed from the order
+    returns True if the order was moved back
+    """
+    fields = fields or dict()
+    result = m_client.bulk_write("orders", [UpdateOne(
+        {"_id": order["_id"], "status": order["status"], **fields},
+        {"$set": {"status": previous}, **({"$unset": {field: "" for field in fields}} if fields else {})}
+    )])
+    return result.modified_count == 1
+
+
+def close(m_client: MongoDBClient, order_id: str) -> dict[str, Any] | None:
+    """
+    Function that deactivates a FINISHED order once it is reported, in one atomic round trip.
+    returns the closed order, None if the order is not FINISHED or already closed (report already created)
+    """
+    return m_client.find_and_update("orders", {"_id": order_id, "status": "FINISHED", "is_active": True}, {"is_active": False})
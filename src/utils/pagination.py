@@ -0,0 +1,84 @@
+"""
+This file contains the keyset pagination of the lists of the application (patients, workflow, reports). Instead of reading
+a whole collection and sorting it in the browser, a page is read sorted by MongoDB on an indexed field :
+    - A page is sorted on (field, _id), _id makes the order total when several documents share the same value
+    - The next page starts after the last document of the current one ({field > last value} or {field = last value and
+      _id > last _id}), the position is given to the client as an opaque cursor ("after")
+    - Only @limit + 1 documents are read (the extra one tells if there is a next page), whatever the size of the collection
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from bson import json_util
+from typing import Any
+import base64
+
+
+class Listing:
+
+    def __init__(self, collection: str, sorts: dict[str, str], default_sort: str, projection: dict[str, int] | None = None):
+        """
+        Constructor for Listing instance (a paginated list of a collection).
+        @pre collection: the name of the collection
+        @pre sorts: the sorts allowed as {sort name (in the URL): field}, each one backed by an index (field, _id) declared
+                    in the index registry (after the equality fields of the queries of the list)
+        @pre default_sort: the sort name used when none is given
+        @pre projection: the fields returned for each document, all of them if None
+        """
+        self.collection = collection
+        self.sorts = sorts
+        self.default_sort = default_sort
+        self.projection = projection
+
+    @staticmethod
+    def encode_cursor(value: Any, last_id: Any) -> str:
+        return base64.urlsafe_b64encode(json_util.dumps([value, last_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> tuple[Any, Any]:
+        """
+        returns the (sort value, _id) of the last document of the previous page, raises ValueError if the cursor is invalid
+        """
+        try:
+            value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception as e:
+            raise ValueError(f"Invalid cursor {cursor}") from e
+        return value, last_id
+
+    @staticmethod
+    def __after(field: str, direction: int, value: Any, last_id: Any) -> dict[str, Any]:
+        """
+        Returns the filter of the documents placed after (@value, @last_id) for the sort (@field, @direction). MongoDB
+        places the missing/null values before the others in ascending order (after in descending order).
+        """
+        op = "$gt" if direction == 1 else "$lt"
+        if value is None:
+            conditions = [{field: None, "_id": {op: last_id}}]
+            if direction == 1:
+                conditions.append({field: {"$ne": None}})
+        else:
+            conditions = [{field: {op: value}}, {field: value, "_id": {op: last_id}}]
+            if direction == -1:
+                conditions.append({field: None})
+        return {"$or": conditions}
+
+    def page(self, m_client: MongoDBClient, query: dict[str, Any], sort: str | None = None, direction: int = 1, after: str | None = None, limit: int = 50) -> tuple[list[dict[str, Any]], str | None]:
+        """
+        Function that reads one page of the list.
+            @pre m_client: MongoDB client object
+            @pre query: the filter of the list
+            @pre sort: the sort name (see sorts), default_sort if None or unknown
+            @pre direction: 1 (ascending) or -1 (descending)
+            @pre after: the cursor returned with the previous page, None for the first page
+            @pre limit: the number of documents of the page
+        returns the documents of the page and the cursor of the next page (None if it is the last page)
+        """
+        field = self.sorts.get(sort, self.sorts[self.default_sort])
+        direction = -1 if direction == -1 else 1
+        if after:
+            query = {"$and": [query, self.__after(field, direction, *self.decode_cursor(after))]}
+        projection = dict(self.projection, **{field: 1}) if self.projection is not None else None
+        documents = m_client.get_documents(self.collection, query, projection=projection, sort=[(field, direction), ("_id", direction)], limit=limit + 1)
+        if len(documents) <= limit:
+            return documents, None
+        documents = documents[:limit]
+        last = documents[-1]
+        return documents, self.encode_cursor(last.get(field), last["_id"])
@@ -0,0 +1,125 @@
+"""
+This file contains an in-process cache of the patients shared by the HL7 handlers and the routes. A patient is read from
+MongoDB at most once while it is used (admission wave, orders of the day) :
+    - The cache keeps the @capacity most recently used patients (LRU), a patient is read again from MongoDB after @ttl
+      seconds to see the changes made through another worker
+    - The writes go through the cache (write-through) : the patient is written in MongoDB and the cache keeps the
+      document returned by MongoDB, no read is needed after a write
+    - A patient deleted or changed outside of the cache must be evicted explicitly (evict)
+The patients returned are shared by all the requests and must not be modified, use update to change a patient.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from pymongo.errors import DuplicateKeyError
+from collections import OrderedDict
+from typing import Any
+import threading
+import time
+
+COLLECTION = "patients"
+
+
+class PatientCache:
+
+    def __init__(self, capacity: int = 10000, ttl: int = 60):
+        """
+        Constructor for PatientCache instance.
+        @pre capacity: the maximum number of patients kept in memory
+        @pre ttl: the number of seconds after which a patient is read again from MongoDB
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.RLock()
+        self.__patients = OrderedDict()    # {patient_id: (loaded at, patient)}, least recently used first
+
+    def __get(self, patient_id: str) -> dict[str, Any] | None:
+        entry = self.__patients.get(patient_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        self.__patients.move_to_end(patient_id)
+        return entry[1]
+
+    def __put(self, patient: dict[str, Any]):
+        self.__patients[patient["_id"]] = (time.monotonic(), patient)
+        self.__patients.move_to_end(patient["_id"])
+        while len(self.__patients) > self.capacity:
+            self.__patients.popitem(last=False)
+
+    def get(self, m_client: MongoDBClient, patient_id: str) -> dict[str, Any] | None:
+        """
+        Returns the patient with @patient_id (None if it does not exist), read from MongoDB if not in the cache
+        """
+        with self.__lock:
+            patient = self.__get(patient_id)
+            if patient is not None:
+                self.hits += 1
+                return patient
+            self.misses += 1
+        patient = m_client.get_document(COLLECTION, {"_id": patient_id})
+        if patient is not None:
+            with self.__lock:
+                self.__put(patient)
+        return patient
+
+    def get_many(self, m_client: MongoDBClient, patient_ids) -> dict[str, dict[str, Any]]:
+        """
+        Returns {patient_id: patient} for the existing patients among @patient_ids, the patients missing from the cache
+        are read with a single query
+        """
+        result = dict()
+        missing = list()
+        with self.__lock:
+            for patient_id in set(patient_ids):
+                patient = self.__get(patient_id)
+                if patient is not None:
+                    self.hits += 1
+                    result[patient_id] = patient
+                else:
+                    self.misses += 1
+                    missing.append(patient_id)
+        if missing:
+            patients = m_client.get_documents(COLLECTION, {"_id": {"$in": missing}})
+            with self.__lock:
+                for patient in patients:
+                    self.__put(patient)
+                    result[patient["_id"]] = patient
+        return result
+
+    def insert(self, m_client: MongoDBClient, patient: dict[str, Any]) -> bool:
+        """
+        Function that registers a new patient (one round trip, no existence check before).
+        returns False if a patient with the same _id already exists
+        """
+        try:
+            m_client.add_document(COLLECTION, patient)
+        except DuplicateKeyError:
+            return False
+        with self.__lock:
+            self.__put(patient)
+        return True
+
+    def update(self, m_client: MongoDBClient, patient_id: str, updated: dict[str, Any]) -> dict[str, Any] | None:
+        """
+        Function that updates the fields @updated of a patient in MongoDB and keeps the updated patient in the cache.
+        returns the updated patient, None if it does not exist
+        """
+        patient = m_client.find_and_update(COLLECTION, {"_id": patient_id}, updated)
+        with self.__lock:
+            if patient is None:
+                self.__patients.pop(patient_id, None)
+            else:
+                self.__put(patient)
+        return patient
+
+    def evict(self, patient_id: str):
+        with self.__lock:
+            self.__patients.pop(patient_id, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__patients.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self.__lock:
+            return {"size": len(self.__patients), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,78 @@
+"""
+This file contains the search keys stored on each patient to search them by the beginning of their name/surname or by the
+way it sounds, with indexes and without regex (collection scan) :
+    - The name and surname are normalized (accents removed, upper case) and split into tokens ("Jean-Éric" -> JEAN, ERIC)
+    - search_prefixes contains every prefix of every token ("N:J", "N:JE", ..., "S:D", "S:DU", ...)
+    - search_phonetic contains the Soundex code of every token ("N:J500", "S:D150", ...)
+The keys are recomputed each time the name or the surname of a patient changes (ADT^A04, ADT^A08, edit profile).
+"""
+from typing import Any
+import re
+import unicodedata
+
+# Longest prefix stored for a token, longer search terms are cut to this length
+MAX_PREFIX = 20
+FIELDS = {"name": "N", "surname": "S"}
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(["AEIOUYHW", "BFPV", "CGJKQSXZ", "DT", "L", "MN", "R"]) for letter in letters}
+
+
+def normalize(text: str | None) -> list[str]:
+    """
+    Returns the tokens of @text without accents, in upper case ("Jean-Éric" -> ["JEAN", "ERIC"])
+    """
+    if not text:
+        return list()
+    stripped = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return re.findall(r"[A-Z0-9]+", stripped.upper())
+
+
+def soundex(token: str) -> str:
+    """
+    Returns the American Soundex code of a normalized token (ROBERT -> R163), the token itself if it has no letter
+    """
+    letters = [c for c in token if c.isalpha()]
+    if not letters:
+        return token
+    code = letters[0]
+    previous = SOUNDEX_CODES[letters[0]]
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES[letter]
+        if digit != "0" and digit != previous:
+            code += digit
+        if letter not in "HW":    # H and W do not separate two letters with the same code
+            previous = digit
+    return (code + "000")[:4]
+
+
+def search_keys(name: str | None, surname: str | None) -> dict[str, list[str]]:
+    """
+    Function that computes the search keys of a patient.
+        @pre name: the name of the patient
+        @pre surname: the surname of the patient
+    returns the fields to store on the patient {"search_prefixes": [...], "search_phonetic": [...]}
+    """
+    prefixes, phonetic = set(), set()
+    for field, value in (("name", name), ("surname", surname)):
+        for token in normalize(value):
+            prefixes.update(f"{FIELDS[field]}:{token[:length]}" for length in range(1, min(len(token), MAX_PREFIX) + 1))
+            phonetic.add(f"{FIELDS[field]}:{soundex(token)}")
+    return {"search_prefixes": sorted(prefixes), "search_phonetic": sorted(phonetic)}
+
+
+def search_query(name: str | None, surname: str | None) -> dict[str, Any]:
+    """
+    Function that builds the query of the patients whose name and surname start with (or sound like) the terms searched.
+    Every term must match a token of the field, in any order ("dup jea" finds "Jean Dupont" if typed in the same field).
+        @pre name: the terms searched in the name
+        @pre surname: the terms searched in the surname
+    returns the MongoDB query (empty if nothing is searched)
+    """
+    prefixes, phonetic = list(), list()
+    for field, value in (("name", name), ("surname", surname)):
+        for token in normalize(value):
+            prefixes.append(f"{FIELDS[field]}:{token[:MAX_PREFIX]}")
+            phonetic.append(f"{FIELDS[field]}:{soundex(token)}")
+    if not prefixes:
+        return dict()
+    return {"$or": [{"search_prefixes": {"$all": prefixes}}, {"search_phonetic": {"$all": phonetic}}]}
+
@@ -0,0 +1,276 @@
+"""
+This file contains an offline optimizer that re-packs a week of SCHEDULED orders of a modality. The scheduler books the
+orders on a grid (slots start at multiples of the procedure duration from the shift start), which leaves gaps too small
+for any later procedure. For each day of the week, the optimizer proposes a compacted assignment :
+    - The orders that cannot move (GENERATED, IN PROGRESS, already started or of another modality) are kept as fixed blocks
+    - The SCHEDULED orders are placed again, one by one, at the earliest time a station is free (patient non-overlap is
+      kept), on the least loaded station in case of tie
+    - Several placement orders are tried within a time budget and the assignment with the least wasted time (gaps shorter
+      than the shortest procedure) and the most balanced stations is kept
+The result is only a proposal with a report of the capacity gained, nothing is written in DB. It can be run nightly :
+    python -m src.utils.repacker CT 2025-05-12 --budget 60 --output proposal.json
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.occupancy import ACTIVE_STATUSES
+from typing import Any
+import argparse
+import bisect
+import datetime
+import json
+import random
+import time
+
+
+def to_hour(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def free_gaps(busy: list[tuple[int, int]], lower: int, upper: int) -> list[tuple[int, int]]:
+    """
+    Returns the free gaps between @lower and @upper given a sorted list of booked intervals @busy
+    """
+    gaps = list()
+    cursor = lower
+    for b_start, b_end in busy:
+        if b_end <= cursor:
+            continue
+        if b_start >= upper:
+            break
+        if b_start > cursor:
+            gaps.append((cursor, b_start))
+        cursor = b_end
+    if cursor < upper:
+        gaps.append((cursor, upper))
+    return gaps
+
+
+class WeekRepacker:
+
+    def __init__(self, d_start: datetime.time, d_end: datetime.time, time_budget: float = 30.0, balance_weight: float = 0.5, seed: int = 0):
+        """
+        Constructor for WeekRepacker instance.
+        @pre d_start: an object representing the work day's start time
+        @pre d_end: an object representing the work day's end time
+        @pre time_budget: the number of seconds the optimizer can spend on the whole week
+        @pre balance_weight: the weight of the difference of busy minutes between stations in the cost of a day
+        @pre seed: the seed of the random placement orders (for reproducible proposals)
+        """
+        self.shift_start = d_start.hour * 60 + d_start.minute
+        self.shift_end = d_end.hour * 60 + d_end.minute
+        self.time_budget = time_budget
+        self.balance_weight = balance_weight
+        self.random = random.Random(seed)
+
+    def __earliest_start(self, station_busy: list[tuple[int, int]], patient_busy: list[tuple[int, int]], duration: int, lower: int) -> int | None:
+        """
+        Returns the earliest start (minutes) after @lower where an order of @duration minutes fits both on the station
+        and for the patient, None if it does not fit in the shift.
+        """
+        for g_start, g_end in free_gaps(sorted(station_busy + patient_busy), lower, self.shift_end):
+            if g_end - g_start >= duration:
+                return g_start
+        return None
+
+    def __place(self, orders: list[dict[str, Any]], stations: list[str], fixed_stations: dict[str, list], fixed_patients: dict[str, list], lower: int) -> dict[str, tuple[str, int, int]] | None:
+        """
+        Place the @orders of one day in the given order, each one at the earliest time on the station that can take
+        it first (the least loaded in case of tie).
+        returns {order_id: (station, start, end)} or None if an order cannot be placed
+        """
+        stations_busy = {station: list(fixed_stations.get(station, [])) for station in stations}
+        patients_busy = {patient_id: list(intervals) for patient_id, intervals in fixed_patients.items()}
+        busy_minutes = {station: sum(end - start for start, end in stations_busy[station]) for station in stations}
+        assignment = dict()
+        for order in orders:
+            best = None
+            for station in stations:
+                start = self.__earliest_start(stations_busy[station], patients_busy.get(order["patient_id"], []), order["duration"], lower)
+                if start is not None and (best is None or (start, busy_minutes[station]) < (best[1], busy_minutes[best[0]])):
+                    best = (station, start)
+            if best is None:
+                return None
+            station, start = best
+            end = start + order["duration"]
+            bisect.insort(stations_busy[station], (start, end))
+            bisect.insort(patients_busy.setdefault(order["patient_id"], list()), (start, end))
+            busy_minutes[station] += order["duration"]
+            assignment[order["_id"]] = (station, start, end)
+        return assignment
+
+    def __day_stats(self, stations_busy: dict[str, list[tuple[int, int]]], lower: int, durations: list[int]) -> dict[str, Any]:
+        """
+        Compute the statistics of a day given the booked intervals of each station.
+            - wasted_minutes: free minutes in gaps shorter than the shortest procedure (no order can use them)
+            - busy_spread: difference of busy minutes between the most and the least loaded station
+            - capacity: for each procedure duration, the number of orders that still fit in the free gaps
+        """
+        shortest = min(durations)
+        wasted = 0
+        capacity = {duration: 0 for duration in durations}
+        busy_minutes = list()
+        for busy in stations_busy.values():
+            busy = sorted(busy)
+            busy_minutes.append(sum(end - start for start, end in busy))
+            for g_start, g_end in free_gaps(busy, lower, self.shift_end):
+                if g_end - g_start < shortest:
+                    wasted += g_end - g_start
+                for duration in durations:
+                    capacity[duration] += (g_end - g_start) // duration
+        return {
+            "wasted_minutes": wasted,
+            "busy_spread": max(busy_minutes) - min(busy_minutes) if busy_minutes else 0,
+            "capacity": capacity
+        }
+
+    def __cost(self, stats: dict[str, Any]) -> float:
+        return stats["wasted_minutes"] + self.balance_weight * stats["busy_spread"]
+
+    def optimize_day(self, orders: list[dict[str, Any]], stations: list[str], fixed_stations: dict[str, list], fixed_patients: dict[str, list], lower: int, deadline: float) -> tuple[dict[str, tuple[str, int, int]], dict, dict]:
+        """
+        Function that searches a compacted assignment for the movable @orders of one day until @deadline.
+            @pre orders: the movable orders of the day with their "duration" and current "station_aet", "start", "end"
+            @pre stations: the stations of the modality
+            @pre fixed_stations: {station: sorted list of (start, end)} that cannot move
+            @pre fixed_patients: {patient_id: sorted list of (start, end)} that cannot move
+            @pre lower: the first minute an order can start
+            @pre deadline: the time.monotonic() value after which the search stops
+        returns (assignment {order_id: (station, start, end)}, statistics before, statistics after)
+        """
+        durations = sorted({order["duration"] for order in orders})
+
+        def stats_of(assignment):
+            stations_busy = {station: list(fixed_stations.get(station, [])) for station in stations}
+            for station, start, end in assignment.values():
+                stations_busy.setdefault(station, list()).append((start, end))
+            return self.__day_stats(stations_busy, lower, durations)
+
+        current = {order["_id"]: (order["station_aet"], order["start"], order["end"]) for order in orders}
+        before = stats_of(current)
+        best, best_stats = current, before
+        # Longest first, then the current order of the day, then random orders while there is time left
+        candidates = [
+            sorted(orders, key=lambda order: (-order["duration"], order["start"])),
+            sorted(orders, key=lambda order: order["start"])
+        ]
+        attempt = 0
+        while attempt < len(candidates) or time.monotonic() < deadline:
+            if attempt < len(candidates):
+                ordering = candidates[attempt]
+            else:
+                ordering = list(orders)
+                self.random.shuffle(ordering)
+            attempt += 1
+            assignment = self.__place(ordering, stations, fixed_stations, fixed_patients, lower)
+            if assignment is None:
+                continue
+            stats = stats_of(assignment)
+            if self.__cost(stats) < self.__cost(best_stats):
+                best, best_stats = assignment, stats
+            if len(orders) <= 1:
+                break
+        return best, before, best_stats
+
+    def run(self, m_client: MongoDBClient, modality: str, week_start: datetime.date, stations: list[str] | None = None) -> dict[str, Any]:
+        """
+        Entry point of the optimizer : load the week of @modality starting at @week_start and propose a compacted
+        assignment for each day.
+            @pre m_client: MongoDB client object
+            @pre modality: the modality to optimize (e.g. "CT")
+            @pre week_start: the first day of the week
+            @pre stations: the stations of the modality, by default the stations used by the orders of the week
+        returns a dictionary with the proposed moves and the report of the capacity gained
+        """
+        week = [week_start + datetime.timedelta(days=i) for i in range(7)]
+        orders = m_client.get_documents(
+            "orders",
+            {
+                "status": {"$in": ACTIVE_STATUSES},
+                "examination_start": {
+                    "$gte": datetime.datetime.combine(week[0], datetime.time()),
+                    "$lt": datetime.datetime.combine(week[-1] + datetime.timedelta(days=1), datetime.time())
+                }
+            },
+            projection={"_id": 1, "status": 1, "patient_id": 1, "modality": 1, "station_aet": 1, "examination_start": 1, "examination_end": 1}
+        )
+        stations = sorted(set(stations or []) | {order["station_aet"] for order in orders if order.get("modality") == modality and order.get("station_aet")})
+        now = datetime.datetime.now()
+        deadline = time.monotonic() + self.time_budget
+
+        moves = list()
+        days = dict()
+        for i, date in enumerate(week):
+            str_date = date.strftime("%Y-%m-%d")
+            lower = self.shift_start
+            if date == now.date():
+                lower = max(lower, now.hour * 60 + now.minute + 1)
+            elif date < now.date():
+                continue
+            movable = list()
+            fixed_stations = dict()
+            fixed_patients = dict()
+            for order in orders:
+                if order["examination_start"].date() != date:
+                    continue
+                start = order["examination_start"].hour * 60 + order["examination_start"].minute
+                end = order["examination_end"].hour * 60 + order["examination_end"].minute
+                if order.get("modality") == modality and order["status"] == "SCHEDULED" and start >= lower and order.get("station_aet") in stations:
+                    movable.append({"_id": order["_id"], "patient_id": order["patient_id"], "station_aet": order["station_aet"], "start": start, "end": end, "duration": end - start})
+                else:
+                    if order.get("station_aet") in stations:
+                        bisect.insort(fixed_stations.setdefault(order["station_aet"], list()), (start, end))
+                    bisect.insort(fixed_patients.setdefault(order["patient_id"], list()), (start, end))
+            if not movable:
+                continue
+            # The remaining budget is shared between the remaining days
+            day_deadline = time.monotonic() + (deadline - time.monotonic()) / (len(week) - i)
+            assignment, before, after = self.optimize_day(movable, stations, fixed_stations, fixed_patients, lower, day_deadline)
+            days[str_date] = {"orders": len(movable), "before": before, "after": after}
+            for order in movable:
+                station, start, end = assignment[order["_id"]]
+                if (station, start) != (order["station_aet"], order["start"]):
+                    moves.append({
+                        "order_id": order["_id"],
+                        "from": {"station_aet": order["station_aet"], "date": str_date, "start_time": to_hour(order["start"]), "end_time": to_hour(order["end"])},
+                        "to": {"station_aet": station, "date": str_date, "start_time": to_hour(start), "end_time": to_hour(end)}
+                    })
+
+        gained = dict()
+        for day in days.values():
+            for duration, capacity in day["after"]["capacity"].items():
+                gained[duration] = gained.get(duration, 0) + capacity - day["before"]["capacity"][duration]
+        return {
+            "modality": modality,
+            "week_start": week_start.strftime("%Y-%m-%d"),
+            "stations": stations,
+            "moves": moves,
+            "report": {
+                "days": days,
+                "wasted_minutes_before": sum(day["before"]["wasted_minutes"] for day in days.values()),
+                "wasted_minutes_after": sum(day["after"]["wasted_minutes"] for day in days.values()),
+                "extra_orders_by_duration": gained
+            }
+        }
+
+
+if __name__ == "__main__":
+    import src.config as config
+
+    parser = argparse.ArgumentParser(description="Propose a compacted assignment of a week of SCHEDULED orders")
+    parser.add_argument("modality", help="modality to optimize (e.g. CT)")
+    parser.add_argument("week_start", help="first day of the week (YYYY-MM-DD)")
+    parser.add_argument("--stations", nargs="*", default=None, help="stations of the modality (default: stations used in the week)")
+    parser.add_argument("--budget", type=float, default=30.0, help="time budget in seconds")
+    parser.add_argument("--output", default=None, help="file to write the proposal (default: stdout)")
+    args = parser.parse_args()
+
+    repacker = WeekRepacker(
+        datetime.datetime.strptime(config.SHIFT_START, "%H:%M").time(),
+        datetime.datetime.strptime(config.SHIFT_END, "%H:%M").time(),
+        time_budget=args.budget
+    )
+    proposal = repacker.run(MongoDBClient(), args.modality, datetime.datetime.strptime(args.week_start, "%Y-%m-%d").date(), args.stations)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(proposal, f, indent=4)
+    else:
+        print(json.dumps(proposal, indent=4))
@@ -0,0 +1,102 @@
+"""
+This file contains the reservation mechanism preventing two workers (or two clerks) from booking the same station or the
+same patient at the same time. The computation of the free slots is not atomic with the write of the order, so before
+writing a booking, the worker reserves it :
+    - A booking [start, end) is split into cells of one minute, one reservation document per cell for the station and
+      one per cell for the patient, the _id of the document being the cell ("S|CT1|2025-05-12|08:00", "P|<patient>|...").
+      Only the bookings really overlapping share a cell, whatever their alignment (back-to-back bookings never clash)
+    - The documents are inserted at once, the unique _id makes MongoDB refuse a cell already reserved by another order
+    - On conflict, the cells inserted by the worker are removed and the booking is refused
+No lock is needed and the check holds for any number of workers sharing the database. The reservations expire (TTL
+index) one day after the end of the examination day.
+"""
+from src.utils.MongoDBClient import MongoDBClient
+from src.utils.occupancy import ACTIVE_STATUSES
+from pymongo.errors import BulkWriteError
+import datetime
+
+COLLECTION = "reservations"
+
+
+class SlotReservations:
+
+    def __keys(self, station: str, patient_id: str, date: str, start_t: str, end_t: str) -> list[str]:
+        """
+        Returns the _id of all the minutes covered by a booking [@start_t, @end_t), for the station and for the patient
+        """
+        start_h, start_m = start_t.split(":")
+        end_h, end_m = end_t.split(":")
+        minutes = [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(int(start_h) * 60 + int(start_m), int(end_h) * 60 + int(end_m))]
+        keys = [f"S|{station}|{date}|{minute}" for minute in minutes]
+        keys += [f"P|{patient_id}|{date}|{minute}" for minute in minutes]
+        return keys
+
+    def reserve(self, m_client: MongoDBClient, order_id: str, station: str, patient_id: str, date: str, start_t: str, end_t: str) -> list[str] | None:
+        """
+        Function that atomically reserves a booking for an order before writing it. The previous reservations of the
+        order are kept until confirm (the order can still keep its previous slot if the booking fails later).
+            @pre m_client: MongoDB client object
+            @pre order_id: the ID of the order to book
+            @pre station: the station of the booking
+            @pre patient_id: the patient ID of the order
+            @pre date: the date of the booking ("%Y-%m-%d")
+            @pre start_t: the start time of the booking ("%H:%M")
+            @pre end_t: the end time of the booking ("%H:%M")
+        returns the keys inserted by this call (to cancel them), None if the booking overlaps another reservation
+        """
+        keys = self.__keys(station, patient_id, date, start_t, end_t)
+        existing = m_client.get_documents(COLLECTION, {"_id": {"$in": keys}}, projection={"order_id": 1})
+        if any(doc["order_id"] != order_id for doc in existing):
+            return None    # Some cells are already reserved by another order
+        owned = {doc["_id"] for doc in existing}
+        expires_at = datetime.datetime.strptime(date, "%Y-%m-%d") + datetime.timedelta(days=2)
+        to_insert = [key for key in keys if key not in owned]
+        if not to_insert:
+            return list()
+        try:
+            m_client.add_documents(COLLECTION, [{"_id": key, "order_id": order_id, "expires_at": expires_at} for key in to_insert], ordered=False)
+        except BulkWriteError:
+            # Another worker reserved one of the cells in the meantime
+            self.cancel(m_client, order_id, to_insert)
+            return None
+        return to_insert
+
+    def cancel(self, m_client: MongoDBClient, order_id: str, keys: list[str]):
+        """
+        Remove the reservations @keys made by reserve when the booking is finally not written
+        """
+        if keys:
+            m_client.delete_documents(COLLECTION, {"_id": {"$in": keys}, "order_id": order_id})
+
+    def confirm(self, m_client: MongoDBClient, order_id: str, station: str, patient_id: str, date: str, start_t: str, end_t: str):
+        """
+        Function to call once the booking is written : the other reservations of the order (previous slot) are released
+        """
+        m_client.delete_documents(COLLECTION, {"order_id": order_id, "_id": {"$nin": self.__keys(station, patient_id, date, start_t, end_t)}})
+
+    def release(self, m_client: MongoDBClient, order_id: str):
+        """
+        Release all the reservations of an order (deleted, cancelled or finished order)
+        """
+        m_client.delete_documents(COLLECTION, {"order_id": order_id})
+
+    def backfill(self, m_client: MongoDBClient) -> int:
+        """
+        Reserve the active orders already booked today or later (orders booked before the reservations existed).
+        returns the number of orders that could not be reserved because they overlap another one
+        """
+        conflicts = 0
+        orders = m_client.iter_documents(
+            "orders",
+            {"status": {"$in": ACTIVE_STATUSES}, "examination_start": {"$gte": datetime.datetime.combine(datetime.date.today(), datetime.time())}},
+            projection={"_id": 1, "patient_id": 1, "station_aet": 1, "examination_date": 1}
+        )
+        for order in orders:
+            if self.reserve(m_client, order["_id"], order["station_aet"], order["patient_id"], order["examination_date"]["date"], order["examination_date"]["start_time"], order["examination_date"]["end_time"]) is None:
+                conflicts += 1
+        return conflicts
+
+
+if __name__ == "__main__":
+    n_conflicts = SlotReservations().backfill(MongoDBClient())
+    print(f"Reservations created, {n_conflicts} overlapping orders")
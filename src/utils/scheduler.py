@@ -1,214 +1,324 @@
 """
 This file contains all the logic about the scheduling of an order. It generates all the possible slot to book for a
 specific order and patient, including the constraint of a shift and a range of day. It works as following :
-    - Extract the examens already reserved for each station of the concerned modality + examens already scheduled for a certain patient (avoid overlapping)
-    - Generate all the possible slots given a shift and a range of day
-    - Delete already booked slots or overlapping slot with existing orders
-    - Returns all the remaining slot that can be booked
+    - Extract, in a single query, the examens already reserved for each station of the concerned modality + examens already scheduled for a certain patient (avoid overlapping)
+    - Keep the booked intervals of each station (and of the patient) sorted for each day of the range
+    - Sweep these intervals to find the free gaps of each station within the shift
+    - Returns the slots of the planning grid that fit in a free gap
+The slots of the planning are stored in arrays (SlotGrid) and only the returned slots are created as Slot objects.
 """
 from src.utils.MongoDBClient import MongoDBClient
-from typing import Any
+from src.utils.occupancy import ACTIVE_STATUSES, OccupancyCache
+from typing import Any, Iterator
+import bisect
 import datetime
+import heapq
+import numpy as np
 
 
 class Slot:
+    __slots__ = ("date", "start_t", "end_t")
 
-    def __init__(self, date, start_t, end_t, stations):
+    def __init__(self, date, start_t, end_t):
         """
-        Slot is an object representing a Slot for an examen that can be booked
+        Slot is an object representing a Slot for an examen that can be booked, only created for the returned slots
             @param date: the date of the slot (without hours)
             @param start_t: the start time of the slot
             @param end_t: the end time of the slot
-            @param stations: a list reprensenting all the stations that can perform the examen
         """
         self.date = date
         self.start_t = start_t
         self.end_t = end_t
-        self.stations = dict()
-        self.is_active = True
-        for station in stations:
-            self.stations[station] = True
-        self._nb_stations_available = len(self.stations)
 
-    def disable_station(self, station: str):
+
+class SlotGrid:
+
+    def __init__(self, dates: list[datetime.date], shift_start: int, shift_end: int, duration: int, stations: list[str], not_before: int = 0):
+        """
+        SlotGrid is a compact representation of all the slots of the planning : the slots of a day start at a multiple
+        of @duration from the shift start. Instead of one object per slot, the grid stores the day index, start and end
+        (minutes since midnight) of the slots in arrays and a (stations x slots) mask of the available stations.
+            @param dates: the dates of the planning
+            @param shift_start: the start of the shift (minutes)
+            @param shift_end: the end of the shift (minutes)
+            @param duration: an integer representing the duration in minutes of the procedure to schedule
+            @param stations: a list of stations (str)
+            @param not_before: the slots of the first date starting before (minutes) are not generated
         """
-        Function that disables a station from a slot (self). If a slot has no remaining station available
-        the slot is disabled and cannot be returned by the scheduler.
-            @param station: the station to disable
+        day_starts = np.arange(shift_start, shift_end - duration + 1, duration, dtype=np.int64)
+        first_day_starts = day_starts[day_starts >= not_before]
+        self.dates = dates
+        self.stations = stations
+        self.duration = duration
+        self.starts = np.concatenate([first_day_starts] + [day_starts] * (len(dates) - 1)) if dates else day_starts[:0]
+        self.ends = self.starts + duration
+        # Index of the first slot of each day (+ end of the grid)
+        self.offsets = np.concatenate(([0], len(first_day_starts) + len(day_starts) * np.arange(len(dates)))) if dates else np.zeros(1, dtype=np.int64)
+        self.available = np.zeros((len(stations), len(self.starts)), dtype=bool)
+
+    def day(self, i: int) -> slice:
+        """
+        Returns the slice of the slots of the i-th date
         """
-        if not self.is_active:
-            pass
-        elif not self.stations[station]:
-            pass
-        else:
-            self.stations[station] = False
-            self._nb_stations_available -= 1
-            self.check_activity()
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
 
-    def disable_all_stations(self):
+    def enable_gaps(self, station_idx: int, i: int, gaps: list[tuple[int, int]]):
         """
-        Function to disable all the stations and so disable the slot
+        Mark as available for a station the slots of the i-th date fully contained in one of the free @gaps
+            @param station_idx: index of the station in the grid
+            @param i: index of the date in the grid
+            @param gaps: sorted list of (start, end) free intervals (minutes)
         """
-        for station in self.stations.keys():
-            self.disable_station(station)
+        day = self.day(i)
+        starts = self.starts[day]
+        ends = self.ends[day]
+        for g_start, g_end in gaps:
+            lower = np.searchsorted(starts, g_start, side="left")
+            upper = np.searchsorted(ends, g_end, side="right")
+            self.available[station_idx, day.start + lower:day.start + upper] = True
 
-    def check_activity(self):
-        if self._nb_stations_available <= 0:
-            self.is_active = False
+    def iter_schedules(self, workload: np.ndarray) -> Iterator[tuple[str, Slot]]:
+        """
+        Yield the public result of the scheduler : for each slot with at least one available station, the least
+        loaded one (the first one in case of tie) and the Slot, sorted by date and start time.
+            @param workload: array of the workload of each station of the grid
+        """
+        if not self.stations:
+            return
+        chosen = np.where(self.available, workload[:, None], np.iinfo(np.int64).max).argmin(axis=0)
+        days = np.searchsorted(self.offsets, np.arange(len(self.starts)), side="right") - 1
+        for j in np.flatnonzero(self.available.any(axis=0)):
+            date = self.dates[days[j]]
+            day_start = datetime.datetime.combine(date, datetime.time())
+            yield (
+                self.stations[chosen[j]],
+                Slot(
+                    date=date,
+                    start_t=day_start + datetime.timedelta(minutes=int(self.starts[j])),
+                    end_t=day_start + datetime.timedelta(minutes=int(self.ends[j]))
+                )
+            )
 
 
 class Scheduler:
 
-    def __init__(self, d_range: int, d_start: datetime.datetime.time, d_end: datetime.datetime.time):
+    def __init__(self, d_range: int, d_start: datetime.datetime.time, d_end: datetime.datetime.time, occupancy: OccupancyCache | None = None):
         """
         Constructor for Scheduler instance.
         @pre d_range: an integer representing the number of days to search and schedule an order
         @pre d_start: an object representing the work day' start time
         @pre d_end: an object representing the work day's end time
+        @pre occupancy: an optional occupancy cache, if given the booked orders are not read from DB at each request
         """
         self.d_range = d_range
         self.d_start = d_start
         self.d_end = d_end
+        self.occupancy = occupancy
 
-    def __extract_stations_scheduled_orders(self, stations: list, m_client: MongoDBClient) -> dict:
+    def __extract_scheduled_orders(self, stations: list, patient_id: str, m_client: MongoDBClient, first_date: datetime.date, last_date: datetime.date) -> tuple[dict, list[dict[str, Any]]]:
         """
-        Function that extracts all the orders scheduled in DB using one of the stations in @stations.
+        Function that extracts, in one query, all the orders scheduled in DB between @first_date and @last_date using
+        one of the stations in @stations or concerning the patient with @patient_id.
             @pre stations: a list of stations (str)
+            @pre patient_id: the patient ID
             @pre m_client: MongoDB client object
-        returns a dictionary {station: list of orders}
+            @pre first_date: the first date of the planning
+            @pre last_date: the last date of the planning
+        returns a tuple ({station: list of orders}, list of orders concerning the patient)
         """
-        result = dict()
-        for station in stations:
-            result[station] = m_client.get_documents(
-                "orders",
-                {
-                    "station_aet": station,
-                    "status": {
-                        "$in": ["SCHEDULED", "GENERATED", "IN PROGRESS"]
-                    },
-                    "examination_date": {
-                        "date": {"$gte": datetime.datetime.now().strftime("%Y-%m-%d")}
-                    }
+        orders = m_client.get_documents(
+            "orders",
+            {
+                "$or": [
+                    {"station_aet": {"$in": stations}},
+                    {"patient_id": patient_id}
+                ],
+                "status": {
+                    "$in": ACTIVE_STATUSES
+                },
+                "examination_start": {
+                    "$gte": datetime.datetime.combine(first_date, datetime.time()),
+                    "$lt": datetime.datetime.combine(last_date + datetime.timedelta(days=1), datetime.time())
                 }
-            )
-        return result
+            },
+            projection={"_id": 0, "patient_id": 1, "station_aet": 1, "examination_start": 1, "examination_end": 1}
+        )
+        stations_orders = {station: list() for station in stations}
+        patient_orders = list()
+        for order in orders:
+            if order.get("station_aet") in stations_orders:
+                stations_orders[order["station_aet"]].append(order)
+            if order.get("patient_id") == patient_id:
+                patient_orders.append(order)
+        return stations_orders, patient_orders
 
-    def __extract_patient_scheduled_orders(self, patient_id: str, m_client: MongoDBClient) -> list[dict[str, Any]]:
+    @staticmethod
+    def __to_minutes(t: datetime.time | datetime.datetime) -> int:
         """
-        Function that extracts all the orders scheduled in DB concerning the patient with @patient_id
-            @pre patient_id: the patient ID
-            @pre m_client: MongoDB client object
-        return a list of orders concerning patient with @patient_id
+        Convert a time of the day into a number of minutes since midnight
         """
-        return m_client.get_documents('orders', {
-            "patient_id": patient_id,
-            "status": {
-                "$in": ["SCHEDULED", "GENERATED", "IN PROGRESS"]
-            },
-            "examination_date": {
-                "date": {"$gte": datetime.datetime.now().strftime("%Y-%m-%d")}
-            }
-        })
+        return t.hour * 60 + t.minute
+
+    def __now_minutes(self) -> int:
+        """
+        Returns the first minute of today at which a slot can start (the next full minute)
+        """
+        now = datetime.datetime.now()
+        return self.__to_minutes(now.time()) + (1 if now.second or now.microsecond else 0)
+
+    def __booked_intervals(self, orders: list[dict[str, Any]], dates: list[datetime.date]) -> dict[datetime.date, list[tuple[int, int]]]:
+        """
+        Function that converts a list of orders into sorted booked intervals (in minutes since midnight) for each date
+        of the planning. Orders outside the planning are ignored.
+            @pre orders: a list of orders containing examination_start and examination_end (datetime)
+            @pre dates: the dates of the planning
+        returns a dictionary {date: sorted list of (start, end)}
+        """
+        intervals = {date: list() for date in dates}
+        for order in orders:
+            date = order["examination_start"].date()
+            if date not in intervals:
+                continue
+            bisect.insort(intervals[date], (self.__to_minutes(order["examination_start"]), self.__to_minutes(order["examination_end"])))
+        return intervals
 
-    def __create_possible_slots(self, duration: int, stations: list[str]) -> dict[datetime.datetime, list[Slot]]:
+    @staticmethod
+    def __free_gaps(station_busy: list[tuple[int, int]], patient_busy: list[tuple[int, int]], lower: int, upper: int) -> list[tuple[int, int]]:
         """
-        Function that creates all the possible slots (Slot) for a certain order duration starting from the start shift @d_start
-        ending from the end shift @d_end and for a number of day @d_range.
+        Sweep both sorted lists of booked intervals at once and return the free gaps between @lower and @upper.
+            @pre station_busy: sorted list of (start, end) booked on the station
+            @pre patient_busy: sorted list of (start, end) booked for the patient
+            @pre lower: the start of the window (minutes)
+            @pre upper: the end of the window (minutes)
+        returns a sorted list of (start, end) free intervals
+        """
+        gaps = list()
+        cursor = lower
+        for b_start, b_end in heapq.merge(station_busy, patient_busy):
+            if b_end <= cursor:
+                continue
+            if b_start >= upper:
+                break
+            if b_start > cursor:
+                gaps.append((cursor, b_start))
+            cursor = b_end
+        if cursor < upper:
+            gaps.append((cursor, upper))
+        return gaps
+
+    def get_possible_schedules(self, duration: int, patient_id: str, stations: list, m_client: MongoDBClient) -> list[tuple[str, Slot]]:
+        """
+        Function that computes the free slots to be scheduled over the range of days. This is the entry point to get
+        the possible slot to schedule a new order.
             @pre duration: an integer representing the duration in minutes of the procedure to schedule
+            @pre patient_id: the patient ID
             @pre stations: a list of stations (str)
-        return a dictionary {date: list of slots}
-        """
-        current_date = datetime.date.today()   # Date without time
-        dates = [current_date + datetime.timedelta(days=i) for i in range(self.d_range + 1)]
-        planning = dict()
-        # Generate all the timing for 1 day
-        for date in dates:
-            planning[date] = list()
-            current_start_time = datetime.datetime.combine(date, self.d_start)
-            current_end_time = current_start_time + datetime.timedelta(minutes=duration)
-            while current_end_time.time() <= self.d_end:
-                planning[date].append(
-                    Slot(
-                        date=date,
-                        start_t=current_start_time,
-                        end_t=current_end_time,
-                        stations=stations
-                    )
-                )
-                current_start_time = current_end_time
-                current_end_time = current_start_time + datetime.timedelta(minutes=duration)
-        return planning
+            @pre m_client: MongoDB client object
+        returns a list of (station, Slot) sorted by date and start time
+        """
+        return list(self.iter_possible_schedules(duration, patient_id, stations, m_client))
 
-    def get_possible_schedules(self, duration: int, patient_id: str, stations: list, m_client: MongoDBClient) -> list[tuple[str, Slot]]:
+    def iter_possible_schedules(self, duration: int, patient_id: str, stations: list, m_client: MongoDBClient, after: datetime.datetime | None = None, horizon: int | None = None) -> Iterator[tuple[str, Slot]]:
         """
-        Function that delete impossible slot and only return the possible slots to be scheduled. This is the entry point
-        to get the possible slot to schedule a new order
+        Lazy version of get_possible_schedules : the planning is computed day by day (or by chunk of days when the
+        booked orders are read from DB) only while the caller asks for more slots, so the cost does not depend on the
+        horizon when only the first slots are needed.
+        Booked intervals are kept sorted per station and per day, the free gaps are obtained by a sweep over them and
+        only the slots fitting in a gap are generated. If the scheduler has an occupancy cache, the days covered by the
+        cache are checked against it instead of reading the booked orders from DB.
             @pre duration: an integer representing the duration in minutes of the procedure to schedule
             @pre patient_id: the patient ID
             @pre stations: a list of stations (str)
             @pre m_client: MongoDB client object
+            @pre after: if given, only the slots starting strictly after this datetime are returned
+            @pre horizon: the number of days (after today) to search, the range of days by default
+        yields (station, Slot) sorted by date and start time
+        """
+        duration = int(duration)
+        horizon = self.d_range if horizon is None else horizon
+        current_date = datetime.date.today()
+        if self.occupancy is not None:
+            self.occupancy.ensure_fresh(m_client)
+        i = 0 if after is None else max(0, (after.date() - current_date).days)
+        while i <= horizon:
+            if self.occupancy is not None and i <= self.d_range:
+                dates = [current_date + datetime.timedelta(days=i)]
+                grid, workload = self.__grid_from_occupancy(dates, duration, patient_id, stations, self.occupancy)
+            else:
+                dates = [current_date + datetime.timedelta(days=j) for j in range(i, min(horizon, i + self.d_range) + 1)]
+                grid, workload = self.__grid_from_orders(dates, duration, patient_id, stations, m_client)
+            for station, slot in grid.iter_schedules(workload):
+                if after is None or slot.start_t > after:
+                    yield station, slot
+            i += len(dates)
+
+    def __grid_from_orders(self, dates: list[datetime.date], duration: int, patient_id: str, stations: list, m_client: MongoDBClient) -> tuple[SlotGrid, np.ndarray]:
         """
-        start_date = datetime.date.today()
-        end_date = datetime.date.today() + datetime.timedelta(days=self.d_range)
-        stations_scheduled_orders = self.__extract_stations_scheduled_orders(stations, m_client)
-        patient_scheduled_orders = self.__extract_patient_scheduled_orders(patient_id, m_client)
-        planning = self.__create_possible_slots(duration, stations)
+        Build the grid of @dates from the orders booked in DB (sweep over the sorted booked intervals).
+        returns the grid and the workload of each station over @dates
+        """
+        stations_scheduled_orders, patient_scheduled_orders = self.__extract_scheduled_orders(stations, patient_id, m_client, dates[0], dates[-1])
         # Inferring the workload of each possible station :
-        stations_workload = dict()
-        for station in stations:
-            stations_workload[station] = 0
-        for station, orders in stations_scheduled_orders.items():
-            stations_workload[station] = len(orders)
-
-        current_time = datetime.datetime.now().time()
-        for i in range(len(planning[start_date])):
-            if planning[start_date][i].start_t.time() < current_time:
-                planning[start_date][i].disable_all_stations()
-        for station, orders in stations_scheduled_orders.items():
-            for order in orders:
-                date = datetime.datetime.strptime(order["examination_date"]["date"], "%Y-%m-%d").date()
-                o_start_t = datetime.datetime.combine(date, datetime.datetime.strptime(order["examination_date"]["start_time"], "%H:%M").time())
-                o_end_t = datetime.datetime.combine(date, datetime.datetime.strptime(order["examination_date"]["end_time"], "%H:%M").time())
-                for i in range(len(planning[date])):
-                    if self.__is_overlapping(planning[date][i].start_t, planning[date][i].end_t, o_start_t, o_end_t):
-                        planning[date][i].disable_station(station)
-        for order in patient_scheduled_orders:
-            date = datetime.datetime.strptime(order["examination_date"]["date"], "%Y-%m-%d").date()
-            o_start_t = datetime.datetime.combine(date, datetime.datetime.strptime(order["examination_date"]["start_time"], "%H:%M").time())
-            o_end_t = datetime.datetime.combine(date, datetime.datetime.strptime(order["examination_date"]["end_time"], "%H:%M").time())
-            for i in range(len(planning[date])):
-                if self.__is_overlapping(planning[date][i].start_t, planning[date][i].end_t, o_start_t, o_end_t):
-                    planning[date][i].disable_all_stations()
+        workload = np.array([len(stations_scheduled_orders.get(station, [])) for station in stations], dtype=np.int64)
+        stations_busy = {station: self.__booked_intervals(stations_scheduled_orders.get(station, []), dates) for station in stations}
+        patient_busy = self.__booked_intervals(patient_scheduled_orders, dates)
+
+        shift_start = self.__to_minutes(self.d_start)
+        shift_end = self.__to_minutes(self.d_end)
+        not_before = self.__now_minutes() if dates[0] == datetime.date.today() else 0
+        grid = SlotGrid(dates, shift_start, shift_end, duration, stations, not_before)
+        for i, date in enumerate(dates):
+            lower = max(shift_start, not_before) if i == 0 else shift_start
+            for k, station in enumerate(stations):
+                grid.enable_gaps(k, i, self.__free_gaps(stations_busy[station][date], patient_busy[date], lower, shift_end))
+        return grid, workload
+
+    def __grid_from_occupancy(self, dates: list[datetime.date], duration: int, patient_id: str, stations: list, occupancy: OccupancyCache) -> tuple[SlotGrid, np.ndarray]:
+        """
+        Build the grid of @dates (covered by the @occupancy cache), all the slots of a day are checked at once.
+        returns the grid and the workload of each station
+        """
+        workload = np.array([occupancy.workload(station) for station in stations], dtype=np.int64)
+        not_before = self.__now_minutes() if dates[0] == datetime.date.today() else 0
+        grid = SlotGrid(dates, self.__to_minutes(self.d_start), self.__to_minutes(self.d_end), duration, stations, not_before)
+        for i, date in enumerate(dates):
+            day = grid.day(i)
+            grid.available[:, day] = occupancy.free_mask(stations, patient_id, date, grid.starts[day], grid.ends[day])
+        return grid, workload
+
+    def schedule_batch(self, requests: list[tuple[dict[str, Any], int, list[str]]], m_client: MongoDBClient) -> list[tuple[str, Slot] | None]:
+        """
+        Function that assigns a slot to several orders in one pass over the occupancy data. Each order gets the first
+        free slot of the range of days (on the least loaded station), then its booking is added to the occupancy so
+        the following orders cannot overlap it (on the station or for the patient) and the workload stays balanced.
+        The bookings are added to the occupancy cache of the scheduler (if any) : the caller has to restore the orders
+        that are finally not persisted with OccupancyCache.update_order.
+            @pre requests: a list of (order, duration in minutes of its procedure, stations that can perform it)
+            @pre m_client: MongoDB client object
+        returns for each request the chosen (station, Slot) or None if no slot is available
+        """
+        occupancy = self.occupancy if self.occupancy is not None else OccupancyCache(self.d_range)
+        occupancy.ensure_fresh(m_client)
+        current_date = datetime.date.today()
         result = list()
-        for date, slots in planning.items():
-            for slot in slots:
-                if slot.is_active:
-                    available_stations = [station for station, val in slot.stations.items() if val]
-                    if len(available_stations) == 1:
-                        result.append((available_stations[0], slot))
-                    else:
-                        filtered_stations_workload = {station: workload for station, workload in stations_workload.items() if station in available_stations}
-                        result.append((min(filtered_stations_workload, key=filtered_stations_workload.get), slot))
+        for order, duration, stations in requests:
+            occupancy.remove_order(order["_id"])    # A rescheduled order must not block its own slot
+            assignment = None
+            for i in range(self.d_range + 1):
+                grid, workload = self.__grid_from_occupancy([current_date + datetime.timedelta(days=i)], int(duration), order["patient_id"], stations, occupancy)
+                assignment = next(grid.iter_schedules(workload), None)
+                if assignment is not None:
+                    break
+            if assignment is None:
+                occupancy.update_order(order)
+            else:
+                station, slot = assignment
+                occupancy.update_order({
+                    **order,
+                    "status": "SCHEDULED",
+                    "station_aet": station,
+                    "examination_start": slot.start_t,
+                    "examination_end": slot.end_t
+                })
+            result.append(assignment)
         return result
-
-    def __is_overlapping(self, t_start_slot: datetime.datetime, t_end_slot: datetime.datetime, t_start_order: datetime.datetime, t_end_order: datetime.datetime) -> bool:
-        """
-        Simple function that checks whether a slot is overlapping with an already scheduled order.
-            @pre t_start_slot: the start time of the slot
-            @pre t_end_slot: the end time of the slot
-            @pre t_start_order: the start time of the order
-            @pre t_end_order: the end time of the order
-        returns True if overlapping, False otherwise
-        """
-        if t_start_order < t_start_slot < t_end_order:
-            return True
-        elif t_start_order < t_end_slot < t_end_order:
-            return True
-        elif t_start_slot == t_start_order and t_end_slot == t_end_order:
-            return True
-        elif t_start_slot < t_start_order and t_end_slot > t_end_order:
-            return True
-        elif t_start_slot > t_start_order and t_end_slot < t_end_order:
-            return True
-        else:
-            return False
\ No newline at end of file
@@ -1,6 +1,7 @@
 """
 This file contained all the utils function. For now, most of the function here are not use anymore.
 """
+import datetime
 import uuid
 
 
@@ -11,6 +12,21 @@ def generate_uuid() -> str:
     return str(uuid.uuid4())
 
 
+def examination_datetimes(examination_date: dict[str, str]) -> dict[str, datetime.datetime]:
+    """
+    Function that converts the examination_date of an order ({"date": "%Y-%m-%d", "start_time": "%H:%M", "end_time": "%H:%M"})
+    into the native datetime fields stored on the order to be used by range queries and the scheduler.
+    returns {"examination_start": datetime, "examination_end": datetime}
+    """
+    date = datetime.datetime.strptime(examination_date["date"], "%Y-%m-%d")
+    start_h, start_m = examination_date["start_time"].split(":")
+    end_h, end_m = examination_date["end_time"].split(":")
+    return {
+        "examination_start": date.replace(hour=int(start_h), minute=int(start_m)),
+        "examination_end": date.replace(hour=int(end_h), minute=int(end_m)),
+    }
+
+
 def generate_patient_id(patient_name: str, patient_dob: str, patient_sex: str):
     """
     Outdated